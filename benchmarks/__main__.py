@@ -0,0 +1,106 @@
+import json
+from pathlib import Path
+
+import click
+
+from worek.compression import CODECS
+from worek.dialects.postgres import Postgres
+
+from . import runner
+
+
+def split(value):
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(help='Generate the dataset and time backups, cleans and restores')
+@click.option('-h', '--host', default=None, help='connection hostname for server')
+@click.option('-p', '--port', default=None, help='connection port for server')
+@click.option('-u', '--user', default=None, help='connection username for server')
+@click.option(
+    '-d',
+    '--dbname',
+    required=True,
+    help='database to benchmark against, EVERYTHING in it is dropped',
+)
+@click.option('--scale', type=float, default=1, help='dataset scale factor')
+@click.option('--seed', type=float, default=0.5, help='dataset random seed, between -1 and 1')
+@click.option('--formats', default='c,d,n', help='comma separated backup formats')
+@click.option(
+    '--compress',
+    default='none,gzip',
+    help=f'comma separated compression codecs, "none" or {", ".join(CODECS)}',
+)
+@click.option('--jobs', default='1,4', help='comma separated job counts')
+@click.option('--repeat', type=int, default=3, help='runs per case, the median is reported')
+@click.option(
+    '-o',
+    '--output',
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help='write the JSON results to this file, otherwise to STDOUT',
+)
+def run(host, port, user, dbname, scale, seed, formats, compress, jobs, repeat, output):
+    codecs = [None if x == 'none' else x for x in split(compress)]
+    unknown = set(codecs) - {None, *CODECS}
+    if unknown:
+        raise click.BadParameter(
+            f'unknown codecs {", ".join(sorted(unknown))}',
+            param_hint='compress',
+        )
+
+    engine = Postgres.construct_engine_from_params(host=host, port=port, user=user, dbname=dbname)
+    try:
+        results = runner.run(
+            engine,
+            scale=scale,
+            seed=seed,
+            formats=split(formats),
+            codecs=codecs,
+            jobs=[int(x) for x in split(jobs)],
+            repeat=repeat,
+            log=lambda line: click.echo(line, err=True),
+        )
+    finally:
+        engine.dispose()
+
+    data = json.dumps(results, indent=2)
+    if output is None:
+        click.echo(data)
+    else:
+        output.write_text(data)
+
+
+@cli.command(help='Compare two benchmark results, exits with 1 when there are regressions')
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option(
+    '--threshold',
+    type=float,
+    default=0.1,
+    help='relative slowdown counted as a regression (default: 0.1)',
+)
+def compare(baseline, current, threshold):
+    baseline = json.loads(baseline.read_text())
+    current = json.loads(current.read_text())
+    if (baseline['scale'], baseline['seed']) != (current['scale'], current['seed']):
+        click.echo('warning: the results are for different datasets', err=True)
+
+    regressions = 0
+    for key, op, before, after, regression in runner.compare(baseline, current, threshold):
+        regressions += regression
+        change = (after - before) / before * 100 if before else 0
+        marker = '  REGRESSION' if regression else ''
+        click.echo(f'{key:<20} {op:<8} {before:8.2f}s {after:8.2f}s {change:+7.1f}%{marker}')
+
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    cli()
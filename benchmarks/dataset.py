@@ -0,0 +1,206 @@
+"""A reproducible synthetic dataset for benchmarking backups and restores
+
+The dataset's size grows linearly with its scale factor and is made of the kinds of objects which
+stress different parts of a backup or restore:
+
+* a wide table with many columns of mixed types and a few indexes, which is mostly about raw data
+  throughput
+* many small tables, where the per object overhead of pg_dump/pg_restore dominates
+* large objects, which are dumped and restored separately from table data
+* many schemas with views, functions and sequences, for cleaning and schema handling
+
+All data is generated on the server with a fixed random seed, so the same scale and seed always
+produce the same content.
+"""
+
+import dataclasses
+
+import sqlalchemy as sa
+from sqlalchemy import text
+
+
+WIDE_SCHEMA = 'bench_wide'
+SMALL_SCHEMA = 'bench_small'
+SCHEMA_PREFIX = 'bench_schema_'
+
+# the number of objects per unit of scale
+WIDE_ROWS = 50_000
+SMALL_TABLES = 200
+SMALL_ROWS = 20
+LARGE_OBJECTS = 20
+LARGE_OBJECT_SIZE = 256 * 1024
+SCHEMAS = 20
+
+# the wide table has WIDE_COLUMN_GROUPS groups of five columns of different types
+WIDE_COLUMN_GROUPS = 10
+
+
+@dataclasses.dataclass
+class DatasetInfo:
+    """A description of a generated dataset, used to verify a restore
+
+    :ivar tables: the number of tables in the benchmark schemas
+    :ivar rows: the total number of rows in those tables
+    :ivar large_objects: the number of large objects
+    :ivar size: the size of the database in bytes
+    """
+
+    tables: int
+    rows: int
+    large_objects: int
+    size: int
+
+
+def wide_table_sql():
+    columns = ['id bigint PRIMARY KEY']
+    values = ['g']
+    for i in range(WIDE_COLUMN_GROUPS):
+        columns += [
+            f'int_{i} integer',
+            f'num_{i} numeric(12, 2)',
+            f'text_{i} text',
+            f'ts_{i} timestamptz',
+            f'flag_{i} boolean',
+        ]
+        values += [
+            '(random() * 1000000)::integer',
+            '(random() * 10000)::numeric(12, 2)',
+            "md5(random()::text) || ' ' || md5(random()::text)",
+            "'2020-01-01'::timestamptz + random() * interval '1000 days'",
+            'random() < 0.5',
+        ]
+
+    return (
+        f'CREATE TABLE {WIDE_SCHEMA}.wide ({", ".join(columns)})',
+        (
+            f'INSERT INTO {WIDE_SCHEMA}.wide SELECT {", ".join(values)}'
+            ' FROM generate_series(1, :rows) AS g'
+        ),
+    )
+
+
+def generate(engine, scale=1, seed=0.5):
+    """Create the benchmark dataset in the database of `engine`
+
+    Existing benchmark schemas are dropped first, anything else in the database is left alone.
+
+    :param scale: the scale factor, a positive number
+    :param seed: the seed of the server's random number generator, between -1 and 1
+    :return: a `DatasetInfo`
+    """
+    schemas = [f'{SCHEMA_PREFIX}{i}' for i in range(max(int(SCHEMAS * scale), 1))]
+
+    with engine.connect() as conn:
+        drop(conn)
+        conn.execute(text('SELECT setseed(:seed)'), {'seed': seed})
+
+        conn.execute(text(f'CREATE SCHEMA {WIDE_SCHEMA}'))
+        create, insert = wide_table_sql()
+        conn.execute(text(create))
+        conn.execute(text(insert), {'rows': int(WIDE_ROWS * scale)})
+        conn.execute(text(f'CREATE INDEX wide_int_0 ON {WIDE_SCHEMA}.wide (int_0)'))
+        conn.execute(text(f'CREATE INDEX wide_text_0 ON {WIDE_SCHEMA}.wide (text_0)'))
+
+        conn.execute(text(f'CREATE SCHEMA {SMALL_SCHEMA}'))
+        for i in range(max(int(SMALL_TABLES * scale), 1)):
+            conn.execute(
+                text(
+                    f"""
+                    CREATE TABLE {SMALL_SCHEMA}.small_{i} (
+                        id serial PRIMARY KEY,
+                        name text NOT NULL,
+                        value double precision
+                    );
+                    INSERT INTO {SMALL_SCHEMA}.small_{i} (name, value)
+                        SELECT md5(random()::text), random() FROM generate_series(1, :rows);
+                    """,
+                ),
+                {'rows': SMALL_ROWS},
+            )
+
+        create_large_objects(conn, max(int(LARGE_OBJECTS * scale), 1))
+
+        for schema in schemas:
+            conn.execute(
+                text(
+                    f"""
+                    CREATE SCHEMA {schema};
+                    CREATE TABLE {schema}.events (
+                        id serial PRIMARY KEY,
+                        kind text NOT NULL,
+                        created timestamptz NOT NULL DEFAULT now()
+                    );
+                    INSERT INTO {schema}.events (kind)
+                        SELECT md5(random()::text) FROM generate_series(1, :rows);
+                    CREATE VIEW {schema}.recent_events AS
+                        SELECT * FROM {schema}.events ORDER BY id DESC LIMIT 10;
+                    CREATE FUNCTION {schema}.event_count() RETURNS bigint AS
+                        'SELECT count(*) FROM {schema}.events' LANGUAGE sql;
+                    CREATE SEQUENCE {schema}.counter;
+                    """,
+                ),
+                {'rows': SMALL_ROWS},
+            )
+
+        conn.commit()
+
+    return describe(engine)
+
+
+def benchmark_schemas(conn):
+    sql = text(
+        'SELECT nspname FROM pg_namespace WHERE nspname IN (:wide, :small) OR nspname LIKE :prefix',
+    )
+    params = {'wide': WIDE_SCHEMA, 'small': SMALL_SCHEMA, 'prefix': f'{SCHEMA_PREFIX}%'}
+    return conn.execute(sql, params).scalars().all()
+
+
+def drop(conn):
+    """Drop the benchmark schemas and all large objects"""
+    for schema in benchmark_schemas(conn):
+        conn.execute(text(f'DROP SCHEMA {schema} CASCADE'))
+    drop_large_objects(conn)
+
+
+def create_large_objects(conn, count):
+    """Create `count` large objects of `LARGE_OBJECT_SIZE` bytes"""
+    conn.execute(
+        text(
+            """
+            SELECT lo_from_bytea(0, convert_to(repeat(md5(random()::text), :repeat), 'UTF8'))
+            FROM generate_series(1, :count)
+            """,
+        ),
+        {'repeat': LARGE_OBJECT_SIZE // 32, 'count': count},
+    )
+
+
+def drop_large_objects(conn):
+    """Drop all large objects, which don't belong to a schema so cleaning a database keeps them"""
+    conn.execute(text('SELECT lo_unlink(oid) FROM pg_largeobject_metadata'))
+
+
+def describe(engine):
+    """Return a `DatasetInfo` for the benchmark dataset currently in the database"""
+    with engine.connect() as conn:
+        tables = conn.execute(
+            text(
+                """
+                SELECT format('%I.%I', schemaname, relname)
+                FROM pg_stat_user_tables
+                WHERE schemaname = ANY(:schemas)
+                """,
+            ),
+            {'schemas': benchmark_schemas(conn)},
+        )
+        tables = tables.scalars().all()
+        rows = sum(conn.execute(text(f'SELECT count(*) FROM {table}')).scalar() for table in tables)
+        large_objects = conn.execute(text('SELECT count(*) FROM pg_largeobject_metadata')).scalar()
+        size = conn.execute(sa.select(sa.func.pg_database_size(sa.func.current_database())))
+
+        return DatasetInfo(
+            tables=len(tables),
+            rows=rows,
+            large_objects=large_objects,
+            size=size.scalar(),
+        )
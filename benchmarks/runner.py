@@ -0,0 +1,197 @@
+"""Time worek's backups, restores and database cleaning across a matrix of settings
+
+Each case backs up the benchmark dataset to a temporary file, cleans the database and restores the
+backup, `repeat` times, recording the wall clock time of each step. The results are written as
+JSON so the runs of two commits can be compared with `compare`.
+"""
+
+import dataclasses
+import datetime as dt
+import itertools
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import worek
+from worek.dialects.postgres import Postgres
+from worek.version import VERSION
+
+from . import dataset
+
+
+RESULTS_FORMAT_VERSION = 1
+OPERATIONS = ('backup', 'clean', 'restore')
+
+
+@dataclasses.dataclass(frozen=True)
+class Case:
+    """One combination of settings to benchmark"""
+
+    file_format: str
+    compress: str | None
+    jobs: int
+
+    @property
+    def key(self):
+        return f'{self.file_format}/{self.compress or "none"}/j{self.jobs}'
+
+
+def cases(formats, codecs, jobs):
+    """Return the cases for every combination of the settings which worek supports"""
+    for file_format, compress, job_count in itertools.product(formats, codecs, jobs):
+        # custom format backups can't be made in parallel
+        if file_format == 'c' and job_count > 1:
+            continue
+        yield Case(file_format, compress, job_count)
+
+
+def git_commit():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def run_case(engine, case, expected, repeat=3):
+    """Benchmark one case, returning its result as a dict
+
+    The case is `verified` when the tables and rows of the database match `expected` after each
+    restore. Large objects are compared on their own, in `large_objects`, as restores limited to
+    some schemas (every restore of a custom or directory format backup) leave them out. Missing
+    large objects are recreated, so the next run and case still back them up.
+
+    :param expected: the `DatasetInfo` the database must match after each restore
+    """
+    seconds = {x: [] for x in OPERATIONS}
+    size = None
+    verified = True
+    large_objects = True
+
+    for _ in range(repeat):
+        with tempfile.TemporaryFile(prefix='worek-bench-') as fp:
+            seconds['backup'].append(
+                timed(
+                    worek.backup,
+                    fp,
+                    file_format=case.file_format,
+                    jobs=case.jobs if case.jobs > 1 else None,
+                    compress=case.compress,
+                    saengine=engine,
+                ),
+            )
+            size = fp.tell()
+
+            seconds['clean'].append(
+                timed(Postgres(engine).clean_existing_database, parallel=case.jobs),
+            )
+            with engine.connect() as conn:
+                dataset.drop_large_objects(conn)
+                conn.commit()
+
+            fp.seek(0)
+            seconds['restore'].append(
+                timed(
+                    worek.restore,
+                    fp,
+                    file_format=case.file_format,
+                    clean_existing_database=False,
+                    jobs=case.jobs if case.jobs > 1 else None,
+                    saengine=engine,
+                ),
+            )
+
+        restored = dataset.describe(engine)
+        verified = verified and (restored.tables, restored.rows) == (expected.tables, expected.rows)
+        if restored.large_objects != expected.large_objects:
+            large_objects = False
+            with engine.connect() as conn:
+                dataset.drop_large_objects(conn)
+                dataset.create_large_objects(conn, expected.large_objects)
+                conn.commit()
+
+    return {
+        'format': case.file_format,
+        'compress': case.compress,
+        'jobs': case.jobs,
+        'size': size,
+        'verified': verified,
+        'large_objects': large_objects,
+        'seconds': seconds,
+        'median': {op: statistics.median(values) for op, values in seconds.items()},
+    }
+
+
+def run(engine, scale=1, seed=0.5, formats=('c',), codecs=(None,), jobs=(1,), repeat=3, log=None):
+    """Generate the dataset and benchmark every case
+
+    .. note:: Every schema of the database is dropped between the backup and the restore, so
+        `engine` must connect to a database used only for benchmarking.
+
+    :param log: an optional callable called with a line of text as each case finishes
+    :return: the results as a dict, ready to be written as JSON
+    """
+    generated = time.perf_counter()
+    expected = dataset.generate(engine, scale=scale, seed=seed)
+    generated = time.perf_counter() - generated
+
+    with engine.connect() as conn:
+        server_version = conn.exec_driver_sql('SHOW server_version').scalar()
+
+    results = {}
+    for case in cases(formats, codecs, jobs):
+        results[case.key] = run_case(engine, case, expected, repeat=repeat)
+        if log is not None:
+            medians = results[case.key]['median']
+            log(
+                f'{case.key}: '
+                + ', '.join(f'{op} {medians[op]:.2f}s' for op in OPERATIONS)
+                + ('' if results[case.key]['verified'] else ' (restore did not match)')
+                + ('' if results[case.key]['large_objects'] else ' (large objects not restored)'),
+            )
+
+    return {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'created': dt.datetime.now(dt.UTC).isoformat(),
+        'worek_version': VERSION,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'server_version': server_version,
+        'scale': scale,
+        'seed': seed,
+        'repeat': repeat,
+        'dataset': dataclasses.asdict(expected),
+        'generate_seconds': generated,
+        'cases': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """Compare the median times of two result sets
+
+    :param threshold: the relative slowdown above which a time is a regression
+    :return: a list of `(case, operation, baseline seconds, current seconds, is regression)`
+        tuples for the cases and operations found in both results
+    """
+    rows = []
+    for key, case in current['cases'].items():
+        if key not in baseline['cases']:
+            continue
+        for op in OPERATIONS:
+            before = baseline['cases'][key]['median'][op]
+            after = case['median'][op]
+            rows.append((key, op, before, after, after > before * (1 + threshold)))
+    return rows
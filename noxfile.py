@@ -38,6 +38,13 @@ def audit(session: nox.Session):
     )
 
 
+@nox.session
+def benchmark(session: nox.Session):
+    """Run the benchmarks, e.g. `nox -s benchmark -- -d worek-bench -o results.json`"""
+    uv_sync(session, 'pytest', project=True)
+    session.run('python', '-m', 'benchmarks', 'run', *session.posargs)
+
+
 def pytest_run(session: nox.Session, *args, **env):
     """
     Using functions for pytest and uv enables more advanced uses cases.  Examples:
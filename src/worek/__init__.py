@@ -1,5 +1,17 @@
-# flake8: noqa
-from .core import (
-    backup,
-    restore,
-)
+import importlib
+
+
+__all__ = ['Session', 'backup', 'restore']
+
+# the API is imported on first use, so the CLI can start without importing SQLAlchemy
+_LAZY = {
+    'backup': 'worek.core',
+    'restore': 'worek.core',
+    'Session': 'worek.session',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(importlib.import_module(_LAZY[name]), name)
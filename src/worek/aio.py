@@ -0,0 +1,284 @@
+"""An asyncio API for running many backups and restores from one event loop
+
+pg_dump, pg_restore and psql run with `asyncio.create_subprocess_exec` and the database queries
+(server info and cleaning) use SQLAlchemy's asyncio engine with the asyncpg driver, so no call
+blocks the event loop or needs a thread of its own. Backups can stream to async sinks and restores
+can read from async sources. Cancelling a backup or restore kills its child process.
+
+Many jobs can share an `asyncio.Semaphore` to limit how many of them run at once::
+
+    limit = asyncio.Semaphore(8)
+    await asyncio.gather(
+        *(worek.aio.backup(f'{name}.dump', dbname=name, semaphore=limit) for name in tenants),
+    )
+
+Only the custom format (and plain text restores) are available, without worek's in-process
+compression and encryption. Custom format backups are still compressed by pg_dump.
+"""
+
+import asyncio
+import contextlib
+import inspect
+import os
+from pathlib import Path
+import subprocess
+
+import sqlalchemy as sa
+
+import worek.dialects.postgres as pgdialect
+from worek.exc import WorekOperationException
+from worek.streams import CHUNK_SIZE, has_fileno
+
+
+def _create_async_engine():
+    try:
+        import asyncpg  # noqa: F401
+        from sqlalchemy.ext.asyncio import create_async_engine
+    except ImportError as err:
+        raise WorekOperationException(
+            'The asyncio API needs the asyncpg package, install worek[aio].',
+        ) from err
+    return create_async_engine
+
+
+def construct_engine_from_params(**params):
+    """Create a SQLAlchemy `AsyncEngine` using asyncpg from the passed params and sensible defaults
+
+    See `Postgres.construct_engine_from_params` for the params.
+    """
+    url = pgdialect.Postgres.construct_engine_from_params(**params).url
+    return _create_async_engine()(url.set(drivername='postgresql+asyncpg'))
+
+
+async def _postgres(engine, schemas=None, version=None):
+    """Return a `Postgres` dialect for building CLI commands, with the server info read async"""
+    async with engine.connect() as conn:
+        row = (await conn.execute(sa.text(pgdialect.SERVER_INFO_SQL))).one()
+
+    return pgdialect.Postgres(
+        engine.sync_engine,
+        schemas=list(schemas) if schemas else list(row.schemas),
+        version=version,
+        server_version=row.version,
+    )
+
+
+@contextlib.asynccontextmanager
+async def _engine(saengine, params):
+    if saengine is not None:
+        yield saengine
+        return
+
+    engine = construct_engine_from_params(**params)
+    try:
+        yield engine
+    finally:
+        await engine.dispose()
+
+
+async def _maybe_await(value):
+    return await value if inspect.isawaitable(value) else value
+
+
+async def _write(sink, data):
+    """Write to a sink whose `write` is a coroutine, a `StreamWriter` or a plain writer"""
+    result = sink.write(data)
+    if inspect.isawaitable(result):
+        await result
+    elif hasattr(sink, 'drain'):
+        await sink.drain()
+
+
+async def _chunks(source):
+    """Yield the data of an async iterable or an object with a sync or async `read`"""
+    if hasattr(source, '__aiter__'):
+        async for chunk in source:
+            yield chunk
+        return
+
+    while chunk := await _maybe_await(source.read(CHUNK_SIZE)):
+        yield chunk
+
+
+async def _feed(source, stdin):
+    try:
+        async for chunk in _chunks(source):
+            stdin.write(chunk)
+            await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # the child exited without reading everything, its exit code tells what happened
+        pass
+    finally:
+        stdin.close()
+
+
+async def _drain(stdout, sink):
+    while chunk := await stdout.read(CHUNK_SIZE):
+        await _write(sink, chunk)
+
+
+async def _execute_cli_command(PG, command, additional_args, stdin=None, stdout=None):
+    """Run a postgres command, pumping Python objects to and from it on the event loop
+
+    :param stdin: a file with a file descriptor, or an async source which is fed to the command
+    :param stdout: a file with a file descriptor, or an async sink the output is written to
+    :return: a `subprocess.CompletedProcess` with the command's stderr
+    """
+    cli_args, env = PG.cli_command(command, additional_args)
+    feed = stdin is not None and not has_fileno(stdin)
+    drain = stdout is not None and not has_fileno(stdout)
+
+    proc = await asyncio.create_subprocess_exec(
+        *cli_args,
+        env=env,
+        stdin=subprocess.PIPE if feed else (stdin or subprocess.DEVNULL),
+        stdout=subprocess.PIPE if drain else (stdout or subprocess.DEVNULL),
+        stderr=subprocess.PIPE,
+    )
+    try:
+        async with asyncio.TaskGroup() as tasks:
+            stderr = tasks.create_task(proc.stderr.read())
+            if feed:
+                tasks.create_task(_feed(stdin, proc.stdin))
+            if drain:
+                tasks.create_task(_drain(proc.stdout, stdout))
+        returncode = await proc.wait()
+    except BaseException:
+        # also on cancellation, the child must not outlive the task
+        if proc.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+        # the process only counts as finished once its pipes are read to the end
+        await proc.communicate()
+        raise
+
+    result = subprocess.CompletedProcess(cli_args, returncode, stdout=None, stderr=stderr.result())
+    if returncode != 0:
+        raise pgdialect.PostgresCLIError(result)
+    return result
+
+
+async def _clean_existing_database(engine, PG, parallel=None):
+    """Clean the database like `Postgres.clean_existing_database`, on async connections
+
+    :param parallel: the number of schemas to clean concurrently (default: 1)
+    :return: the number of objects dropped
+    """
+    schemas = list(PG.schemas)
+    groups = [schemas]
+    if parallel and parallel > 1 and len(schemas) > 1:
+        async with engine.connect() as conn:
+            dependencies = await conn.run_sync(PG.get_schema_dependencies)
+        groups = PG.schema_clean_groups(schemas, dependencies)
+
+    limit = asyncio.Semaphore(parallel or 1)
+
+    async def clean(group):
+        async with limit, engine.connect() as conn:
+            return await conn.run_sync(lambda sync_conn: PG._clean_schemas(group, sync_conn))
+
+    async with asyncio.TaskGroup() as tasks:
+        cleans = [tasks.create_task(clean(group)) for group in groups]
+    return sum(x.result() for x in cleans)
+
+
+async def backup(
+    backup_file,
+    compress_level=None,
+    blobs=True,
+    saengine=None,
+    semaphore=None,
+    schemas=None,
+    version=None,
+    **params,
+):
+    """Create a custom format backup of the database
+
+    :param backup_file: where to send the backup, a path, a file with a file descriptor (pg_dump
+        writes to it directly) or a sink whose `write` is a coroutine (e.g. an aiofiles file or an
+        upload) or which has a `drain` coroutine (e.g. an `asyncio.StreamWriter`)
+    :param compress_level: pg_dump's compression level, 0 for an uncompressed backup
+    :param blobs: include large objects in the backup (default: True)
+    :param saengine: an optional SQLAlchemy `AsyncEngine`, by default one is created from the
+        connection params (see `worek.backup`) and disposed of afterwards
+    :param semaphore: an `asyncio.Semaphore` shared by jobs to limit how many run at once
+    :param schemas: schemas to backup, by default all non-system schemas
+    :param version: version of PG client executables to use
+    :return: a `subprocess.CompletedProcess`
+    """
+    async with semaphore or contextlib.nullcontext(), _engine(saengine, params) as engine:
+        PG = await _postgres(engine, schemas=schemas, version=version)
+        command_args = [
+            '--format',
+            'custom',
+            *(['--blobs'] if blobs else []),
+            *([f'--compress={compress_level}'] if compress_level is not None else []),
+        ]
+
+        with contextlib.ExitStack() as stack:
+            if isinstance(backup_file, str | os.PathLike):
+                backup_file = stack.enter_context(Path(backup_file).open('wb'))
+            return await _execute_cli_command(
+                PG,
+                pgdialect.PostgresCommand.BACKUP,
+                command_args,
+                stdout=backup_file,
+            )
+
+
+async def restore(
+    restore_file,
+    file_format='c',
+    clean_existing_database=True,
+    jobs=None,
+    clean_jobs=None,
+    saengine=None,
+    semaphore=None,
+    schemas=None,
+    version=None,
+    **params,
+):
+    """Restore a backup to the database
+
+    :param restore_file: the backup to restore, a path, a file with a file descriptor, an async
+        iterable of bytes or an object with a `read` coroutine (e.g. an `asyncio.StreamReader`)
+    :param file_format: "c" (custom, the default) or "t" (text)
+    :param clean_existing_database: clean an existing database before restore
+    :param jobs: the number of parallel jobs pg_restore uses, `restore_file` must then be a path
+    :param clean_jobs: the number of schemas to clean concurrently
+    :param saengine: an optional SQLAlchemy `AsyncEngine`, see `backup`
+    :param semaphore: an `asyncio.Semaphore` shared by jobs to limit how many run at once
+    :param schemas: schemas to restore, by default all non-system schemas
+    :param version: version of PG client executables to use
+    :return: a `subprocess.CompletedProcess`
+    """
+    if file_format not in ('c', 't'):
+        raise NotImplementedError(
+            f'Got an unexpected file_format. {file_format} is not a valid type, expecting "c" or'
+            ' "t".',
+        )
+
+    is_path = isinstance(restore_file, str | os.PathLike)
+    if jobs and jobs > 1 and (file_format != 'c' or not is_path):
+        raise WorekOperationException(
+            'Parallel async restores need a custom format backup given as a path.',
+        )
+
+    async with semaphore or contextlib.nullcontext(), _engine(saengine, params) as engine:
+        PG = await _postgres(engine, schemas=schemas, version=version)
+        if clean_existing_database:
+            await _clean_existing_database(engine, PG, parallel=clean_jobs)
+
+        if file_format == 't':
+            command, command_args = pgdialect.PostgresCommand.RESTORE_TEXT, []
+        else:
+            command = pgdialect.PostgresCommand.RESTORE_BINARY
+            command_args = ['--no-owner', '--no-privileges']
+
+        with contextlib.ExitStack() as stack:
+            if jobs and jobs > 1:
+                command_args += ['--jobs', str(jobs), os.fspath(restore_file)]
+                restore_file = None
+            elif is_path:
+                restore_file = stack.enter_context(Path(restore_file).open('rb'))
+            return await _execute_cli_command(PG, command, command_args, stdin=restore_file)
@@ -0,0 +1,127 @@
+"""Checksums of backups computed while they are written
+
+The checksums of a backup have the digest of the whole file, which tools like ``b2sum`` can check,
+and the digest of each of its `chunk_size` chunks, which `verify_file` checks in parallel.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+import hashlib
+import importlib
+import os
+from pathlib import Path
+
+from worek.exc import WorekOperationException
+from worek.streams import BLOCK_SIZE, OrderedParallelWriter
+
+
+ALGORITHMS = ('blake2b', 'xxh3')
+DEFAULT_ALGORITHM = 'blake2b'
+CHUNK_SIZE = BLOCK_SIZE
+
+
+class WorekChecksumError(WorekOperationException):
+    pass
+
+
+def new_hash(algorithm):
+    """Return a new hash object of `algorithm`, one of `ALGORITHMS`"""
+    if algorithm == 'blake2b':
+        return hashlib.blake2b()
+    if algorithm != 'xxh3':
+        raise WorekChecksumError(
+            f'Unknown checksum {algorithm}, expecting one of {", ".join(ALGORITHMS)}.',
+        )
+
+    try:
+        xxhash = importlib.import_module('xxhash')
+    except ImportError as err:
+        raise WorekChecksumError(
+            'xxh3 checksums require the xxhash package. Install it with'
+            ' `pip install worek[xxhash]`.',
+        ) from err
+    return xxhash.xxh3_128()
+
+
+def digest(algorithm, data):
+    """Return the hex digest of `data`"""
+    hasher = new_hash(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+@dataclasses.dataclass
+class Checksums:
+    """The size and digests of a backup file, `chunks` has the digest of each chunk in order"""
+
+    algorithm: str
+    chunk_size: int
+    size: int
+    digest: str
+    chunks: list
+
+    def chunk_range(self, index):
+        """Return the `(start, end)` byte range of a chunk"""
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size)
+
+
+class ChecksumWriter(OrderedParallelWriter):
+    """A writer passing the data written to it on to `sink` unchanged, computing its `Checksums`
+
+    The digest of the whole stream is updated as the data is written, the digests of the chunks
+    are computed on a pool of `threads` threads.
+    """
+
+    def __init__(self, sink, algorithm=DEFAULT_ALGORITHM, chunk_size=CHUNK_SIZE, threads=None):
+        super().__init__(sink, threads=threads, block_size=chunk_size)
+        self.algorithm = algorithm
+        self._hash = new_hash(algorithm)
+        self._size = 0
+        self._chunks = {}
+
+    def write(self, data):
+        self._hash.update(data)
+        self._size += len(data)
+        return super().write(data)
+
+    def transform(self, index, block, last):
+        if block:
+            self._chunks[index] = digest(self.algorithm, block)
+        return block
+
+    def finish(self):
+        """Write the remaining data to the sink and return the `Checksums` of all the data"""
+        self.close()
+        return Checksums(
+            algorithm=self.algorithm,
+            chunk_size=self.block_size,
+            size=self._size,
+            digest=self._hash.hexdigest(),
+            chunks=[self._chunks[x] for x in sorted(self._chunks)],
+        )
+
+
+def verify_file(path, checksums, threads=None):
+    """Check the file at `path` against its `Checksums`, `threads` chunks at a time
+
+    :return: the indexes of the chunks which don't match their digest
+    :raises WorekChecksumError: when the file doesn't have the size of the checksummed data
+    """
+    with Path(path).open('rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size != checksums.size:
+            raise WorekChecksumError(
+                f'{path} has {size} bytes, the checksummed backup had {checksums.size}.',
+            )
+
+        def check(index):
+            start, end = checksums.chunk_range(index)
+            data = os.pread(fp.fileno(), end - start, start)
+            return digest(checksums.algorithm, data) == checksums.chunks[index]
+
+        # each chunk is read by the thread checking it, so only `threads` chunks are in memory
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+            results = list(executor.map(check, range(len(checksums.chunks))))
+
+    return [index for index, matches in enumerate(results) if not matches]
@@ -1,6 +1,22 @@
 import click
 
-import worek.core as core
+from worek import s3, toc
+from worek.checksums import ALGORITHMS, DEFAULT_ALGORITHM
+from worek.compression import CODECS
+from worek.crypto import load_key
+from worek.dialects import DIALECTS
+from worek.exc import WorekOperationException
+from worek.manifest import MANIFEST_SUFFIX, manifest_path
+from worek.progress import format_bytes, format_status
+
+
+class BackupFile(click.File):
+    """A backup file, or an ``s3://bucket/key`` URL which is passed on as is"""
+
+    def convert(self, value, param, ctx):
+        if s3.is_url(value):
+            return value
+        return super().convert(value, param, ctx)
 
 
 @click.group()
@@ -8,12 +24,23 @@ def cli():
     pass
 
 
+def show_progress(status):
+    """Show a `ProgressStatus` on a single, continuously rewritten line of STDERR"""
+    click.echo(f'\r\033[K{format_status(status)}', err=True, nl=status.done)
+
+
 @cli.command(help='Create a database backup')
 @click.option('-h', '--host', default=None, help='connection hostname for server')
 @click.option('-p', '--port', default=None, help='connection port for server')
 @click.option('-u', '--user', default=None, help='connection username for server')
 @click.option('-d', '--dbname', default=None, help='database to backup')
-@click.option('-e', '--engine', default='postgres', help='database type [postgres]')
+@click.option(
+    '-e',
+    '--engine',
+    type=click.Choice(sorted(DIALECTS)),
+    default='postgres',
+    help='database type',
+)
 @click.option(
     '-s',
     '--schema',
@@ -23,27 +50,213 @@ def cli():
 @click.option(
     '-f',
     '--file',
-    'output_file',
+    'output_files',
+    multiple=True,
+    type=BackupFile(mode='w'),
+    help=(
+        'path to file backup location or s3://bucket/key URL, otherwise pipe to STDOUT. Can be'
+        ' used multiple times to write the backup to several locations at once'
+    ),
+)
+@click.option(
+    '-F',
+    '--format',
+    'file_format',
+    type=click.Choice(['c', 'd', 'n']),
+    default='c',
+    help='backup file format, ([c]ustom, [d]irectory packed as a tar stream, [n]ative binary COPY)',
+)
+@click.option(
+    '-j',
+    '--jobs',
+    type=int,
+    default=None,
+    help='number of tables to dump in parallel, requires the directory or native format',
+)
+@click.option(
+    '--type',
+    'backup_type',
+    type=click.Choice(['full', 'incremental']),
+    default='full',
+    help='backup type, an incremental backup only dumps the data of changed tables',
+)
+@click.option(
+    '--parent',
+    type=click.Path(exists=True, dir_okay=False),
     default=None,
-    type=click.File(mode='w'),
-    help='path to file backup location, otherwise pipe to STDOUT',
+    help='previous backup of the incremental chain, otherwise a new chain is started',
+)
+@click.option(
+    '--checksums',
+    is_flag=True,
+    default=False,
+    help='also compare checksums of the rows to find changed tables',
+)
+@click.option(
+    '--repo',
+    type=click.Path(file_okay=False),
+    default=None,
+    help='store the backup in a deduplicating repository, prints the id of the backup',
+)
+@click.option(
+    '--compress',
+    type=click.Choice(CODECS),
+    default=None,
+    help='compress the backup in-process',
+)
+@click.option('--level', type=int, default=None, help='compression level')
+@click.option(
+    '--threads',
+    type=int,
+    default=None,
+    help='compression and encryption threads, default one per CPU',
+)
+@click.option(
+    '--key-file',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='encrypt the backup with the key in this file',
+)
+@click.option(
+    '--key-env',
+    default=None,
+    help='encrypt the backup with the key in this environment variable',
+)
+@click.option(
+    '--progress',
+    is_flag=True,
+    default=False,
+    help='show the bytes dumped, throughput, elapsed time and ETA on STDERR',
+)
+@click.option(
+    '--index',
+    is_flag=True,
+    default=False,
+    help=f'write an index of the backup to FILE{toc.INDEX_SUFFIX}, for worek list and restores',
+)
+@click.option(
+    '--manifest',
+    is_flag=True,
+    default=False,
+    help=f'write the checksums and a description of the backup to FILE{MANIFEST_SUFFIX}',
+)
+@click.option(
+    '--checksum',
+    type=click.Choice(ALGORITHMS),
+    default=DEFAULT_ALGORITHM,
+    help='the digest of the manifest checksums, xxh3 needs the xxhash package',
 )
 @click.option('-v', '--version', default=None, help='major version of PG client utilities')
-def backup(host, port, user, dbname, engine, schema, output_file, version):
-    file_name = output_file if output_file is not None else click.get_text_stream('stdout')
+def backup(
+    host,
+    port,
+    user,
+    dbname,
+    engine,
+    schema,
+    output_files,
+    file_format,
+    jobs,
+    backup_type,
+    parent,
+    checksums,
+    repo,
+    compress,
+    level,
+    threads,
+    key_file,
+    key_env,
+    progress,
+    index,
+    manifest,
+    checksum,
+    version,
+):
+    if repo is not None and output_files:
+        raise click.BadOptionUsage('repo', 'A backup can not go to both a file and a repository.')
+    if index and not output_files:
+        raise click.BadOptionUsage('index', 'An index is written next to a backup file (-f).')
+    if manifest and not output_files:
+        raise click.BadOptionUsage('manifest', 'A manifest is written next to a backup file (-f).')
+
+    file_name = list(output_files) or click.get_text_stream('stdout')
+    if repo is not None:
+        file_name = None
+    # the index and the manifest go next to the first file
+    first_file = getattr(output_files[0], 'name', output_files[0]) if output_files else None
+
+    # the commands import the database code when they run, so --help and usage errors are fast
+    from worek import core
 
     try:
-        core.backup(
+        result = core.backup(
             file_name,
+            backup_type=backup_type,
+            file_format=file_format,
+            jobs=jobs,
+            parent=parent,
+            checksums=checksums,
+            repo=repo,
+            compress=compress,
+            compress_level=level,
+            compress_threads=threads,
+            key_file=key_file,
+            key_env=key_env,
+            progress=show_progress if progress else None,
+            index=toc.index_path(first_file) if index else None,
+            manifest=manifest_path(first_file) if manifest else None,
+            checksum_algorithm=checksum,
             schemas=schema,
             host=host,
             port=port,
             user=user,
             dbname=dbname,
             version=version,
+            dialect=engine,
         )
-    except core.WorekOperationException as e:
+    except WorekOperationException as e:
+        click.echo(str(e), err=True)
+        return
+
+    if repo is not None:
+        click.echo(result.id)
+
+
+@cli.command('backup-all', help='Back up every database of a fleet of servers')
+@click.option(
+    '-c',
+    '--config',
+    'config_file',
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help='YAML or JSON fleet config, see worek.fleet for its format',
+)
+@click.option(
+    '--dry-run',
+    is_flag=True,
+    default=False,
+    help='list the backups which would run, in order, without running them',
+)
+def backup_all(config_file, dry_run):
+    from worek import fleet
+
+    try:
+        config = fleet.load_config(config_file)
+        if dry_run:
+            jobs = fleet.plan(config)
+            for job in jobs:
+                click.echo(f'{job.host} {job.dbname} {job.size} {job.output or job.error}')
+            if any(x.status == 'failed' for x in jobs):
+                raise SystemExit(1)
+            return
+        jobs = fleet.backup_fleet(config)
+    except WorekOperationException as e:
         click.echo(str(e), err=True)
+        raise SystemExit(1) from e
+
+    click.echo(fleet.summary(jobs))
+    if any(x.status == 'failed' for x in jobs):
+        raise SystemExit(1)
 
 
 @cli.command(help='Restore a database backup')
@@ -51,46 +264,315 @@ def backup(host, port, user, dbname, engine, schema, output_file, version):
 @click.option('-p', '--port', default=None, help='connection port for server')
 @click.option('-u', '--user', default=None, help='connection username for server')
 @click.option('-d', '--dbname', default=None, help='database to backup')
-@click.option('-e', '--engine', default='postgres', help='database type [postgres]')
+@click.option(
+    '-e',
+    '--engine',
+    type=click.Choice(sorted(DIALECTS)),
+    default='postgres',
+    help='database type',
+)
 @click.option(
     '-s',
     '--schema',
     multiple=True,
-    help='schemas to backup up, can be used multiple times',
+    help='schemas to restore, can be used multiple times',
+)
+@click.option(
+    '-t',
+    '--table',
+    'tables',
+    multiple=True,
+    help='only restore tables matching this pattern, e.g. "sales.order*", and what goes with them',
+)
+@click.option(
+    '-T',
+    '--exclude-table',
+    'exclude_tables',
+    multiple=True,
+    help='do not restore tables matching this pattern, can be used multiple times',
 )
 @click.option(
     '-f',
     '--file',
     'restore_file',
     default=None,
-    type=click.File(mode='rb'),
-    help='path to file backup location, otherwise the read from STDIN',
+    type=BackupFile(mode='rb'),
+    help='path to file backup location or s3://bucket/key URL, otherwise the read from STDIN',
 )
 @click.option(
     '-F',
     '--format',
     'file_format',
-    type=click.Choice(['c', 't']),
+    type=click.Choice(['c', 'd', 't', 'n', 'i']),
     default=None,
-    help='backup file format, ([c]ustom, [t]ext)',
+    help=(
+        'backup file format, ([c]ustom, [d]irectory tar stream, [t]ext, [n]ative, [i]ncremental),'
+        ' detected from the backup by default'
+    ),
+)
+@click.option(
+    '-j',
+    '--jobs',
+    type=int,
+    default=None,
+    help='number of parallel jobs to load data and build indexes, STDIN is spooled to a temp file',
+)
+@click.option(
+    '--clean-jobs',
+    type=int,
+    default=None,
+    help='number of schemas to clean concurrently before the restore',
+)
+@click.option(
+    '--parent',
+    'parents',
+    multiple=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help='older backup of the incremental chain, can be used multiple times',
+)
+@click.option(
+    '--repo',
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help='restore a backup from a deduplicating repository',
+)
+@click.option(
+    '--backup',
+    'backup_id',
+    default=None,
+    help='id of the repository backup to restore, by default the latest',
+)
+@click.option(
+    '--key-file',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='decrypt the backup with the key in this file',
+)
+@click.option(
+    '--key-env',
+    default=None,
+    help='decrypt the backup with the key in this environment variable',
+)
+@click.option(
+    '--progress',
+    is_flag=True,
+    default=False,
+    help='show the bytes read, throughput, elapsed time and current item on STDERR',
+)
+@click.option(
+    '--index',
+    'index_file',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help=f'index of the backup file to read only the data restored, default FILE{toc.INDEX_SUFFIX}',
 )
 @click.option('-v', '--version', default=None, help='major version of PG client utilities')
-def restore(host, port, user, dbname, engine, schema, restore_file, file_format, version):
+def restore(
+    host,
+    port,
+    user,
+    dbname,
+    engine,
+    schema,
+    tables,
+    exclude_tables,
+    restore_file,
+    file_format,
+    jobs,
+    clean_jobs,
+    parents,
+    repo,
+    backup_id,
+    key_file,
+    key_env,
+    progress,
+    index_file,
+    version,
+):
     file_name = restore_file if restore_file is not None else click.get_binary_stream('stdin')
 
-    if not restore_file and not file_format:
-        raise click.BadArgumentUsage(
-            'You must specify the file format (-F) when using a pipe to STDIN. We can not'
-            ' automatically determine the file format when using a pipe.',
+    if repo is not None:
+        file_name = None
+    elif index_file is None and restore_file is not None and file_format in (None, 'c'):
+        sidecar = toc.index_path(getattr(restore_file, 'name', restore_file))
+        found = s3.exists(sidecar) if s3.is_url(sidecar) else sidecar.exists()
+        index_file = sidecar if found else None
+
+    from worek import core
+
+    try:
+        core.restore(
+            file_name,
+            schemas=schema,
+            tables=tables,
+            exclude_tables=exclude_tables,
+            host=host,
+            port=port,
+            user=user,
+            dbname=dbname,
+            file_format=file_format,
+            jobs=jobs,
+            clean_jobs=clean_jobs,
+            parents=parents,
+            repo=repo,
+            backup_id=backup_id,
+            key_file=key_file,
+            key_env=key_env,
+            progress=show_progress if progress else None,
+            index=index_file,
+            version=version,
+            dialect=engine,
         )
+    except WorekOperationException as e:
+        click.echo(str(e), err=True)
+
+
+@cli.command('index', help='Index the TOC of a custom format backup for worek list and restores')
+@click.argument('backup_file', type=click.File(mode='rb'))
+@click.option(
+    '-o',
+    '--output',
+    type=click.Path(dir_okay=False),
+    default=None,
+    help=f'path of the index, by default BACKUP_FILE{toc.INDEX_SUFFIX}',
+)
+def index(backup_file, output):
+    try:
+        archive_index = toc.index_archive(backup_file)
+    except WorekOperationException as e:
+        click.echo(str(e), err=True)
+        raise SystemExit(1) from e
+
+    archive_index.save(output or toc.index_path(backup_file.name))
+    data = sum(x.size for x in archive_index.entries)
+    click.echo(f'{len(archive_index.entries)} entries, {format_bytes(data)} of data')
+
+
+@cli.command('list', help='List the TOC of a custom format backup from its index')
+@click.argument('backup_file', type=click.File(mode='rb'))
+@click.option(
+    '--index',
+    'index_file',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help=f'index of the backup, by default BACKUP_FILE{toc.INDEX_SUFFIX}, else the backup is read',
+)
+@click.option('-s', '--schema', multiple=True, help='only list these schemas')
+@click.option('--sizes', is_flag=True, default=False, help='show the size of the data of entries')
+def list_(backup_file, index_file, schema, sizes):
+    sidecar = toc.index_path(backup_file.name)
+    if index_file is None and sidecar.exists():
+        index_file = sidecar
+
+    try:
+        if index_file is not None:
+            archive_index = toc.ArchiveIndex.load(index_file)
+            archive_index.check(backup_file)
+        else:
+            archive_index = toc.index_archive(backup_file)
+    except WorekOperationException as e:
+        click.echo(str(e), err=True)
+        raise SystemExit(1) from e
+
+    for entry in archive_index.entries:
+        if entry.desc in toc.UNLISTED or (schema and entry.namespace not in schema):
+            continue
+        # the lines are those of `pg_restore -l`, so the output works with its --use-list
+        size = f'  ({format_bytes(entry.size)})' if sizes and entry.size else ''
+        click.echo(f'{entry.list_line()}{size}')
+
+
+@cli.command(
+    'verify',
+    help='Check a backup file against its manifest and list its archive, without a database',
+)
+@click.argument('backup_file', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--manifest',
+    'manifest_file',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help=f'manifest of the backup, by default BACKUP_FILE{MANIFEST_SUFFIX} if it exists',
+)
+@click.option(
+    '-j',
+    '--jobs',
+    type=int,
+    default=None,
+    help='number of chunks checksummed in parallel, default one per CPU',
+)
+@click.option(
+    '--key-file',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='decrypt the backup with the key in this file',
+)
+@click.option(
+    '--key-env',
+    default=None,
+    help='decrypt the backup with the key in this environment variable',
+)
+def verify_(backup_file, manifest_file, jobs, key_file, key_env):
+    from worek import verify
+
+    sidecar = manifest_path(backup_file)
+    if manifest_file is None and sidecar.exists():
+        manifest_file = sidecar
+
+    try:
+        key = load_key(key_file=key_file, key_env=key_env)
+        result = verify.verify(backup_file, manifest=manifest_file, key=key, threads=jobs)
+    except WorekOperationException as e:
+        click.echo(str(e), err=True)
+        raise SystemExit(1) from e
+
+    if result.checksummed:
+        checksums = 'checked against the manifest'
+    else:
+        checksums = 'not checked' if manifest_file else 'not checked, no manifest'
+    structure = 'not checked' if result.entries is None else f'{result.entries} TOC entries'
+    click.echo(f'{backup_file}: {format_bytes(result.size)}, format {result.file_format or "?"}')
+    click.echo(f'  checksums: {checksums}')
+    click.echo(f'  archive: {structure}')
+    for error in result.errors:
+        click.echo(f'  error: {error}', err=True)
+    if not result.ok:
+        raise SystemExit(1)
+
+
+@cli.command(
+    'compare',
+    help='Compare the row counts and checksums of the tables of two databases, e.g. a restore',
+)
+@click.option('--source', required=True, help='URL of the source database, postgresql://...')
+@click.option('--target', required=True, help='URL of the target database, postgresql://...')
+@click.option(
+    '-s',
+    '--schema',
+    multiple=True,
+    help='schemas to compare, by default every schema of the source',
+)
+@click.option(
+    '-j',
+    '--jobs',
+    type=int,
+    default=4,
+    help='number of tables checksummed at once on each database',
+)
+def compare_(source, target, schema, jobs):
+    from worek import compare
+
+    try:
+        tables = compare.compare(source, target, schemas=list(schema) or None, jobs=jobs)
+    except WorekOperationException as e:
+        click.echo(str(e), err=True)
+        raise SystemExit(1) from e
+
+    for table in tables:
+        rows = '' if table.rows is None else f'  {table.rows} rows'
+        click.echo(f'{table.status:<24} {table.name}{rows}')
 
-    core.restore(
-        file_name,
-        schema=schema,
-        host=host,
-        port=port,
-        user=user,
-        dbname=dbname,
-        file_format=file_format,
-        version=version,
-    )
+    different = sum(not x.matches for x in tables)
+    click.echo(f'{len(tables) - different} tables match, {different} differ')
+    if different:
+        raise SystemExit(1)
@@ -0,0 +1,135 @@
+"""Compare the data of two databases, e.g. a source and the database a backup was restored to
+
+Every table is summarized on its own server by its row count and an order independent sum of a
+hash of its rows, see `Postgres.get_table_checksum`, so only one row per table crosses the network.
+The tables are checksummed `jobs` at a time on each server, biggest first, on pooled connections.
+Tables whose columns differ aren't checksummed, their rows couldn't match.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import dataclasses
+
+import sqlalchemy as sa
+
+import worek.dialects.postgres as pgdialect
+from worek.exc import WorekOperationException
+
+
+@dataclasses.dataclass
+class TableComparison:
+    """The summaries of a table in both databases
+
+    `source` and `target` are the "count:sum" checksums of the table, None when it is missing from
+    that database or wasn't checksummed because its columns differ.
+    """
+
+    name: str
+    source: str | None = None
+    target: str | None = None
+    in_source: bool = True
+    in_target: bool = True
+    columns_match: bool = True
+
+    @property
+    def matches(self):
+        return (
+            self.in_source and self.in_target and self.columns_match and self.source == self.target
+        )
+
+    @property
+    def status(self):
+        """Describe how the table differs, "ok" when it doesn't"""
+        if not self.in_target:
+            return 'missing from the target'
+        if not self.in_source:
+            return 'missing from the source'
+        if not self.columns_match:
+            return 'columns differ'
+        if self.source.split(':')[0] != self.target.split(':')[0]:
+            return 'row counts differ'
+        if self.source != self.target:
+            return 'data differs'
+        return 'ok'
+
+    @property
+    def rows(self):
+        """The number of rows of the table in the source, None when it wasn't checksummed"""
+        return None if self.source is None else int(self.source.split(':')[0])
+
+
+def create_engine(url, jobs):
+    """Create an engine for a ``postgresql://`` URL with a connection for each of `jobs`"""
+    url = sa.engine.make_url(url)
+    if not url.drivername.startswith('postgresql'):
+        raise WorekOperationException(f'Only Postgres databases can be compared, got {url}.')
+    return sa.create_engine(url, pool_size=jobs, max_overflow=0)
+
+
+def compare(source, target, schemas=None, jobs=4):
+    """Compare the tables of two databases by their row counts and checksums
+
+    :param source: the database restored from, a SQLAlchemy engine or URL
+    :param target: the database restored to, a SQLAlchemy engine or URL
+    :param schemas: the schemas compared, by default the non-system schemas of the source
+    :param jobs: the number of tables checksummed at once on each database
+    :return: a list of `TableComparison`, sorted by table name
+    """
+    with contextlib.ExitStack() as stack:
+        if not isinstance(source, sa.engine.Engine):
+            source = create_engine(source, jobs)
+            stack.callback(source.dispose)
+        if not isinstance(target, sa.engine.Engine):
+            target = create_engine(target, jobs)
+            stack.callback(target.dispose)
+        return _compare(source, target, schemas, jobs)
+
+
+def _compare(source, target, schemas, jobs):
+    source_pg = pgdialect.Postgres(source, schemas=schemas)
+    target_pg = pgdialect.Postgres(target, schemas=list(source_pg.schemas))
+
+    source_tables = {x.name: x for x in source_pg.get_table_fingerprints()}
+    target_tables = {x.name: x for x in target_pg.get_table_fingerprints()}
+    comparisons = {
+        name: TableComparison(
+            name=name,
+            in_source=name in source_tables,
+            in_target=name in target_tables,
+            columns_match=(
+                name not in source_tables
+                or name not in target_tables
+                or source_tables[name].columns == target_tables[name].columns
+            ),
+        )
+        for name in source_tables.keys() | target_tables.keys()
+    }
+
+    # the biggest tables go first, so the longest checksums don't end up running alone at the end
+    sizes = source_pg.get_table_sizes()
+    compared = sorted(
+        (x for x in comparisons.values() if x.in_source and x.in_target and x.columns_match),
+        key=lambda x: (-sizes.get(x.name, 0), x.name),
+    )
+
+    def checksum(pg, fingerprints, name):
+        table = fingerprints[name]
+        return pg.get_table_checksum(table.schema, table.table)
+
+    with (
+        ThreadPoolExecutor(max_workers=jobs) as source_executor,
+        ThreadPoolExecutor(max_workers=jobs) as target_executor,
+    ):
+        pending = [
+            (
+                comparison,
+                source_executor.submit(checksum, source_pg, source_tables, comparison.name),
+                target_executor.submit(checksum, target_pg, target_tables, comparison.name),
+            )
+            for comparison in compared
+        ]
+        for comparison, source_result, target_result in pending:
+            comparison.source = source_result.result()
+            comparison.target = target_result.result()
+
+    return [comparisons[name] for name in sorted(comparisons)]
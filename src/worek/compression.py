@@ -0,0 +1,185 @@
+import gzip
+import importlib
+import io
+import zlib
+
+from worek.exc import WorekOperationException
+from worek.streams import BLOCK_SIZE, OrderedParallelWriter
+
+
+CODECS = ('gzip', 'zstd', 'lz4')
+
+# The magic bytes each compressed stream starts with
+MAGIC_BYTES = {
+    'gzip': b'\x1f\x8b',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'lz4': b'\x04\x22\x4d\x18',
+}
+MAGIC_SIZE = max(len(x) for x in MAGIC_BYTES.values())
+
+# The packages needed for codecs which aren't part of the standard library
+CODEC_PACKAGES = {
+    'zstd': 'zstandard',
+    'lz4': 'lz4.frame',
+}
+
+
+class WorekCompressionError(WorekOperationException):
+    pass
+
+
+def _import_codec(codec):
+    if codec not in CODECS:
+        raise WorekCompressionError(
+            f'Unknown compression {codec}, expecting one of {", ".join(CODECS)}.',
+        )
+
+    package = CODEC_PACKAGES.get(codec)
+    if package is None:
+        return None
+
+    try:
+        return importlib.import_module(package)
+    except ImportError as err:
+        raise WorekCompressionError(
+            f'{codec} compression requires the {package.split(".")[0]} package. Install it with'
+            f' `pip install worek[{codec}]`.',
+        ) from err
+
+
+def detect_compression(header):
+    """Return the codec of a stream starting with `header` or None if it isn't compressed"""
+    for codec, magic in MAGIC_BYTES.items():
+        if header.startswith(magic):
+            return codec
+    return None
+
+
+def compress_block(data, codec, level=None):
+    """Compress `data` into a single, self-contained frame of `codec`"""
+    if codec == 'gzip':
+        _import_codec(codec)
+        compressor = zlib.compressobj(
+            6 if level is None else level,
+            zlib.DEFLATED,
+            16 + zlib.MAX_WBITS,
+        )
+        return compressor.compress(data) + compressor.flush()
+
+    module = _import_codec(codec)
+    if codec == 'zstd':
+        return module.ZstdCompressor(level=3 if level is None else level).compress(data)
+    return module.compress(data, compression_level=level or 0)
+
+
+def decompress_block(data):
+    """Decompress a frame made by `compress_block`, detecting its codec"""
+    codec = detect_compression(data[:MAGIC_SIZE])
+    if codec is None:
+        raise WorekCompressionError('The data is not compressed with a known codec.')
+
+    if codec == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    module = _import_codec(codec)
+    if codec == 'zstd':
+        return module.ZstdDecompressor().decompress(data)
+    return module.decompress(data)
+
+
+class BlockCompressor(OrderedParallelWriter):
+    """Compress a stream on a thread pool by compressing each block as a separate frame
+
+    Both gzip and lz4 decoders treat concatenated frames as one stream, so the output can be
+    decompressed with the standard tools (e.g. `gunzip`, `lz4 -d`). zlib and lz4 release the GIL
+    while compressing so the blocks are compressed in parallel.
+    """
+
+    def __init__(self, sink, codec, level=None, threads=None, block_size=BLOCK_SIZE):
+        super().__init__(sink, threads=threads, block_size=block_size)
+        self.codec = codec
+        self.level = level
+        _import_codec(codec)
+
+    def transform(self, index, block, last):
+        return compress_block(block, self.codec, level=self.level)
+
+
+class ZstdCompressor:
+    """Compress a stream with zstd using the library's own worker threads
+
+    zstd splits the input into jobs which are compressed in parallel and written as a single frame
+    in order, so there is no need to frame the blocks ourselves.
+    """
+
+    def __init__(self, sink, level=None, threads=None):
+        zstandard = _import_codec('zstd')
+        compressor = zstandard.ZstdCompressor(
+            level=3 if level is None else level,
+            threads=threads or -1,
+        )
+        self.sink = sink
+        self.writer = compressor.stream_writer(sink, closefd=False)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.writer.close()
+        if hasattr(self.sink, 'flush'):
+            self.sink.flush()
+
+
+def open_compressor(sink, codec, level=None, threads=None):
+    """Return a writer which compresses everything written to it into `sink`
+
+    The writer must be closed to write the end of the compressed stream, `sink` is left open.
+
+    :param sink: a binary writable stream
+    :param codec: one of `CODECS`
+    :param level: the compression level, by default the codec's own default
+    :param threads: the number of threads used for compression, by default one per CPU
+    """
+    if codec == 'zstd':
+        return ZstdCompressor(sink, level=level, threads=threads)
+    return BlockCompressor(sink, codec, level=level, threads=threads)
+
+
+class DecompressingReader(io.RawIOBase):
+    """A binary reader which decompresses `stream` as it is read
+
+    This wraps the codec's own reader so that only reading is exposed. In particular it has no
+    `name` or `fileno`, which would point to the compressed source.
+    """
+
+    def __init__(self, stream, codec):
+        module = _import_codec(codec)
+        if codec == 'gzip':
+            self.reader = gzip.GzipFile(fileobj=stream, mode='rb')
+        elif codec == 'zstd':
+            self.reader = module.ZstdDecompressor().stream_reader(
+                stream,
+                read_across_frames=True,
+                closefd=False,
+            )
+        else:
+            self.reader = module.LZ4FrameFile(stream, mode='rb')
+        self.codec = codec
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.reader.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.reader.close()
+        super().close()
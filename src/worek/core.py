@@ -1,17 +1,89 @@
-import worek.dialects.postgres as pgdialect
-from worek.exc import WorekException
+from worek.crypto import load_key, parse_key
+from worek.exc import WorekOperationException  # noqa: F401
+from worek.session import Session
 
 
-class WorekOperationException(WorekException):
-    pass
+def _session(params):
+    """Create a single use `Session` from the connection parameters in `params`"""
+    return Session(**{k: v for k, v in params.items() if k not in ('schemas', 'version')})
 
 
-def backup(backup_file, backup_type='full', **params):
+def _key(key, key_file, key_env):
+    """Return the encryption key from whichever of the key parameters is given"""
+    if key is not None:
+        return parse_key(key)
+    return load_key(key_file=key_file, key_env=key_env)
+
+
+def backup(
+    backup_file,
+    backup_type='full',
+    file_format='c',
+    jobs=None,
+    compress=None,
+    compress_level=None,
+    compress_threads=None,
+    key=None,
+    key_file=None,
+    key_env=None,
+    parent=None,
+    checksums=False,
+    repo=None,
+    progress=None,
+    index=None,
+    manifest=None,
+    checksum_algorithm='blake2b',
+    **params,
+):
     """Create backup of the database to the backup file
 
     :param backup_file: The file to send the backup to, this can be any file-like object including a
-        a stream like. sys.stdin and sys.stdout should work no problem.
-    :param backup_type: The type of database backup requested. The only option is 'full'.
+        a stream like. sys.stdin and sys.stdout should work no problem. An ``s3://bucket/key`` URL
+        streams the backup to S3 compatible storage with a multipart upload, see `worek.s3`. A
+        list of files and URLs writes the same backup to all of them at once, see
+        `worek.streams.fan_out`.
+    :param backup_type: The type of database backup requested, 'full' (the default) or
+        'incremental'. An incremental backup only dumps the data of tables which changed since its
+        `parent` backup, without a parent it starts a new chain with the data of every table.
+    :param file_format: The format of the backup, "c" (custom, the default), "d" (directory) or
+        "n" (native). A directory backup is packed into a single tar stream. A native backup copies
+        the tables' data in the binary COPY format from a snapshot shared by `jobs` connections,
+        see `Postgres.backup_native`.
+    :param jobs: the number of tables to dump in parallel, only available for directory and native
+        backups. For incremental backups it is the number of tables checksummed in parallel.
+    :param compress: compress the backup in-process with "gzip", "zstd" or "lz4". The zstd and lz4
+        codecs need the `zstandard` and `lz4` packages. pg_dump then doesn't compress the data
+        itself.
+    :param compress_level: the compression level, by default the codec's default
+    :param compress_threads: the number of compression and encryption threads, by default one per
+        CPU
+    :param key: encrypt the backup with AES-256-GCM using this 32 byte key, given raw, hex or
+        base64 encoded. Encryption needs the `cryptography` package.
+    :param key_file: read the encryption key from this file instead
+    :param key_env: read the encryption key from this environment variable instead
+    :param parent: the previous backup of an incremental chain, as a path or a binary file-like
+        object. Only its manifest is read.
+    :param checksums: fingerprint the tables of an incremental backup with a checksum of their
+        rows as well as their statistics. This reads every table in full, with `jobs` tables at
+        a time, but catches any change the statistics miss. The statistics are flushed
+        asynchronously, so writes committed in the second or so before the backup may only be
+        seen by the next one, and a standby has none: backups of a standby are always checksummed.
+    :param repo: store the backup in the deduplicating repository at this path instead of
+        `backup_file`, which may be None. The repository is created if needed. Each unique chunk of
+        the backup is stored once, compressed with `compress` (default: gzip).
+    :param progress: a callable called with a `worek.progress.ProgressStatus` about once a second
+        while the backup runs and once more when it is done. It tells the bytes dumped so far
+        (before compression), the current rate, the elapsed time, an ETA estimated from the size of
+        the database and the table being dumped.
+    :param index: write an index of the backup's TOC to this path, S3 URL or binary file, see
+        `worek.toc`. Only for custom format backups without in-process compression or encryption,
+        whose byte offsets are those of the archive.
+    :param manifest: write a manifest of the backup to this path, S3 URL or binary file, see
+        `worek.manifest.manifest_path`. It has the checksums of the backup file, computed while it
+        is written, and the pg_dump and server versions, the schemas and the duration of the
+        backup. `worek verify` checks a backup against it.
+    :param checksum_algorithm: the digest of the manifest's checksums, "blake2b" (the default) or
+        "xxh3", which is faster but needs the `xxhash` package
 
     :param driver: the driver to use for connecting to the database
     :param host: the host of the database server
@@ -22,31 +94,95 @@ def backup(backup_file, backup_type='full', **params):
     :param saengine: an optional sqlalchemy engine, if this is passed, this will be used for the
         backup and other connection type parameters (e.g. driver, host, port) will be ignored
     :param version: version of PG client executables to use
-    """
-    PG = pgdialect.Postgres(
-        engine=params.get('saengine') or pgdialect.Postgres.construct_engine_from_params(**params),
-        schemas=params.get('schemas'),
-        version=params.get('version'),
-    )
+    :param dialect: the database dialect, by name, see `worek.dialects.DIALECTS` (default:
+        "postgres")
 
-    if not PG.engine_can_connect:
-        raise WorekOperationException("Can't connect to the database.")
-
-    if backup_type == 'full':
-        PG.backup_binary(backup_file)
-    else:
-        raise NotImplementedError('Only full backups are available at this time.')
+    .. note:: Use a `worek.Session` when running many backups or restores, it reuses the engine and
+        server metadata between calls.
+    """
+    with _session(params) as session:
+        return session.backup(
+            backup_file,
+            backup_type=backup_type,
+            file_format=file_format,
+            jobs=jobs,
+            compress=compress,
+            compress_level=compress_level,
+            compress_threads=compress_threads,
+            key=_key(key, key_file, key_env),
+            parent=parent,
+            checksums=checksums,
+            repo=repo,
+            progress=progress,
+            index=index,
+            manifest=manifest,
+            checksum_algorithm=checksum_algorithm,
+            schemas=params.get('schemas'),
+            version=params.get('version'),
+        )
 
 
-def restore(restore_file, file_format=None, clean_existing_database=True, **params):
+def restore(
+    restore_file,
+    file_format=None,
+    clean_existing_database=True,
+    jobs=None,
+    clean_jobs=None,
+    key=None,
+    key_file=None,
+    key_env=None,
+    parents=(),
+    repo=None,
+    backup_id=None,
+    progress=None,
+    index=None,
+    tables=(),
+    exclude_tables=(),
+    **params,
+):
     """Restore a backup file to the specified database
 
     :param restore_file: The file to pull the backup from, this can be any file-like object
-        including a a stream like. sys.stdin and sys.stdout should work no problem.
+        including a a stream like. sys.stdin and sys.stdout should work no problem. Backups
+        compressed with gzip, zstd or lz4 are detected and decompressed automatically, as are
+        encrypted backups when a key is given. An ``s3://bucket/key`` URL restores a backup from
+        S3 compatible storage while it is downloaded with parallel range requests, see
+        `worek.s3.ObjectReader`.
 
-    :param file_format: an optional file format. By default we try to be smart about this and detect
-        the type of file, but sometimes we can't and this allows hard setting it.
+    :param file_format: an optional file format, "c" (custom), "d" (directory tar stream), "t"
+        (text), "n" (native) or "i" (incremental). By default we try to be smart about this and
+        detect the type of file, but sometimes we can't and this allows hard setting it.
     :param clean_existing_database: clean an existing database before restore
+    :param jobs: the number of parallel jobs used to load data and build indexes. Not available for
+        text backups. Input which isn't a regular file is spooled to a temporary file first since
+        pg_restore needs a seekable file to run in parallel. Native backups load tables and build
+        indexes, biggest first, on `jobs` connections of their own instead, see
+        `Postgres.restore_native`.
+    :param clean_jobs: the number of schemas to clean concurrently, schemas which depend on each
+        other are still cleaned one after another
+    :param key: the key to decrypt an encrypted backup with, see `backup`
+    :param key_file: read the decryption key from this file instead
+    :param key_env: read the decryption key from this environment variable instead
+    :param parents: the older backups of an incremental chain, as paths or binary file-like
+        objects. Tables which didn't change in the restored backup are loaded from them.
+    :param repo: restore a backup from the deduplicating repository at this path instead of
+        `restore_file`, which may be None
+    :param backup_id: the id of the repository backup to restore, by default the latest one
+    :param progress: a callable called with a `worek.progress.ProgressStatus` about once a second
+        while the restore runs and once more when it is done. It tells the bytes of the backup read
+        so far, the current rate, the elapsed time, an ETA when `restore_file` is a regular file
+        and the TOC item being restored.
+    :param index: the TOC index of a custom format `restore_file`, an `ArchiveIndex` or the path of
+        one. The restore then only reads the header, the TOC and the data it restores from the
+        file, which must be seekable.
+    :param tables: only restore the tables (or views, sequences...) matching these patterns, with
+        the objects which go with them: their data, indexes, constraints, triggers, owned sequences
+        and so on. Patterns are shell style globs, e.g. "billing.invoice_*", matched against the
+        name alone when they have no schema. Only these objects are dropped first when
+        `clean_existing_database` is set, the rest of the database is left alone. Only for custom
+        and directory format backups.
+    :param exclude_tables: restore everything but the tables matching these patterns and what
+        depends on them
     :param driver: the driver to use for connecting to the database
     :param host: the host of the database server
     :param port: the port of the database server
@@ -56,28 +192,27 @@ def restore(restore_file, file_format=None, clean_existing_database=True, **para
     :param saengine: an optional sqlalchemy engine, if this is passed, this will be used for the
         backup and other connection type parameters (e.g. driver, host, port) will be ignored
     :param version: version of PG client executables to use
-    """
-    PG = pgdialect.Postgres(
-        engine=params.get('saengine') or pgdialect.Postgres.construct_engine_from_params(**params),
-        schemas=params.get('schemas'),
-        version=params.get('version'),
-    )
-
-    if not PG.engine_can_connect:
-        raise WorekOperationException("Can't connect to the database.")
+    :param dialect: the database dialect, by name, see `worek.dialects.DIALECTS` (default:
+        "postgres")
 
-    if clean_existing_database:
-        PG.clean_existing_database()
-
-    # perform the restore
-    if file_format == 'c':
-        return PG.restore_binary(restore_file)
-    elif file_format == 't':
-        return PG.restore_text(restore_file)
-    elif file_format is None:
-        return PG.restore(restore_file)
-    else:
-        raise NotImplementedError(
-            f'Got an unexpected file_format. {file_format} is not a valid type, expecting'
-            ' "c", "t", or nothing.',
+    .. note:: Use a `worek.Session` when running many backups or restores, it reuses the engine and
+        server metadata between calls.
+    """
+    with _session(params) as session:
+        return session.restore(
+            restore_file,
+            file_format=file_format,
+            clean_existing_database=clean_existing_database,
+            jobs=jobs,
+            clean_jobs=clean_jobs,
+            key=_key(key, key_file, key_env),
+            parents=parents,
+            repo=repo,
+            backup_id=backup_id,
+            progress=progress,
+            index=index,
+            tables=tables,
+            exclude_tables=exclude_tables,
+            schemas=params.get('schemas'),
+            version=params.get('version'),
         )
@@ -0,0 +1,229 @@
+"""Chunked authenticated encryption of backup streams
+
+An encrypted stream is a header followed by a sequence of frames:
+
+    header: MAGIC (8 bytes) | version (1) | chunk size (4) | salt (16) | nonce prefix (7)
+    frame:  last flag (high bit) + ciphertext length (4) | AES-256-GCM ciphertext and tag
+
+Each chunk is encrypted with a key derived from the user's key and the random salt, using a nonce
+made of the nonce prefix, the chunk's index and its last flag, with the header as associated data.
+So every chunk can be verified on its own, and reordered, dropped, truncated or corrupted chunks
+fail authentication as soon as they are read.
+"""
+
+import base64
+import binascii
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import io
+import os
+from pathlib import Path
+import struct
+
+from worek.exc import WorekOperationException
+from worek.streams import BLOCK_SIZE, OrderedParallelWriter
+
+
+MAGIC = b'WOREKENC'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('>8sBI16s7s')
+FRAME = struct.Struct('>I')
+LAST_FLAG = 0x80000000
+TAG_SIZE = 16
+KEY_SIZE = 32
+
+
+class WorekEncryptionError(WorekOperationException):
+    pass
+
+
+def _crypto():
+    try:
+        return (
+            importlib.import_module('cryptography.hazmat.primitives.ciphers.aead'),
+            importlib.import_module('cryptography.hazmat.primitives.hashes'),
+            importlib.import_module('cryptography.hazmat.primitives.kdf.hkdf'),
+        )
+    except ImportError as err:
+        raise WorekEncryptionError(
+            'Encryption requires the cryptography package. Install it with'
+            ' `pip install worek[encryption]`.',
+        ) from err
+
+
+def parse_key(value):
+    """Return the 32 byte key encoded in `value`
+
+    :param value: bytes or text with the key as 32 raw bytes, 64 hex digits or base64
+    """
+    if isinstance(value, str):
+        value = value.encode()
+
+    if len(value) == KEY_SIZE:
+        return value
+
+    text = value.strip()
+    for decode in (binascii.unhexlify, base64.b64decode):
+        try:
+            key = decode(text)
+        except (ValueError, binascii.Error):
+            continue
+        if len(key) == KEY_SIZE:
+            return key
+
+    raise WorekEncryptionError(
+        f'The encryption key must be {KEY_SIZE} bytes, either raw, hex or base64 encoded.',
+    )
+
+
+def load_key(key_file=None, key_env=None):
+    """Load the encryption key from a file or an environment variable
+
+    :param key_file: path to a file containing the key
+    :param key_env: name of an environment variable containing the key
+    :return: the key bytes or None if neither source is given
+    """
+    if key_file is not None:
+        return parse_key(Path(key_file).read_bytes())
+
+    if key_env is not None:
+        value = os.environ.get(key_env)
+        if not value:
+            raise WorekEncryptionError(f'The environment variable {key_env} is not set.')
+        return parse_key(value)
+
+    return None
+
+
+def is_encrypted(header):
+    return header.startswith(MAGIC)
+
+
+def _cipher(key, salt):
+    aead, hashes, hkdf = _crypto()
+    file_key = hkdf.HKDF(
+        algorithm=hashes.SHA256(),
+        length=KEY_SIZE,
+        salt=salt,
+        info=b'worek backup encryption',
+    ).derive(key)
+    return aead.AESGCM(file_key)
+
+
+def _nonce(prefix, index, last):
+    return prefix + struct.pack('>IB', index, 1 if last else 0)
+
+
+class Encryptor(OrderedParallelWriter):
+    """A writer which encrypts everything written to it into `sink`, chunks in parallel
+
+    The writer must be closed to write the final chunk, `sink` is left open.
+    """
+
+    def __init__(self, sink, key, threads=None, chunk_size=BLOCK_SIZE):
+        super().__init__(sink, threads=threads, block_size=chunk_size)
+        salt = os.urandom(16)
+        self.nonce_prefix = os.urandom(7)
+        self.header = HEADER.pack(MAGIC, FORMAT_VERSION, chunk_size, salt, self.nonce_prefix)
+        self.cipher = _cipher(key, salt)
+        sink.write(self.header)
+
+    def transform(self, index, block, last):
+        ciphertext = self.cipher.encrypt(_nonce(self.nonce_prefix, index, last), block, self.header)
+        return FRAME.pack(len(ciphertext) | (LAST_FLAG if last else 0)) + ciphertext
+
+
+class Decryptor(io.RawIOBase):
+    """A binary reader which decrypts and verifies `stream` as it is read
+
+    Frames are read ahead and decrypted on a thread pool, at most `2 * threads` at a time.
+
+    :raises WorekEncryptionError: when a chunk fails authentication or the stream is truncated
+    """
+
+    def __init__(self, stream, key, threads=None):
+        self.stream = stream
+        self.threads = threads or os.cpu_count() or 1
+
+        self.header = self._read_exactly(HEADER.size, 'header')
+        magic, version, self.chunk_size, salt, self.nonce_prefix = HEADER.unpack(self.header)
+        if magic != MAGIC:
+            raise WorekEncryptionError('The backup is not encrypted by worek.')
+        if version != FORMAT_VERSION:
+            raise WorekEncryptionError(f'Unsupported encryption format version {version}.')
+
+        self.cipher = _cipher(key, salt)
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._index = 0
+        self._seen_last = False
+        self._current = memoryview(b'')
+
+    def _read_exactly(self, size, what):
+        data = b''
+        while len(data) < size and (chunk := self.stream.read(size - len(data))):
+            data += chunk
+        if len(data) != size:
+            raise WorekEncryptionError(f'The encrypted backup is truncated, incomplete {what}.')
+        return data
+
+    def _decrypt(self, index, ciphertext, last):
+        try:
+            return self.cipher.decrypt(
+                _nonce(self.nonce_prefix, index, last),
+                ciphertext,
+                self.header,
+            )
+        except Exception as err:
+            raise WorekEncryptionError(
+                f'Chunk {index} of the encrypted backup is corrupt or was tampered with.',
+            ) from err
+
+    def _fill(self):
+        """Read and submit frames until enough are in flight or the stream is exhausted"""
+        while not self._seen_last and len(self._pending) < 2 * self.threads:
+            frame = self.stream.read(FRAME.size)
+            if not frame:
+                raise WorekEncryptionError(
+                    'The encrypted backup is truncated, final chunk missing.',
+                )
+            if len(frame) < FRAME.size:
+                frame += self._read_exactly(FRAME.size - len(frame), 'frame')
+
+            (value,) = FRAME.unpack(frame)
+            last = bool(value & LAST_FLAG)
+            size = value & ~LAST_FLAG
+            if size > self.chunk_size + TAG_SIZE:
+                raise WorekEncryptionError(
+                    f'Chunk {self._index} of the encrypted backup is corrupt.',
+                )
+
+            ciphertext = self._read_exactly(size, 'chunk')
+            self._pending.append(
+                self._executor.submit(self._decrypt, self._index, ciphertext, last),
+            )
+            self._index += 1
+            self._seen_last = last
+
+        if self._seen_last and not self._pending and self.stream.read(1):
+            raise WorekEncryptionError('Unexpected data after the end of the encrypted backup.')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._current:
+            self._fill()
+            if not self._pending:
+                return 0
+            self._current = memoryview(self._pending.popleft().result())
+
+        size = min(len(buffer), len(self._current))
+        buffer[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+        super().close()
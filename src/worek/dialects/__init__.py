@@ -0,0 +1,31 @@
+"""The database dialects worek can back up and restore, by the name given to ``--engine``
+
+A dialect's module is only imported when it is first used, so commands which don't touch a database
+(e.g. ``worek --help``) don't pay for importing SQLAlchemy and the database driver.
+"""
+
+import importlib
+
+from worek.exc import WorekOperationException
+
+
+# the dialect classes by name, as "module:class" so they are imported on demand
+DIALECTS = {
+    'postgres': 'worek.dialects.postgres:Postgres',
+}
+
+
+def register_dialect(name, target):
+    """Make the dialect class at `target`, given as "module:class", available as `name`"""
+    DIALECTS[name] = target
+
+
+def get_dialect(name):
+    """Import and return the dialect class registered as `name`"""
+    try:
+        module, _, attr = DIALECTS[name].partition(':')
+    except KeyError:
+        raise WorekOperationException(
+            f'Unknown database engine {name}, expecting one of {", ".join(sorted(DIALECTS))}.',
+        ) from None
+    return getattr(importlib.import_module(module), attr)
@@ -1,17 +1,40 @@
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
+import dataclasses
 import enum
 import getpass
+import io
+import json
 import logging
 import os
 from pathlib import Path
+import queue
 import re
 import shutil
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
 
 import psycopg2
 import sqlalchemy as sa
 from sqlalchemy import text
 
-from worek.exc import WorekException
+from worek import toc
+from worek.exc import WorekException, WorekOperationException
+from worek.progress import StderrMonitor
+from worek.streams import run, sniff
+from worek.utils import (
+    SPOOL_BUFFER_SIZE,
+    add_tar_member,
+    binary_stream,
+    first_tar_member,
+    pack_directory,
+    spooled_path,
+    unpack_directory,
+)
 
 
 log = logging.getLogger(__name__)
@@ -30,6 +53,424 @@ class PostgresInputError(WorekPostgresError):
     pass
 
 
+# The members of a native archive, see `Postgres.backup_native`
+NATIVE_TOC_NAME = 'toc.json'
+NATIVE_SCHEMA_NAME = 'schema.dump'
+NATIVE_BLOBS_NAME = 'blobs.dump'
+
+# The maximum number of objects dropped by a single DROP statement when cleaning a database
+DROP_BATCH_SIZE = 500
+
+# The order objects are dropped in when cleaning a database. Functions go first, as they may
+# reference any of the other objects, and types go last since everything else may use them.
+DROP_ORDER = (
+    'FUNCTION',
+    'PROCEDURE',
+    'AGGREGATE',
+    'MATERIALIZED VIEW',
+    'VIEW',
+    'TABLE',
+    'FOREIGN TABLE',
+    'SEQUENCE',
+    'DOMAIN',
+    'TYPE',
+)
+
+DROPPABLE_OBJECTS_SQL = """
+    SELECT
+        NS.nspname,
+        OBJ.kind,
+        OBJ.identity
+    FROM (
+        SELECT
+            'pg_proc'::regclass AS classid,
+            PR.oid AS objid,
+            PR.pronamespace AS nsoid,
+            CASE PR.prokind
+                WHEN 'p' THEN 'PROCEDURE'
+                WHEN 'a' THEN 'AGGREGATE'
+                ELSE 'FUNCTION'
+            END AS kind,
+            format(
+                '%I.%I(%s)',
+                PRNS.nspname,
+                PR.proname,
+                pg_get_function_identity_arguments(PR.oid)
+            ) AS identity
+        FROM
+            pg_proc PR
+            JOIN pg_namespace PRNS ON PRNS.oid = PR.pronamespace
+        UNION ALL
+        SELECT
+            'pg_class'::regclass,
+            C.oid,
+            C.relnamespace,
+            CASE C.relkind
+                WHEN 'S' THEN 'SEQUENCE'
+                WHEN 'v' THEN 'VIEW'
+                WHEN 'm' THEN 'MATERIALIZED VIEW'
+                WHEN 'f' THEN 'FOREIGN TABLE'
+                ELSE 'TABLE'
+            END,
+            format('%I.%I', CNS.nspname, C.relname)
+        FROM
+            pg_class C
+            JOIN pg_namespace CNS ON CNS.oid = C.relnamespace
+        WHERE C.relkind IN ('r', 'p', 'v', 'm', 'f', 'S')
+        UNION ALL
+        SELECT
+            'pg_type'::regclass,
+            T.oid,
+            T.typnamespace,
+            CASE T.typtype WHEN 'd' THEN 'DOMAIN' ELSE 'TYPE' END,
+            format('%I.%I', TNS.nspname, T.typname)
+        FROM
+            pg_type T
+            JOIN pg_namespace TNS ON TNS.oid = T.typnamespace
+            LEFT JOIN pg_class TC ON TC.oid = T.typrelid
+        WHERE
+            (T.typrelid = 0 OR TC.relkind = 'c')
+            AND NOT EXISTS (
+                SELECT 1
+                FROM pg_type EL
+                WHERE EL.oid = T.typelem AND EL.typarray = T.oid
+            )
+    ) OBJ
+    JOIN pg_namespace NS ON NS.oid = OBJ.nsoid
+    WHERE
+        NS.nspname = ANY(:schemas)
+        AND NOT EXISTS (
+            SELECT 1
+            FROM pg_depend D
+            WHERE
+                D.classid = OBJ.classid
+                AND D.objid = OBJ.objid
+                AND D.deptype IN ('e', 'i')
+        )
+    ORDER BY NS.nspname, OBJ.kind, OBJ.identity
+"""
+
+SCHEMA_DETAILS_SQL = """
+    SELECT
+        NS.nspname AS name,
+        obj_description(NS.oid, 'pg_namespace') AS comment,
+        ARRAY(
+            SELECT format(
+                'GRANT %s ON SCHEMA %I TO %s%s',
+                ACL.privilege_type,
+                NS.nspname,
+                CASE WHEN ACL.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(R.rolname) END,
+                CASE WHEN ACL.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END
+            )
+            FROM
+                aclexplode(NS.nspacl) ACL
+                LEFT JOIN pg_roles R ON R.oid = ACL.grantee
+            WHERE ACL.grantee <> NS.nspowner
+        ) AS grants,
+        (
+            pg_get_userbyid(NS.nspowner) = current_user
+            AND NOT EXISTS (SELECT 1 FROM pg_extension E WHERE E.extnamespace = NS.oid)
+            AND NOT EXISTS (
+                SELECT 1 FROM pg_default_acl DA WHERE DA.defaclnamespace = NS.oid
+            )
+            AND NOT EXISTS (
+                SELECT 1
+                FROM
+                    pg_depend D
+                    JOIN pg_class C ON D.classid = 'pg_class'::regclass AND C.oid = D.objid
+                WHERE D.deptype = 'e' AND C.relnamespace = NS.oid
+            )
+            AND NOT EXISTS (
+                SELECT 1
+                FROM
+                    pg_depend D
+                    JOIN pg_proc PR ON D.classid = 'pg_proc'::regclass AND PR.oid = D.objid
+                WHERE D.deptype = 'e' AND PR.pronamespace = NS.oid
+            )
+            AND NOT EXISTS (
+                SELECT 1
+                FROM
+                    pg_depend D
+                    JOIN pg_type T ON D.classid = 'pg_type'::regclass AND T.oid = D.objid
+                WHERE D.deptype = 'e' AND T.typnamespace = NS.oid
+            )
+        ) AS droppable
+    FROM pg_namespace NS
+    WHERE NS.nspname = ANY(:schemas)
+"""
+
+
+SCHEMA_DEPENDENCIES_SQL = """
+    SELECT DISTINCT
+        NS.nspname,
+        REFNS.nspname
+    FROM
+        pg_depend D
+        LEFT JOIN pg_class C ON D.classid = 'pg_class'::regclass AND C.oid = D.objid
+        LEFT JOIN pg_proc PR ON D.classid = 'pg_proc'::regclass AND PR.oid = D.objid
+        LEFT JOIN pg_type T ON D.classid = 'pg_type'::regclass AND T.oid = D.objid
+        LEFT JOIN pg_constraint CO ON D.classid = 'pg_constraint'::regclass AND CO.oid = D.objid
+        LEFT JOIN pg_rewrite RW ON D.classid = 'pg_rewrite'::regclass AND RW.oid = D.objid
+        LEFT JOIN pg_attrdef AD ON D.classid = 'pg_attrdef'::regclass AND AD.oid = D.objid
+        LEFT JOIN pg_trigger TG ON D.classid = 'pg_trigger'::regclass AND TG.oid = D.objid
+        LEFT JOIN pg_class OWNER ON OWNER.oid = COALESCE(RW.ev_class, AD.adrelid, TG.tgrelid)
+        LEFT JOIN pg_class REFC ON D.refclassid = 'pg_class'::regclass AND REFC.oid = D.refobjid
+        LEFT JOIN pg_proc REFPR ON D.refclassid = 'pg_proc'::regclass AND REFPR.oid = D.refobjid
+        LEFT JOIN pg_type REFT ON D.refclassid = 'pg_type'::regclass AND REFT.oid = D.refobjid
+        JOIN pg_namespace NS ON NS.oid = COALESCE(
+            C.relnamespace,
+            PR.pronamespace,
+            T.typnamespace,
+            CO.connamespace,
+            OWNER.relnamespace
+        )
+        JOIN pg_namespace REFNS ON REFNS.oid = COALESCE(
+            REFC.relnamespace,
+            REFPR.pronamespace,
+            REFT.typnamespace
+        )
+    WHERE
+        D.deptype IN ('n', 'a')
+        AND NS.oid <> REFNS.oid
+"""
+
+
+SERVER_INFO_SQL = """
+    SELECT
+        current_setting('server_version') AS version,
+        ARRAY(
+            SELECT schema_name::text
+            FROM information_schema.schemata
+            WHERE
+                "schema_name" NOT LIKE 'pg_%'
+                AND "schema_name" != 'information_schema'
+        ) AS schemas
+"""
+
+
+# Cheap change fingerprints for every table with data, the tuple counters only ever grow, the
+# relfilenode changes when a table is rewritten (e.g. TRUNCATE, VACUUM FULL) and the columns hash
+# when the table's definition changes
+TABLE_FINGERPRINTS_SQL = """
+    SELECT
+        NS.nspname AS "schema",
+        C.relname AS "table",
+        C.relfilenode AS relfilenode,
+        coalesce(S.n_tup_ins, 0) AS inserted,
+        coalesce(S.n_tup_upd, 0) AS updated,
+        coalesce(S.n_tup_del, 0) AS deleted,
+        (
+            SELECT md5(string_agg(
+                A.attname || ' ' || format_type(A.atttypid, A.atttypmod),
+                ', ' ORDER BY A.attnum
+            ))
+            FROM pg_attribute A
+            WHERE A.attrelid = C.oid AND A.attnum > 0 AND NOT A.attisdropped
+        ) AS columns
+    FROM pg_class C
+        JOIN pg_namespace NS ON NS.oid = C.relnamespace
+        LEFT JOIN pg_stat_user_tables S ON S.relid = C.oid
+    WHERE
+        C.relkind = 'r'
+        AND NS.nspname = ANY(:schemas)
+    ORDER BY NS.nspname, C.relname
+"""
+
+
+STATS_RESET_SQL = """
+    SELECT stats_reset::text
+    FROM pg_stat_database
+    WHERE datname = current_database()
+"""
+
+
+# Whether the database has large objects, which the native engine leaves to pg_dump
+HAS_LARGE_OBJECTS_SQL = 'SELECT EXISTS (SELECT FROM pg_largeobject_metadata)'
+
+# The tables exported by the native engine, biggest first. Generated columns can't be copied into
+# and tables belonging to an extension are left to the extension's own script.
+NATIVE_TABLES_SQL = """
+    SELECT
+        NS.nspname AS "schema",
+        C.relname AS "table",
+        ARRAY(
+            SELECT A.attname::text
+            FROM pg_attribute A
+            WHERE
+                A.attrelid = C.oid
+                AND A.attnum > 0
+                AND NOT A.attisdropped
+                AND A.attgenerated = ''
+            ORDER BY A.attnum
+        ) AS columns,
+        pg_relation_size(C.oid) AS size
+    FROM pg_class C
+        JOIN pg_namespace NS ON NS.oid = C.relnamespace
+    WHERE
+        C.relkind = 'r'
+        AND NS.nspname = ANY(:schemas)
+        AND NOT EXISTS (
+            SELECT 1
+            FROM pg_depend D
+            WHERE D.classid = 'pg_class'::regclass AND D.objid = C.oid AND D.deptype = 'e'
+        )
+    ORDER BY size DESC, NS.nspname, C.relname
+"""
+
+
+NATIVE_INDEXES_SQL = """
+    SELECT NS.nspname AS "schema", IC.relname AS "name", TC.relname AS "table"
+    FROM pg_index I
+        JOIN pg_class IC ON IC.oid = I.indexrelid
+        JOIN pg_class TC ON TC.oid = I.indrelid
+        JOIN pg_namespace NS ON NS.oid = IC.relnamespace
+    WHERE NS.nspname = ANY(:schemas)
+    ORDER BY NS.nspname, IC.relname
+"""
+
+
+NATIVE_CONSTRAINTS_SQL = """
+    SELECT
+        NS.nspname AS "schema",
+        TC.relname AS "table",
+        CO.conname AS "name",
+        RNS.nspname AS referenced_schema,
+        RC.relname AS referenced_table
+    FROM pg_constraint CO
+        JOIN pg_class TC ON TC.oid = CO.conrelid
+        JOIN pg_namespace NS ON NS.oid = TC.relnamespace
+        LEFT JOIN pg_class RC ON RC.oid = CO.confrelid
+        LEFT JOIN pg_namespace RNS ON RNS.oid = RC.relnamespace
+    WHERE NS.nspname = ANY(:schemas)
+    ORDER BY NS.nspname, TC.relname, CO.conname
+"""
+
+
+SET_SEQUENCE_SQL = """
+    SELECT setval(format('%I.%I', :schema, :name)::regclass, :value, :is_called)
+"""
+
+
+NATIVE_SEQUENCES_SQL = """
+    SELECT
+        schemaname AS "schema",
+        sequencename AS "name",
+        coalesce(last_value, start_value) AS "value",
+        last_value IS NOT NULL AS is_called
+    FROM pg_sequences
+    WHERE schemaname = ANY(:schemas)
+    ORDER BY schemaname, sequencename
+"""
+
+
+# The foreign keys referencing some tables, by the qualified names of both sides
+INBOUND_FOREIGN_KEYS_SQL = """
+    SELECT
+        C.conname AS "name",
+        FN.nspname || '.' || F.relname AS "table",
+        RN.nspname || '.' || R.relname AS referenced
+    FROM pg_constraint C
+        JOIN pg_class F ON F.oid = C.conrelid
+        JOIN pg_namespace FN ON FN.oid = F.relnamespace
+        JOIN pg_class R ON R.oid = C.confrelid
+        JOIN pg_namespace RN ON RN.oid = R.relnamespace
+    WHERE
+        C.contype = 'f'
+        AND RN.nspname || '.' || R.relname = ANY(:tables)
+    ORDER BY 2, 1
+"""
+
+
+# The size on disk of every table, to compare the biggest tables first
+TABLE_SIZES_SQL = """
+    SELECT NS.nspname || '.' || C.relname AS "name", pg_relation_size(C.oid) AS size
+    FROM pg_class C
+        JOIN pg_namespace NS ON NS.oid = C.relnamespace
+    WHERE
+        C.relkind = 'r'
+        AND NS.nspname = ANY(:schemas)
+"""
+
+
+# An order independent checksum of a table's rows, the sum of a 64 bit hash of every row
+TABLE_CHECKSUM_SQL = """
+    SELECT
+        count(*) AS "rows",
+        coalesce(sum(('x' || left(md5(T::text), 16))::bit(64)::bigint), 0) AS checksum
+    FROM {table} AS T
+"""
+
+# The text of a row depends on these settings, pinned so servers and sessions configured
+# differently still compute the same checksum for the same data
+TABLE_CHECKSUM_SETTINGS = (
+    "SET LOCAL TimeZone = 'UTC'",
+    "SET LOCAL DateStyle = 'ISO, MDY'",
+    "SET LOCAL IntervalStyle = 'postgres'",
+    'SET LOCAL extra_float_digits = 1',
+    "SET LOCAL bytea_output = 'hex'",
+)
+
+
+@dataclasses.dataclass
+class ServerInfo:
+    version: str
+    schemas: list
+
+
+@dataclasses.dataclass
+class DroppableObject:
+    schema: str
+    kind: str
+    identity: str
+
+
+@dataclasses.dataclass
+class TableFingerprint:
+    schema: str
+    table: str
+    relfilenode: int
+    inserted: int
+    updated: int
+    deleted: int
+    columns: str
+    checksum: str | None = None
+
+    @property
+    def name(self):
+        return f'{self.schema}.{self.table}'
+
+
+@dataclasses.dataclass
+class NativeTable:
+    schema: str
+    table: str
+    columns: list
+    size: int
+
+    @property
+    def qualified_name(self):
+        return f'{quote_ident(self.schema)}.{quote_ident(self.table)}'
+
+    @property
+    def column_list(self):
+        return ', '.join(quote_ident(x) for x in self.columns)
+
+
+@dataclasses.dataclass
+class NativeSequence:
+    schema: str
+    name: str
+    value: int
+    is_called: bool
+
+
+@dataclasses.dataclass
+class CleanResult:
+    schemas: list
+    objects_dropped: int
+    duration: float
+
+
 class PostgresCommand(enum.Enum):
     BACKUP = 'pg_dump'
     RESTORE_BINARY = 'pg_restore'
@@ -43,15 +484,28 @@ class Postgres:
     manage backups and restores of their own data.
     """
 
-    def __init__(self, engine, schemas=None, executor=None, version=None):
+    def __init__(
+        self,
+        engine,
+        schemas=None,
+        executor=None,
+        version=None,
+        server_version=None,
+        progress=None,
+    ):
         """Postgres Database Management Tool
 
         :param engine: a SQLAlchemy Engine which connects to the relevant database
         :param schemas: schemas you want to restore or backup
         :param executor: the method for executing the PG commands against the database. By default
-            this uses `subprocess.run` but you can use the `tests.helpers.MockCLIExecutor` or any
-            callable that accepts a list of CLI arguments and `**kwargs`.
+            this uses `worek.streams.run` but you can use the `tests.helpers.MockCLIExecutor` or any
+            callable that accepts a list of CLI arguments and the keyword arguments of
+            `worek.streams.run`.
         :param version: the version of PG client executables to use
+        :param server_version: the server's `server_version` setting, if already known. By default
+            it is looked up the first time it is needed.
+        :param progress: a `worek.progress.Progress` which is told the item pg_dump and pg_restore
+            are working on
 
         .. note:: `schemas` is ignored when working with a RESTORE_TEXT operation because postgres
             can not selectively restore a plain text backup. Use a binary backup if you want to
@@ -61,8 +515,10 @@ class Postgres:
         self._schemas = schemas
 
         self.errors = []
-        self.executor = subprocess.run if executor is None else executor
+        self.executor = run if executor is None else executor
         self.version = version
+        self.server_version = server_version
+        self.progress = progress
 
     @property
     def schemas(self):
@@ -72,15 +528,22 @@ class Postgres:
         return self._schemas
 
     def _default_version(self):
-        sql = sa.select(sa.func.current_setting('server_version'))
+        if self.server_version is None:
+            sql = sa.select(sa.func.current_setting('server_version'))
+            with self.engine.connect() as conn:
+                self.server_version = conn.execute(sql).scalar()
+
+        return client_version(self.server_version)
+
+    def get_server_info(self):
+        """Return the server version and the non-system schemas with a single query
+
+        :return: a `ServerInfo`
+        """
         with self.engine.connect() as conn:
-            result = conn.execute(sql).fetchone()
+            row = conn.execute(text(SERVER_INFO_SQL)).one()
 
-        match = re.match(r'(\d+\.\d+)', result[0])
-        version = match.group(1)
-        if version.startswith('9'):
-            return version
-        return version.split('.')[0]
+        return ServerInfo(version=row.version, schemas=list(row.schemas))
 
     @property
     def engine_can_connect(self):
@@ -88,7 +551,7 @@ class Postgres:
             with self.engine.connect() as conn:
                 conn.execute(text('SELECT 1'))
             return True
-        except psycopg2.Error:
+        except (psycopg2.Error, sa.exc.DBAPIError):
             return False
 
     @classmethod
@@ -139,6 +602,35 @@ class Postgres:
             raise OSError('pg_wrapper is required if a version is specified')
         return f'{self.version or self._default_version()}/localhost:'
 
+    def cli_command(self, command, additional_args=(), all_schemas=False):
+        """Return the arguments and environment to run a postgres command with
+
+        :param command: the postgres command, an instance of `PostgresCommand`
+        :param additional_args: a list of arguments which should be passed to the CLI command
+        :param all_schemas: don't limit the command to `self.schemas`, e.g. to restore large
+            objects, which don't belong to a schema and are skipped by `pg_restore --schema`
+        :return: a tuple of the list of CLI arguments and the environment variables
+        """
+        if not isinstance(command, PostgresCommand):
+            raise NotImplementedError(
+                'Unknown postgresql command. Are you using the PostgresCommand enum.',
+            )
+
+        env = os.environ.copy()
+        url = self.engine.url
+
+        cli_args = [command.value, *self.cli_flags_for_url(url)]
+
+        if command != PostgresCommand.RESTORE_TEXT and not all_schemas:
+            cli_args += [f'--schema={x}' for x in self.schemas]
+
+        env['PGCLUSTER'] = self._pg_wrapper_cluster(command.value)
+        if url.password:
+            env['PGPASSWORD'] = url.password
+
+        cli_args.extend(additional_args)
+        return cli_args, env
+
     def _execute_cli_command(
         self,
         command,
@@ -146,6 +638,7 @@ class Postgres:
         stdin=None,
         stdout=None,
         stderr=None,
+        all_schemas=False,
     ):
         """
         Execute a CLI Command putting STDOUT into output.
@@ -164,65 +657,48 @@ class Postgres:
         :param stdout: a stream or pipe to use for standard output, useful when you want to pipe a
             backup command to some other tool like gzip or openssl.
         :param stderr: a stream or pipe to use for standard error, by default this is just a
-            subprocess pipe.
+            subprocess pipe, or a `StderrMonitor` when reporting progress.
+        :param all_schemas: don't limit the command to `self.schemas`, see `cli_command`
+
+        .. note:: `stdin` and `stdout` may also be Python objects without a file descriptor (e.g.
+            a compressor or `BytesIO`), their data is then pumped through a pipe on a thread by the
+            default executor, `worek.streams.run`. Only the tail of stderr is kept in memory.
         """
+        additional_args = list(additional_args or [])
+
+        # with progress reporting, pg_dump and pg_restore announce each item they work on in their
+        # verbose output, which is read as it is written
+        monitor = None
+        if (
+            self.progress is not None
+            and stderr is None
+            and command != PostgresCommand.RESTORE_TEXT
+            and '--list' not in additional_args
+        ):
+            monitor = stderr = StderrMonitor(self.progress)
+            additional_args.append('--verbose')
+
         stdin = stdin or subprocess.PIPE
         stdout = stdout or subprocess.PIPE
         stderr = stderr or subprocess.PIPE
 
-        if not isinstance(command, PostgresCommand):
-            raise NotImplementedError(
-                'Unknown postgresql command. Are you using the PostgresCommand enum.',
-            )
-
-        env = os.environ.copy()
-        url = self.engine.url
-
-        cli_args = [command.value, *self.cli_flags_for_url(url)]
-
-        if command != PostgresCommand.RESTORE_TEXT:
-            cli_args += [f'--schema={x}' for x in self.schemas]
-
-        env['PGCLUSTER'] = self._pg_wrapper_cluster(command.value)
-        if url.password:
-            env['PGPASSWORD'] = url.password
-
-        cli_args.extend(additional_args or [])
-
+        cli_args, env = self.cli_command(command, additional_args, all_schemas=all_schemas)
         result = self.executor(cli_args, env=env, stdin=stdin, stdout=stdout, stderr=stderr)
 
+        if monitor is not None:
+            result.stderr = monitor.tail()
+
         if result.returncode != 0:
             raise PostgresCLIError(result)
 
         return result
 
+    def _set_progress_item(self, item):
+        if self.progress is not None:
+            self.progress.set_item(item)
+
     def drop_schema(self, schema):
-        with self.engine.connect() as conn:
-            for funcname, funcargs in self.get_function_list_from_db(schema):
-                try:
-                    sql = f'DROP FUNCTION "{schema}"."{funcname}" ({funcargs}) CASCADE'
-                    conn.execute(text(sql))
-                except Exception:
-                    raise
-
-            for table in self.get_table_list_from_db(schema):
-                try:
-                    conn.execute(text(f'DROP TABLE "{schema}"."{table}" CASCADE'))
-                except Exception:
-                    raise
-
-            for seq in self.get_seq_list_from_db(schema):
-                try:
-                    conn.execute(text(f'DROP SEQUENCE "{schema}"."{seq}" CASCADE'))
-                except Exception:
-                    raise
-
-            for dbtype in self.get_type_list_from_db(schema):
-                try:
-                    conn.execute(text(f'DROP TYPE "{schema}"."{dbtype}" CASCADE'))
-                except Exception:
-                    raise
-            conn.commit()
+        return self.clean_existing_database([schema])
 
     def get_function_list_from_db(self, schema):
         """Returns a list of functions not associated with an extension
@@ -322,47 +798,609 @@ class Postgres:
         with self.engine.connect() as conn:
             return [name for (name,) in conn.execute(text(sql))]
 
-    def clean_existing_database(self, schemas=None):
-        schemas = schemas if schemas is not None else self.schemas
+    def get_droppable_objects(self, schemas, conn=None):
+        """Return every object `clean_existing_database` drops from the passed schemas
+
+        All functions, tables, views, sequences and types are read in a single catalog query.
+        Objects installed by an extension, and objects which are only an internal part of another
+        object (e.g. identity sequences, multirange types), are left out since they are dropped
+        along with their owner.
+
+        :return: a list of `DroppableObject`
+        """
+        if conn is None:
+            with self.engine.connect() as conn:
+                return self.get_droppable_objects(schemas, conn)
+
+        result = conn.execute(text(DROPPABLE_OBJECTS_SQL), {'schemas': list(schemas)})
+        return [DroppableObject(*row) for row in result]
+
+    def get_schema_details(self, schemas, conn):
+        """Return the details needed to drop and recreate the passed schemas, keyed by name"""
+        result = conn.execute(text(SCHEMA_DETAILS_SQL), {'schemas': list(schemas)})
+        return {row.name: row for row in result}
+
+    def _drop_and_recreate_schema(self, conn, details):
+        """Drop a schema and everything in it with a single statement, then recreate it
+
+        :return: True when the schema was dropped, False when the drop failed (e.g. an object in the
+            schema is owned by another role) and the schema has to be cleaned object by object.
+        """
+        name = quote_ident(details.name)
+
+        try:
+            with conn.begin_nested():
+                conn.execute(text(f'DROP SCHEMA {name} CASCADE'))
+                conn.execute(text(f'CREATE SCHEMA {name}'))
+                for grant in details.grants:
+                    conn.execute(text(grant))
+                if details.comment is not None:
+                    conn.execute(
+                        text(f'COMMENT ON SCHEMA {name} IS :comment'),
+                        {'comment': details.comment},
+                    )
+        except sa.exc.DBAPIError as err:
+            log.debug('Could not drop schema %s, dropping objects instead: %s', name, err)
+            return False
+
+        return True
+
+    def _drop_objects(self, conn, objects):
+        """Drop `objects` in multi-object DROP statements of up to `DROP_BATCH_SIZE` objects
+
+        Each statement is committed separately so a large schema doesn't exhaust the server's lock
+        table. `IF EXISTS` is used because an earlier `CASCADE` may already have dropped an object.
+        """
+        by_kind = {}
+        for obj in objects:
+            by_kind.setdefault(obj.kind, []).append(obj.identity)
+
+        for kind in DROP_ORDER:
+            identities = by_kind.get(kind, [])
+            for start in range(0, len(identities), DROP_BATCH_SIZE):
+                batch = ', '.join(identities[start : start + DROP_BATCH_SIZE])
+                conn.execute(text(f'DROP {kind} IF EXISTS {batch} CASCADE'))
+                conn.commit()
 
+    def get_schema_dependencies(self, conn=None):
+        """Return the pairs of schemas where an object in one depends on an object in the other
+
+        :return: a set of `(dependent schema, referenced schema)` tuples
+        """
+        if conn is None:
+            with self.engine.connect() as conn:
+                return self.get_schema_dependencies(conn)
+
+        return {(row[0], row[1]) for row in conn.execute(text(SCHEMA_DEPENDENCIES_SQL))}
+
+    def schema_clean_groups(self, schemas, dependencies):
+        """Split `schemas` into groups which can be cleaned independently of each other
+
+        Two schemas end up in the same group when an object in one depends on an object in the
+        other, or when an object in a third schema depends on objects in both (dropping either
+        would cascade into that object). Within a group, schemas are ordered so that dependent
+        schemas are cleaned before the schemas they reference.
+
+        :param schemas: the schemas being cleaned
+        :param dependencies: the result of `get_schema_dependencies`
+        :return: a list of lists of schema names, largest group first
+        """
+        schemas = list(schemas)
+        parents = {schema: schema for schema in schemas}
+
+        def find(schema):
+            while parents[schema] != schema:
+                parents[schema] = parents[parents[schema]]
+                schema = parents[schema]
+            return schema
+
+        referenced = {}
+        for dependent, reference in dependencies:
+            if reference in parents:
+                referenced.setdefault(dependent, set()).add(reference)
+
+        for dependent, references in referenced.items():
+            linked = references | ({dependent} if dependent in parents else set())
+            first, *others = sorted(linked)
+            for other in others:
+                parents[find(other)] = find(first)
+
+        groups = {}
         for schema in schemas:
-            self.drop_schema(schema)
+            groups.setdefault(find(schema), []).append(schema)
+
+        edges = {(a, b) for a, b in dependencies if a in parents and b in parents}
+        ordered = [dependents_first(group, edges) for group in groups.values()]
+        return sorted(ordered, key=len, reverse=True)
+
+    def _clean_schemas(self, schemas, conn=None):
+        """Clean the passed schemas, in order, on a single connection
+
+        :return: the number of objects dropped
+        """
+        if conn is None:
+            with self.engine.connect() as conn:
+                return self._clean_schemas(schemas, conn)
+
+        objects = self.get_droppable_objects(schemas, conn)
+        details = self.get_schema_details(schemas, conn)
+
+        remaining = objects
+        for name in schemas:
+            schema = details.get(name)
+            if schema is None or not schema.droppable:
+                continue
+
+            if self._drop_and_recreate_schema(conn, schema):
+                conn.commit()
+                remaining = [x for x in remaining if x.schema != schema.name]
+            else:
+                conn.rollback()
+
+        self._drop_objects(conn, remaining)
+        conn.commit()
+
+        return len(objects)
+
+    def clean_existing_database(self, schemas=None, parallel=None):
+        """Drop the functions, tables, sequences and types in the passed schemas
+
+        Schemas which can be dropped as a whole (the current user owns the schema, it has no default
+        privileges and contains no extensions) are dropped with `DROP SCHEMA ... CASCADE` and
+        recreated with the same privileges and comment. Objects in the other schemas are dropped
+        in batched multi-object statements. Objects belonging to extensions are never dropped.
+
+        :param schemas: the schemas to clean, by default all `self.schemas`
+        :param parallel: the number of schemas to clean concurrently (default: 1). Schemas which
+            depend on each other, as recorded in `pg_depend`, are always cleaned one after another.
+        :return: a `CleanResult` with the number of objects dropped and how long it took
+
+        .. note:: Each concurrent clean checks out its own connection from the engine's pool, so
+            the pool should allow at least `parallel` connections. With a default SQLAlchemy pool
+            that is 15, any additional workers wait for a free connection.
+        """
+        schemas = list(schemas if schemas is not None else self.schemas)
+        started = time.perf_counter()
+
+        if not parallel or parallel == 1 or len(schemas) < 2:
+            objects_dropped = self._clean_schemas(schemas)
+        else:
+            groups = self.schema_clean_groups(schemas, self.get_schema_dependencies())
+            with ThreadPoolExecutor(max_workers=min(parallel, len(groups))) as executor:
+                objects_dropped = sum(executor.map(self._clean_schemas, groups))
+
+        result = CleanResult(
+            schemas=schemas,
+            objects_dropped=objects_dropped,
+            duration=time.perf_counter() - started,
+        )
+        log.info(
+            'Dropped %d objects from %d schemas in %.2fs',
+            result.objects_dropped,
+            len(result.schemas),
+            result.duration,
+        )
+        return result
+
+    def get_table_fingerprints(self, checksums=False, jobs=None):
+        """Return a fingerprint of the data in every table of `self.schemas`
+
+        The fingerprint is made from the table's `pg_stat_user_tables` tuple counters, its
+        relfilenode and a hash of its column definitions, so a table whose fingerprint didn't
+        change since a previous backup doesn't need to be dumped again.
+
+        :param checksums: also compute a checksum of each table's rows with `get_table_checksum`.
+            This reads every table in full but catches changes the statistics can miss.
+        :param jobs: the number of tables to checksum concurrently (default: 1)
+        :return: a list of `TableFingerprint`
+
+        .. note:: The statistics are collected asynchronously, writes committed in the second
+            before the fingerprints are read may only show up in the next backup's fingerprints.
+        """
+        with self.engine.connect() as conn:
+            result = conn.execute(text(TABLE_FINGERPRINTS_SQL), {'schemas': list(self.schemas)})
+            fingerprints = [TableFingerprint(**row._mapping) for row in result]
+
+        if checksums:
+            with ThreadPoolExecutor(max_workers=jobs or 1) as executor:
+                results = executor.map(
+                    lambda x: self.get_table_checksum(x.schema, x.table),
+                    fingerprints,
+                )
+                for fingerprint, checksum in zip(fingerprints, results, strict=True):
+                    fingerprint.checksum = checksum
+
+        return fingerprints
+
+    def get_stats_reset(self):
+        """Return when the database's statistics were last reset, as text, or None if never"""
+        with self.engine.connect() as conn:
+            return conn.execute(text(STATS_RESET_SQL)).scalar()
+
+    def is_in_recovery(self):
+        """Return True if the server is a standby, which keeps no statistics of table writes"""
+        with self.engine.connect() as conn:
+            return conn.execute(sa.select(sa.func.pg_is_in_recovery())).scalar()
+
+    def get_database_size(self):
+        """Return the size of the database on disk, in bytes"""
+        with self.engine.connect() as conn:
+            sql = sa.select(sa.func.pg_database_size(sa.func.current_database()))
+            return conn.execute(sql).scalar()
+
+    def get_table_sizes(self):
+        """Return the size on disk of every table of `self.schemas` by "schema.table", in bytes"""
+        with self.engine.connect() as conn:
+            result = conn.execute(text(TABLE_SIZES_SQL), {'schemas': list(self.schemas)})
+            return {row.name: row.size for row in result}
+
+    def get_table_checksum(self, schema, table):
+        """Return an order independent checksum of the rows of a table
+
+        :return: the row count and the sum of a 64 bit hash of each row, as "count:sum"
+        """
+        sql = TABLE_CHECKSUM_SQL.format(table=f'{quote_ident(schema)}.{quote_ident(table)}')
+        with self.engine.connect() as conn:
+            for setting in TABLE_CHECKSUM_SETTINGS:
+                conn.execute(text(setting))
+            row = conn.execute(text(sql)).one()
+
+        return f'{row.rows}:{row.checksum}'
+
+    def get_archive_list(self, path, section=None):
+        """Return the table of contents of a custom format backup, as listed by `pg_restore -l`
+
+        :param path: the path of the backup file
+        :param section: only list the items of this section, e.g. "post-data"
+        :return: a list of the TOC lines, comments excluded
+        """
+        command_args = ['--list', *([f'--section={section}'] if section else []), str(path)]
+        result = self._execute_cli_command(PostgresCommand.RESTORE_BINARY, command_args)
+        lines = result.stdout.decode().splitlines()
+        return [line for line in lines if line and not line.startswith(';')]
+
+    def get_client_version(self, command=PostgresCommand.BACKUP):
+        """Return the version of a client program as it reports it, e.g. "pg_dump (PostgreSQL) 16.4"
+
+        :param command: the program, an instance of `PostgresCommand`
+        """
+        env = os.environ.copy()
+        env['PGCLUSTER'] = self._pg_wrapper_cluster(command.value)
+        result = self.executor(
+            [command.value, '--version'],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            raise PostgresCLIError(result)
+        return result.stdout.decode().strip()
+
+    def selected_list(self, entries, tables=(), exclude_tables=(), clean=False):
+        """Return the TOC lines restoring a selection of tables, for `--use-list`
+
+        :param entries: the `TocEntry`s of the backup
+        :param clean: the selected tables are dropped first, which fails when a table which isn't
+            restored has a foreign key to one of them
+        :raises PostgresInputError: when no table is selected
+        :raises WorekOperationException: when cleaning and a table which isn't restored has a
+            foreign key to one which is
+        """
+        selected = toc.select_entries(entries, self.schemas, tables, exclude_tables)
+        if tables and not any(x.desc in toc.RELATIONS for x in selected):
+            raise PostgresInputError(f'No table of the backup matches {", ".join(tables)}.')
+        if clean:
+            self._check_inbound_foreign_keys(
+                {f'{x.namespace}.{x.tag}' for x in selected if x.desc == 'TABLE'},
+            )
+
+        restored = {x.dump_id for x in selected}
+        skipped = [
+            x.tag
+            for x in entries
+            if x.desc == 'FK CONSTRAINT'
+            and x.dump_id not in restored
+            and restored.intersection(x.dependencies)
+        ]
+        if skipped:
+            log.warning(
+                'Not restoring foreign keys to or from tables which are not restored: %s',
+                ', '.join(skipped),
+            )
+        return [x.list_line() for x in selected]
+
+    def _check_inbound_foreign_keys(self, tables):
+        """Raise if a table of the database outside `tables` has a foreign key to one of them
+
+        Dropping a referenced table would need the foreign key dropped too, which a selective
+        restore wouldn't recreate.
+        """
+        with self.engine.connect() as conn:
+            result = conn.execute(text(INBOUND_FOREIGN_KEYS_SQL), {'tables': sorted(tables)})
+            blocking = [x for x in result if x.table not in tables]
+        if blocking:
+            names = ', '.join(f'{x.name} on {x.table} -> {x.referenced}' for x in blocking)
+            raise WorekOperationException(
+                f'Tables which are not restored have foreign keys to restored tables: {names}.'
+                ' Restore the referencing tables too, or drop these foreign keys first.',
+            )
 
     def restore(self, buf, **kwargs):
-        """Perform a "smart" restore, properly choosing between a binary or text version"""
-        return self.restore_binary(buf, **kwargs)
+        """Perform a "smart" restore, choosing the restore for the format of the backup
 
-        try:
-            header = buf.peek(5)
-        except AttributeError as err:
-            raise PostgresInputError(
-                'You must use a peekable stream when trying to automatically detect the backup file'
-                ' type. If you are pipe data into worek from the CLI, you should explicitly set the'
-                ' backup file type that you are piping to the restore command.',
-            ) from err
-
-        if header[:5] in ('PGDMP', b'PGDMP'):
+        The format is detected from the first bytes of `buf`, see `detect_format`. They are read
+        without consuming them, so `buf` can be any readable stream, including a pipe.
+
+        .. note:: Compressed and encrypted backups must be decoded first, `worek.restore` does
+            that automatically.
+        """
+        if not hasattr(buf, 'read'):
+            # e.g. a file descriptor, which can't be inspected without consuming it
             return self.restore_binary(buf, **kwargs)
-        else:
-            return self.restore_text(buf, **kwargs)
 
-    def restore_binary(self, buf, no_owner=True, no_privileges=True, **kwargs):
+        header, buf = sniff(binary_stream(buf), tarfile.BLOCKSIZE)
+        file_format = detect_format(header)
+        if file_format == 'c':
+            return self.restore_binary(buf, **kwargs)
+        if file_format == 'd':
+            return self.restore_directory(buf, **kwargs)
+        if file_format == 'n':
+            return self.restore_native(buf, **kwargs)
+        return self.restore_text(buf, **kwargs)
+
+    def restore_binary(
+        self,
+        buf,
+        no_owner=True,
+        no_privileges=True,
+        jobs=None,
+        section=None,
+        use_list=None,
+        tables=(),
+        exclude_tables=(),
+        clean=False,
+        all_schemas=False,
+        **kwargs,
+    ):
         """Restore a binary backup from the passed buf
 
         :param buf: the buffer with the backup to restore
         :param no_owner: do not keep the owner information from the backup (default: True)
         :param no_privileges: do not restore privileges information from the backup (default: True)
+        :param jobs: the number of parallel jobs pg_restore uses to load data and build indexes
+            (default: 1)
+        :param section: only restore this section of the backup, "pre-data", "data" or "post-data"
+        :param use_list: only restore the items with these TOC lines, as returned by
+            `get_archive_list`
+        :param tables: only restore the tables matching these patterns and the objects which go
+            with them, see `worek.toc.select_entries`. `buf` must then be a file-like object.
+        :param exclude_tables: don't restore the tables matching these patterns
+        :param clean: drop the objects being restored first. Without `jobs` the restore then runs
+            in a single transaction, so a failure leaves the objects as they were.
+        :param all_schemas: restore the objects of every schema and those without one, like large
+            objects, rather than those of `self.schemas`
 
         .. note:: Depending on the `self.executor`, the options for `buf` depend on the supported
-            values. By default this class uses `subprocess.run` to execute the restore command, so
-            you can pass anything to `buf` that the `stdin` argument would take for that function
-            (i.e. PIPE, file, DEVNULL)
+            values. By default this class uses `worek.streams.run` to execute the restore command,
+            so you can pass anything to `buf` that the `stdin` argument would take for that
+            function (i.e. a file, a file-like object, DEVNULL)
+
+        .. note:: pg_restore can only run parallel jobs against a seekable file. When `jobs` is
+            given and `buf` is not a regular file, it must be a readable file-like object and it is
+            first spooled to a temporary file.
         """
         command_args = [
             *(['--no-owner'] if no_owner else []),
             *(['--no-privileges'] if no_privileges else []),
+            *([f'--section={section}'] if section else []),
+            *(['--clean', '--if-exists'] if clean else []),
         ]
-        return self._execute_cli_command(PostgresCommand.RESTORE_BINARY, command_args, stdin=buf)
+
+        if tables or exclude_tables:
+            entries, buf = toc.read_toc(binary_stream(buf))
+            use_list = self.selected_list(entries, tables, exclude_tables, clean=clean)
+
+        with contextlib.ExitStack() as stack:
+            if use_list is not None:
+                command_args += ['--use-list', list_file(stack, use_list)]
+
+            if not jobs or jobs == 1:
+                return self._execute_cli_command(
+                    PostgresCommand.RESTORE_BINARY,
+                    [*command_args, *(['--single-transaction'] if clean else [])],
+                    stdin=buf,
+                    all_schemas=all_schemas,
+                )
+
+            path = stack.enter_context(spooled_path(buf))
+            command_args += ['--jobs', str(jobs), path]
+            return self._execute_cli_command(
+                PostgresCommand.RESTORE_BINARY,
+                command_args,
+                all_schemas=all_schemas,
+            )
+
+    def restore_directory(
+        self,
+        buf,
+        no_owner=True,
+        no_privileges=True,
+        jobs=None,
+        tables=(),
+        exclude_tables=(),
+        clean=False,
+        **kwargs,
+    ):
+        """Restore a directory format backup packed as a tar stream by `backup_directory`
+
+        :param buf: the buffer with the tar stream of the backup directory
+        :param no_owner: do not keep the owner information from the backup (default: True)
+        :param no_privileges: do not restore privileges information from the backup (default: True)
+        :param jobs: the number of parallel jobs pg_restore uses to load data and build indexes
+            (default: 1)
+        :param tables: only restore the tables matching these patterns, see `restore_binary`
+        :param exclude_tables: don't restore the tables matching these patterns
+        :param clean: drop the objects being restored first, see `restore_binary`
+
+        .. note:: The tar stream is unpacked into a temporary directory before the restore, so
+            there needs to be enough space in the temp directory to hold the full backup.
+        """
+        with (
+            tempfile.TemporaryDirectory(prefix='worek-') as tmpdir,
+            contextlib.ExitStack() as stack,
+        ):
+            dump_dir = Path(tmpdir) / 'backup'
+            unpack_directory(buf, dump_dir)
+
+            command_args = [
+                '--format',
+                'directory',
+                *(['--no-owner'] if no_owner else []),
+                *(['--no-privileges'] if no_privileges else []),
+                *(['--jobs', str(jobs)] if jobs else []),
+                *(['--clean', '--if-exists'] if clean else []),
+                *(['--single-transaction'] if clean and not jobs else []),
+            ]
+            if tables or exclude_tables:
+                with (dump_dir / 'toc.dat').open('rb') as fp:
+                    entries, _ = toc.read_toc(fp)
+                lines = self.selected_list(entries, tables, exclude_tables, clean=clean)
+                command_args += ['--use-list', list_file(stack, lines)]
+
+            command_args.append(str(dump_dir))
+            return self._execute_cli_command(PostgresCommand.RESTORE_BINARY, command_args)
+
+    def _copy_table_in(self, table, path):
+        """Load a table from a file in the binary COPY format on its own connection"""
+        self._set_progress_item(f'loading {table.qualified_name}')
+        sql = f'COPY {table.qualified_name} ({table.column_list}) FROM STDIN (FORMAT binary)'
+        with self.engine.connect() as conn:
+            # only for this transaction, the connection goes back to the pool
+            conn.execute(text('SET LOCAL synchronous_commit = off'))
+            with path.open('rb') as fp:
+                conn.connection.driver_connection.cursor().copy_expert(sql, fp)
+            conn.commit()
+        path.unlink()
+
+    def _restore_item(self, path, line, locks=(), **kwargs):
+        """Restore a single TOC item of a backup, holding `locks` while it runs"""
+        with contextlib.ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            fp = stack.enter_context(path.open('rb'))
+            self.restore_binary(fp, use_list=[line], **kwargs)
+
+    def restore_native(self, buf, jobs=None, no_owner=True, no_privileges=True, **kwargs):
+        """Restore a native archive created by `backup_native`
+
+        The restore is done in three steps:
+
+        1. the pre-data part of the schema (e.g. types, tables, functions) is created
+        2. the tables are loaded with `COPY ... FROM STDIN (FORMAT binary)`, `jobs` at a time
+           each on its own connection. No index, foreign key or trigger exists yet, so nothing
+           slows the load down. The sequences are then set and the large objects restored.
+        3. indexes and primary key / unique constraints are built `jobs` at a time, biggest table
+           first, then foreign keys are validated the same way. The rest of the post-data part
+           (e.g. triggers, rules, comments) is restored last, in its original order.
+
+        :param buf: the buffer with the tar stream of the archive
+        :param jobs: the number of tables loaded and indexes built in parallel (default: 1)
+        :param no_owner: do not keep the owner information from the backup (default: True)
+        :param no_privileges: do not restore privileges information from the backup (default: True)
+
+        .. note:: Each table is spooled to a temporary file as it is read from the archive, up to
+            `2 * jobs` at a time, and each job uses its own connection from the engine's pool.
+        """
+        jobs = jobs or 1
+        options = {'no_owner': no_owner, 'no_privileges': no_privileges}
+        started = time.perf_counter()
+
+        with contextlib.ExitStack() as stack:
+            tmpdir = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix='worek-')))
+            archive = stack.enter_context(tarfile.open(fileobj=buf, mode='r|'))
+
+            member = archive.next()
+            if member is None or member.name != NATIVE_TOC_NAME:
+                raise PostgresInputError('The backup is not a native archive.')
+            native_toc = json.loads(archive.extractfile(member).read())
+            tables = [NativeTable(**x) for x in native_toc['tables']]
+
+            member = archive.next()
+            if member is None or member.name != NATIVE_SCHEMA_NAME:
+                raise PostgresInputError('The native archive has no schema.')
+            schema_path = tmpdir / NATIVE_SCHEMA_NAME
+            with schema_path.open('wb') as fp:
+                shutil.copyfileobj(archive.extractfile(member), fp, SPOOL_BUFFER_SIZE)
+
+            with schema_path.open('rb') as fp:
+                self.restore_binary(fp, section='pre-data', **options)
+
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=jobs))
+            pending = collections.deque()
+            blobs_path = None
+            while (member := archive.next()) is not None:
+                if member.name == NATIVE_BLOBS_NAME:
+                    blobs_path = tmpdir / NATIVE_BLOBS_NAME
+                    with blobs_path.open('wb') as fp:
+                        shutil.copyfileobj(archive.extractfile(member), fp, SPOOL_BUFFER_SIZE)
+                    continue
+
+                index = native_data_index(member.name)
+                path = tmpdir / f'{index}.copy'
+                with path.open('wb') as fp:
+                    shutil.copyfileobj(archive.extractfile(member), fp, SPOOL_BUFFER_SIZE)
+
+                pending.append(executor.submit(self._copy_table_in, tables[index], path))
+                while len(pending) >= 2 * jobs or (pending and pending[0].done()):
+                    pending.popleft().result()
+
+            while pending:
+                pending.popleft().result()
+            log.info('Loaded %d tables in %.2fs', len(tables), time.perf_counter() - started)
+
+            with self.engine.connect() as conn:
+                for sequence in native_toc['sequences']:
+                    conn.execute(text(SET_SEQUENCE_SQL), sequence)
+                conn.commit()
+
+            if blobs_path is not None:
+                # the large objects replace those with the same OIDs, which cleaning keeps
+                with blobs_path.open('rb') as fp:
+                    self.restore_binary(fp, clean=True, all_schemas=True, **options)
+
+            builds, foreign_keys, others = native_post_data_plan(
+                self.get_archive_list(schema_path, section='post-data'),
+                native_toc,
+            )
+            list(executor.map(lambda x: self._restore_item(schema_path, x, **options), builds))
+
+            # lock the tables of a foreign key in a consistent order so that validations running
+            # concurrently wait for each other instead of deadlocking
+            table_locks = collections.defaultdict(threading.Lock)
+            list(
+                executor.map(
+                    lambda x: self._restore_item(
+                        schema_path,
+                        x[0],
+                        locks=[table_locks[name] for name in sorted(x[1])],
+                        **options,
+                    ),
+                    foreign_keys,
+                ),
+            )
+
+            if others:
+                with schema_path.open('rb') as fp:
+                    self.restore_binary(fp, use_list=others, **options)
+
+        log.info(
+            'Restored %d tables, %d indexes and %d foreign keys in %.2fs',
+            len(tables),
+            len(builds),
+            len(foreign_keys),
+            time.perf_counter() - started,
+        )
+        return native_toc
 
     def restore_text(self, buf, **kwargs):
         """Restore a plain text backup from the passed buf
@@ -370,41 +1408,411 @@ class Postgres:
         :param buf: the buffer with the backup to restore
 
         .. note:: Depending on the `self.executor`, the options for `buf` depend on the supported
-            values. By default this class uses `subprocess.run` to execute the restore command, so
-            you can pass anything to `buf` that the `stdin` argument would take for that function
-            (i.e. PIPE, file, DEVNULL)
+            values. By default this class uses `worek.streams.run` to execute the restore command,
+            so you can pass anything to `buf` that the `stdin` argument would take for that
+            function (i.e. a file, a file-like object, DEVNULL)
         """
         return self._execute_cli_command(PostgresCommand.RESTORE_TEXT, [], stdin=buf)
 
-    def backup_binary(self, buf, blobs=True):
+    def backup_binary(self, buf, blobs=True, exclude_table_data=(), compress_level=None):
         """Create a binary (--format=custom) backup of the postgres context
 
         :param buf: the buffer to store the results of the backup
         :param blobs: include blob data in backup (default: True)
+        :param exclude_table_data: `(schema, table)` pairs of tables whose definition is backed up
+            but not their data
+        :param compress_level: pg_dump's compression level, 0 for an uncompressed backup (default:
+            pg_dump's default)
 
         .. note:: Depending on the `self.executor`, the options for `buf` depend on the supported
-            values. By default this class uses `subprocess.run` to execute the backup command, so
-            you can pass anything to `buf` that the `stdout` argument would take for that function
-            (i.e. PIPE, file, DEVNULL)
+            values. By default this class uses `worek.streams.run` to execute the backup command,
+            so you can pass anything to `buf` that the `stdout` argument would take for that
+            function (i.e. a file, a file-like object, DEVNULL)
         """
-        command_args = ['--format', 'custom'] + (['--blobs'] if blobs else [])
+        command_args = [
+            '--format',
+            'custom',
+            *(['--blobs'] if blobs else []),
+            *([f'--compress={compress_level}'] if compress_level is not None else []),
+            *(
+                f'--exclude-table-data={quote_ident(schema)}.{quote_ident(table)}'
+                for schema, table in exclude_table_data
+            ),
+        ]
         return self._execute_cli_command(PostgresCommand.BACKUP, command_args, stdout=buf)
 
+    def backup_directory(self, buf, jobs=None, blobs=True, compress_level=None):
+        """Create a directory format (--format=directory) backup of the postgres context
+
+        pg_dump can only dump tables in parallel when writing a directory format backup. The backup
+        is written to a temporary directory and then packed into a tar stream, so the result is
+        still a single file which can be piped anywhere `backup_binary` output can.
+
+        :param buf: the buffer to store the tar stream of the backup directory
+        :param jobs: the number of tables to dump in parallel (default: 1)
+        :param blobs: include blob data in backup (default: True)
+        :param compress_level: pg_dump's compression level of each file of the directory, 0 for
+            uncompressed files (default: pg_dump's default)
+
+        .. note:: Each pg_dump worker uses its own database connection, so the server must allow
+            `jobs + 1` connections for the user. There also needs to be enough space in the temp
+            directory to hold the full backup.
+        """
+        with tempfile.TemporaryDirectory(prefix='worek-') as tmpdir:
+            dump_dir = Path(tmpdir) / 'backup'
+            command_args = [
+                '--format',
+                'directory',
+                '--file',
+                str(dump_dir),
+                *(['--jobs', str(jobs)] if jobs else []),
+                *(['--blobs'] if blobs else []),
+                *([f'--compress={compress_level}'] if compress_level is not None else []),
+            ]
+            result = self._execute_cli_command(PostgresCommand.BACKUP, command_args)
+            pack_directory(dump_dir, buf)
+
+        return result
+
+    def _snapshot_connection(self, snapshot):
+        """Return a connection whose transaction reads from an exported snapshot"""
+        conn = self.engine.connect().execution_options(
+            isolation_level='REPEATABLE READ',
+            postgresql_readonly=True,
+        )
+        conn.execute(text('SET TRANSACTION SNAPSHOT :snapshot'), {'snapshot': snapshot})
+        return conn
+
+    def _copy_table_out(self, connections, table, path):
+        """Copy a table's data to `path` in the binary COPY format on one of `connections`"""
+        self._set_progress_item(f'copying {table.qualified_name}')
+        conn = connections.get()
+        try:
+            sql = f'COPY {table.qualified_name} ({table.column_list}) TO STDOUT (FORMAT binary)'
+            with path.open('wb') as fp:
+                conn.connection.driver_connection.cursor().copy_expert(sql, fp)
+        finally:
+            connections.put(conn)
+
+    def backup_native(self, buf, jobs=None):
+        """Create a native archive, copying tables in binary in parallel from a shared snapshot
+
+        Instead of having pg_dump format every row as text, a coordinating transaction exports its
+        snapshot with `pg_export_snapshot()` and `jobs` connections import it, so every table is
+        read in the same consistent state. Tables are copied biggest first with
+        `COPY ... TO STDOUT (FORMAT binary)`. The archive is a tar stream holding:
+
+        - `toc.json`: the tables, their columns and sizes, the sequence values and the tables of
+          the indexes and constraints, used by `restore_native` to schedule them
+        - `schema.dump`: a custom format, schema only, pg_dump of the same snapshot
+        - `data/<n>.copy`: the binary COPY data of the nth table of the TOC, in the order the
+          copies finished
+        - `blobs.dump`: a custom format, data only, pg_dump of the large objects of the same
+          snapshot, only when the database has any
+
+        :param buf: the buffer to store the tar stream of the archive
+        :param jobs: the number of tables to copy in parallel (default: 1)
+        :return: the TOC of the archive
+
+        .. note:: Each table is spooled to a temporary file before it is added to the archive, and
+            at most `2 * jobs` tables are copied or waiting to be added at a time, so there needs
+            to be enough space in the temp directory for that many tables. The binary COPY format
+            depends on the column types, so the archive has to be restored to a server with the
+            same types (e.g. not an older major version).
+        """
+        jobs = jobs or 1
+        connections = queue.Queue()
+        self._default_version()
+
+        with contextlib.ExitStack() as stack:
+            coordinator = stack.enter_context(
+                self.engine.connect().execution_options(
+                    isolation_level='REPEATABLE READ',
+                    postgresql_readonly=True,
+                ),
+            )
+            schemas = {'schemas': list(self.schemas)}
+            tables = [
+                NativeTable(**row._mapping)
+                for row in coordinator.execute(text(NATIVE_TABLES_SQL), schemas)
+            ]
+            sequences = [
+                NativeSequence(**row._mapping)
+                for row in coordinator.execute(text(NATIVE_SEQUENCES_SQL), schemas)
+            ]
+            indexes = coordinator.execute(text(NATIVE_INDEXES_SQL), schemas)
+            constraints = coordinator.execute(text(NATIVE_CONSTRAINTS_SQL), schemas)
+            if tables:
+                # keep the tables from being altered or dropped until the export is done
+                names = ', '.join(x.qualified_name for x in tables)
+                coordinator.execute(text(f'LOCK TABLE {names} IN ACCESS SHARE MODE'))
+            has_blobs = coordinator.execute(text(HAS_LARGE_OBJECTS_SQL)).scalar()
+            snapshot = coordinator.execute(text('SELECT pg_export_snapshot()')).scalar()
+
+            for _ in range(min(jobs, len(tables)) or 1):
+                connections.put(stack.enter_context(self._snapshot_connection(snapshot)))
+
+            native_toc = {
+                'format_version': 1,
+                'server_version': self.server_version,
+                'schemas': list(self.schemas),
+                'tables': [dataclasses.asdict(x) for x in tables],
+                'sequences': [dataclasses.asdict(x) for x in sequences],
+                'indexes': [dict(x._mapping) for x in indexes],
+                'constraints': [dict(x._mapping) for x in constraints],
+            }
+            tmpdir = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix='worek-')))
+            archive = stack.enter_context(tarfile.open(fileobj=buf, mode='w|'))
+
+            toc_data = json.dumps(native_toc, indent=2).encode()
+            add_tar_member(archive, NATIVE_TOC_NAME, io.BytesIO(toc_data), len(toc_data))
+
+            schema_path = tmpdir / NATIVE_SCHEMA_NAME
+            with schema_path.open('wb') as fp:
+                self._execute_cli_command(
+                    PostgresCommand.BACKUP,
+                    ['--format', 'custom', '--schema-only', f'--snapshot={snapshot}'],
+                    stdout=fp,
+                )
+            with schema_path.open('rb') as fp:
+                add_tar_member(archive, NATIVE_SCHEMA_NAME, fp, schema_path.stat().st_size)
+            schema_path.unlink()
+
+            started = time.perf_counter()
+            workers = connections.qsize()
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+            pending = collections.deque(enumerate(tables))
+            futures = {}
+
+            try:
+                # tables are only copied a little ahead of the archive, when it is written slower
+                # than they are copied the spooled copies would otherwise fill the temp directory
+                while pending or futures:
+                    while pending and len(futures) < 2 * workers:
+                        index, table = pending.popleft()
+                        path = tmpdir / f'{index}.copy'
+                        future = executor.submit(self._copy_table_out, connections, table, path)
+                        futures[future] = (index, path)
+
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        index, path = futures.pop(future)
+                        with path.open('rb') as fp:
+                            add_tar_member(
+                                archive,
+                                native_data_name(index),
+                                fp,
+                                path.stat().st_size,
+                            )
+                        path.unlink()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+            if has_blobs:
+                blobs_path = tmpdir / NATIVE_BLOBS_NAME
+                with blobs_path.open('wb') as fp:
+                    self._execute_cli_command(
+                        PostgresCommand.BACKUP,
+                        [
+                            '--format',
+                            'custom',
+                            '--data-only',
+                            '--blobs',
+                            # a pattern without a schema only matches tables on the search path
+                            '--exclude-table-data=*.*',
+                            f'--snapshot={snapshot}',
+                        ],
+                        stdout=fp,
+                    )
+                with blobs_path.open('rb') as fp:
+                    add_tar_member(archive, NATIVE_BLOBS_NAME, fp, blobs_path.stat().st_size)
+
+        log.info(
+            'Copied %d tables with %d jobs in %.2fs',
+            len(tables),
+            jobs,
+            time.perf_counter() - started,
+        )
+        return native_toc
+
     def backup_text(self, buf):
         """Create a plain text backup of the postgres context
 
         :param buf: the buffer to store the results of the backup
 
-        .. note:: Depending on the `self.executor`, the options for `buf` depend on the support
-            values. By default this class uses `subprocess.run` to execute the backup command, so
-            you can pass anything to `buf` that the `stdout` argument would take for that function
-            (i.e. PIPE, file, DEVNULL)
+        .. note:: Depending on the `self.executor`, the options for `buf` depend on the supported
+            values. By default this class uses `worek.streams.run` to execute the backup command,
+            so you can pass anything to `buf` that the `stdout` argument would take for that
+            function (i.e. a file, a file-like object, DEVNULL)
         """
 
         command_args = ['--format', 'plain']
         return self._execute_cli_command(PostgresCommand.BACKUP, command_args, stdout=buf)
 
 
+def native_data_name(index):
+    """Return the name of the archive member holding the data of the `index`th table"""
+    return f'data/{index}.copy'
+
+
+def native_data_index(name):
+    """Return the index in the TOC of the table whose data is in the archive member `name`"""
+    match = re.fullmatch(r'data/(\d+)\.copy', name)
+    if match is None:
+        raise PostgresInputError(f'Unexpected member {name} in the native archive.')
+    return int(match.group(1))
+
+
+def toc_item(line):
+    """Return the type, schema and name of an item of a `pg_restore -l` listing
+
+    e.g. "TABLE DATA public users" for "3345; 0 16390 TABLE DATA public users postgres"
+    """
+    return line.split(' ', 3)[-1].rsplit(' ', 1)[0]
+
+
+def native_post_data_plan(lines, native_toc):
+    """Split the post-data items of a native archive by how they are restored
+
+    :param lines: the post-data TOC lines of the archive's schema dump
+    :param native_toc: the TOC of the archive
+    :return: a tuple of the index and primary key / unique constraint lines, biggest table first,
+        the foreign key `(line, tables)` pairs, biggest table first, where `tables` are the two
+        tables the foreign key locks, and the other lines in their original order
+    """
+    sizes = {(x['schema'], x['table']): x['size'] for x in native_toc['tables']}
+    items = {}
+    for index in native_toc['indexes']:
+        key = (index['schema'], index['table'])
+        items[f'INDEX {index["schema"]} {index["name"]}'] = (key, None)
+    for constraint in native_toc['constraints']:
+        key = (constraint['schema'], constraint['table'])
+        name = f'{constraint["schema"]} {constraint["table"]} {constraint["name"]}'
+        referenced = (constraint['referenced_schema'], constraint['referenced_table'])
+        items[f'CONSTRAINT {name}'] = (key, None)
+        items[f'FK CONSTRAINT {name}'] = (key, referenced)
+
+    builds, foreign_keys, others = [], [], []
+    for line in lines:
+        item = toc_item(line)
+        if item not in items:
+            others.append(line)
+            continue
+
+        key, referenced = items[item]
+        size = sizes.get(key, 0)
+        if item.startswith('FK CONSTRAINT'):
+            foreign_keys.append((size, line, {key, referenced}))
+        else:
+            builds.append((size, line))
+
+    builds.sort(key=lambda x: x[0], reverse=True)
+    foreign_keys.sort(key=lambda x: x[0], reverse=True)
+    return (
+        [line for _, line in builds],
+        [(line, tables) for _, line, tables in foreign_keys],
+        others,
+    )
+
+
+def list_file(stack, lines):
+    """Write TOC lines to a temporary file for pg_restore's `--use-list`, return its path
+
+    :param stack: a `contextlib.ExitStack` which deletes the file
+    """
+    fp = stack.enter_context(
+        tempfile.NamedTemporaryFile('w', prefix='worek-', suffix='.list'),  # noqa: SIM115
+    )
+    fp.write(''.join(f'{line}\n' for line in lines))
+    fp.flush()
+    return fp.name
+
+
+def list_archive(buf):
+    """Return the table of contents of a custom format backup without connecting to a database
+
+    Only the header and the table of contents are read, a damaged one makes pg_restore fail.
+
+    :param buf: the path of the backup, or a readable stream of it
+    :return: a list of the TOC lines, comments excluded
+    :raises PostgresCLIError: when pg_restore can't read the archive
+    """
+    if isinstance(buf, (str, Path)):
+        args, stdin = [str(buf)], subprocess.DEVNULL
+    else:
+        args, stdin = [], buf
+    result = run(
+        ['pg_restore', '--list', *args],
+        stdin=stdin,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        raise PostgresCLIError(result)
+
+    lines = result.stdout.decode().splitlines()
+    return [line for line in lines if line and not line.startswith(';')]
+
+
+def detect_format(header):
+    """Return the format of a backup from its first `tarfile.BLOCKSIZE` bytes
+
+    :return: "c" for a custom format dump, "n" for a native archive, "d" for any other tar stream
+        (a packed directory format dump) and "t" for anything else, i.e. plain SQL
+    """
+    if header.startswith(b'PGDMP'):
+        return 'c'
+
+    member = first_tar_member(header)
+    if member == NATIVE_TOC_NAME:
+        return 'n'
+    if member is not None:
+        return 'd'
+    return 't'
+
+
+def client_version(server_version):
+    """Return the client utilities version matching a `server_version` setting
+
+    Before Postgres 10 the major version was the first two numbers, e.g. "9.6", since then it is
+    only the first.
+    """
+    version = re.match(r'(\d+\.\d+)', server_version).group(1)
+    if version.startswith('9'):
+        return version
+    return version.split('.')[0]
+
+
+def dependents_first(schemas, edges):
+    """Order `schemas` so each schema comes before the schemas it depends on
+
+    :param schemas: the schema names to order
+    :param edges: `(dependent, referenced)` schema pairs; dependency cycles are broken by name
+    """
+    pending = sorted(schemas)
+    ordered = []
+    while pending:
+        # a schema is ready once no other pending schema depends on it
+        ready = [
+            schema
+            for schema in pending
+            if not any((other, schema) in edges for other in pending if other != schema)
+        ]
+        schema = ready[0] if ready else pending[0]
+        ordered.append(schema)
+        pending.remove(schema)
+
+    return ordered
+
+
+def quote_ident(name):
+    """Quote a Postgres identifier, e.g. a schema name, for use in a SQL statement"""
+    return '"{}"'.format(name.replace('"', '""'))
+
+
 def is_pg_wrapper_available(exe_name):
     path = shutil.which(exe_name)
     if path is None:
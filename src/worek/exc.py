@@ -1,2 +1,6 @@
 class WorekException(Exception):
     pass
+
+
+class WorekOperationException(WorekException):
+    pass
@@ -0,0 +1,348 @@
+"""Back up every database of a fleet of servers
+
+A fleet is described by a YAML (or JSON) config file::
+
+    output: /srv/backups/{host}/{dbname}-{date}.dump
+    concurrency: 8          # backups running at once across all servers
+    per_host: 2             # backups running at once on each server
+    retries: 2              # times a backup failing with a transient error is retried
+    retry_delay: 30         # seconds before a retry
+    backup:                 # options passed to `worek.backup` for every database
+      compress: zstd
+    servers:
+      - host: db1.example.com
+        user: backup
+      - host: db2.example.com
+        port: 5433
+        per_host: 4
+        databases: [billing, accounts]
+        exclude: [scratch]
+
+Without a `databases` list every database of a server which allows connections is backed up, except
+templates and the ones in `exclude`. Backups of all servers are scheduled largest database first,
+so the longest ones don't end up running alone at the end, while keeping to both concurrency limits.
+A server whose databases can't be listed, after the same retries as a backup, is reported as a
+failed job for its databases ("*") and the other servers are backed up.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import dataclasses
+import datetime as dt
+import json
+import logging
+from pathlib import Path
+import time
+
+import psycopg2
+import sqlalchemy as sa
+
+from worek import core
+import worek.dialects.postgres as pgdialect
+from worek.exc import WorekOperationException
+
+
+log = logging.getLogger(__name__)
+
+DATABASES_SQL = """
+    SELECT datname, pg_database_size(oid) AS size
+    FROM pg_database
+    WHERE datallowconn AND NOT datistemplate
+"""
+
+# pg_dump messages of failures which are worth retrying
+TRANSIENT_ERRORS = (
+    'could not connect',
+    'connection to server',
+    'server closed the connection',
+    'terminating connection',
+    'too many connections',
+    'the database system is starting up',
+    'the database system is shutting down',
+    'could not obtain lock',
+    'deadlock detected',
+    'canceling statement due to conflict with recovery',
+)
+
+SERVER_KEYS = ('host', 'port', 'user', 'password')
+
+
+class WorekFleetError(WorekOperationException):
+    pass
+
+
+@dataclasses.dataclass
+class FleetJob:
+    """The backup of one database of the fleet
+
+    :ivar status: "pending", "done" or "failed". The databases of a server which couldn't be
+        listed are a single failed job, with "*" as its `dbname` and no `output`.
+    :ivar attempts: the number of times the backup was started
+    :ivar duration: the seconds the last attempt took
+    :ivar error: the error of the last failed attempt
+    """
+
+    server: dict
+    dbname: str
+    size: int
+    output: Path | None
+    status: str = 'pending'
+    attempts: int = 0
+    duration: float | None = None
+    error: str | None = None
+    not_before: float = 0
+
+    @property
+    def host(self):
+        return f'{self.server.get("host") or "localhost"}:{self.server.get("port") or 5432}'
+
+
+def load_config(path):
+    """Read a fleet config from a YAML or JSON file"""
+    path = Path(path)
+    text = path.read_text()
+    if path.suffix == '.json':
+        return json.loads(text)
+
+    try:
+        import yaml
+    except ImportError as err:
+        raise WorekFleetError(
+            'YAML fleet configs need the pyyaml package, install worek[fleet] or use JSON.',
+        ) from err
+    return yaml.safe_load(text)
+
+
+def connection_params(server):
+    return {key: server[key] for key in SERVER_KEYS if server.get(key) is not None}
+
+
+def list_databases(server):
+    """Return `(name, size)` pairs for the databases of a server which allow connections"""
+    engine = pgdialect.Postgres.construct_engine_from_params(
+        dbname=server.get('maintenance_db', 'postgres'),
+        **connection_params(server),
+    )
+    try:
+        with engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(sa.text(DATABASES_SQL))]
+    finally:
+        engine.dispose()
+
+
+def list_server_databases(server, retries=0, retry_delay=0):
+    """Return the databases of a server like `list_databases`, retrying transient errors
+
+    :return: a tuple of the `(name, size)` pairs, None when they couldn't be listed, and the
+        failed `FleetJob` standing for the server's databases in that case
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return list_databases(server), None
+        except sa.exc.DBAPIError as err:
+            failed = FleetJob(
+                server=server,
+                dbname='*',
+                size=0,
+                output=None,
+                status='failed',
+                attempts=attempts,
+                error=describe_error(err),
+            )
+            if not is_transient(err) or attempts > retries:
+                log.error("Can't list the databases of %s: %s", failed.host, failed.error)
+                return None, failed
+            log.warning('Retrying to list the databases of %s: %s', failed.host, failed.error)
+            time.sleep(retry_delay)
+
+
+def plan(config, started=None, retries=0, retry_delay=0):
+    """Return the jobs for every database of the fleet, largest first
+
+    :param started: the time substituted for `{date}` in the output paths, by default now
+    :param retries: the number of times listing a server's databases is retried after a transient
+        error. A server which still fails is a failed job, after the others.
+    :param retry_delay: the number of seconds to wait before retrying
+    """
+    started = started or dt.datetime.now(dt.UTC)
+    template = config.get('output', '{host}/{dbname}-{date}.dump')
+
+    jobs = []
+    unreachable = []
+    for server in config['servers']:
+        exclude = set(server.get('exclude', ()))
+        databases, failed = list_server_databases(server, retries, retry_delay)
+        if failed is not None:
+            unreachable.append(failed)
+            continue
+        if 'databases' in server:
+            wanted = set(server['databases'])
+            missing = wanted - {name for name, _ in databases}
+            if missing:
+                raise WorekFleetError(
+                    f'{server.get("host")} has no databases {", ".join(sorted(missing))}.',
+                )
+            databases = [x for x in databases if x[0] in wanted]
+
+        for dbname, size in databases:
+            if dbname in exclude:
+                continue
+            output = template.format(
+                host=server.get('host') or 'localhost',
+                port=server.get('port') or 5432,
+                dbname=dbname,
+                date=started.strftime('%Y%m%dT%H%M%SZ'),
+            )
+            jobs.append(FleetJob(server=server, dbname=dbname, size=size, output=Path(output)))
+
+    return [*sorted(jobs, key=lambda x: x.size, reverse=True), *unreachable]
+
+
+def is_transient(err):
+    """Return True if a failed backup is worth retrying
+
+    Errors worek raises for a database error, e.g. "Can't connect to the database.", are judged by
+    the error they were raised from.
+    """
+    while err is not None:
+        if isinstance(err, sa.exc.OperationalError | psycopg2.OperationalError):
+            return True
+
+        if isinstance(err, pgdialect.PostgresCLIError):
+            stderr = (err.command_result.stderr or b'').decode(errors='replace').lower()
+            return any(x in stderr for x in TRANSIENT_ERRORS)
+
+        err = err.__cause__
+
+    return False
+
+
+def describe_error(err):
+    """Return a one line message of a failed backup, from pg_dump or the database driver"""
+    if isinstance(err, pgdialect.PostgresCLIError):
+        stderr = (err.command_result.stderr or b'').decode(errors='replace').strip()
+        if stderr:
+            return stderr.splitlines()[-1]
+    if isinstance(err, sa.exc.DBAPIError) and str(err.orig).strip():
+        return str(err.orig).strip().splitlines()[0]
+    return str(err).strip() or type(err).__name__
+
+
+def backup_job(job, options):
+    """Back up a job's database to a temporary file, moved to the output path once complete"""
+    job.output.parent.mkdir(parents=True, exist_ok=True)
+    partial = job.output.with_name(f'.{job.output.name}.partial')
+    try:
+        with partial.open('wb') as fp:
+            core.backup(fp, dbname=job.dbname, **connection_params(job.server), **options)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    partial.replace(job.output)
+
+
+def run(jobs, options=None, concurrency=4, per_host=1, retries=2, retry_delay=30, backup=None):
+    """Run the jobs, largest first, within a global and a per host concurrency limit
+
+    :param jobs: the `FleetJob`s to run, in order of priority. Failed ones are left as they are.
+    :param options: keyword arguments for `worek.backup`
+    :param per_host: the default number of backups running at once per server, a server's
+        `per_host` setting overrides it
+    :param retries: the number of times a backup failing with a transient error is retried
+    :param retry_delay: the number of seconds to wait before retrying
+    :param backup: the callable running a job, `backup_job` by default
+    :return: the jobs, with their status, attempts, durations and errors
+    """
+    backup = backup or backup_job
+    options = options or {}
+    pending = [x for x in jobs if x.status == 'pending']
+    running = {}
+    per_host_running = {}
+
+    def start(executor, job):
+        job.attempts += 1
+        per_host_running[job.host] = per_host_running.get(job.host, 0) + 1
+        started = time.monotonic()
+
+        def call():
+            try:
+                backup(job, options)
+            finally:
+                job.duration = time.monotonic() - started
+
+        running[executor.submit(call)] = job
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while pending or running:
+            now = time.monotonic()
+            for job in list(pending):
+                if len(running) >= concurrency:
+                    break
+                limit = job.server.get('per_host', per_host)
+                if job.not_before > now or per_host_running.get(job.host, 0) >= limit:
+                    continue
+                pending.remove(job)
+                start(executor, job)
+
+            if not running:
+                # only retries waiting for their delay are left
+                time.sleep(max(min(x.not_before for x in pending) - now, 0))
+                continue
+
+            waiting = [x.not_before - now for x in pending if x.not_before > now]
+            done, _ = wait(running, timeout=min(waiting, default=None), return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                per_host_running[job.host] -= 1
+                err = future.exception()
+                if err is None:
+                    job.status, job.error = 'done', None
+                    log.info('Backed up %s/%s in %.1fs', job.host, job.dbname, job.duration)
+                    continue
+
+                job.error = describe_error(err)
+                if is_transient(err) and job.attempts <= retries:
+                    log.warning('Retrying %s/%s: %s', job.host, job.dbname, job.error)
+                    job.not_before = time.monotonic() + retry_delay
+                    pending.append(job)
+                    pending.sort(key=lambda x: x.size, reverse=True)
+                else:
+                    log.error('Backup of %s/%s failed: %s', job.host, job.dbname, job.error)
+                    job.status = 'failed'
+
+    return jobs
+
+
+def summary(jobs):
+    """Return a table of the jobs' results, one line per database"""
+    lines = [f'{"STATUS":<8} {"HOST":<24} {"DATABASE":<24} {"SIZE":>10} {"TIME":>9} TRIES']
+    for job in jobs:
+        lines.append(
+            f'{job.status:<8} {job.host:<24} {job.dbname:<24} {job.size / 1024**2:>8.1f}MB'
+            f' {job.duration or 0:>8.1f}s {job.attempts:>5}'
+            + (f'  {job.error}' if job.status == 'failed' else ''),
+        )
+
+    failed = sum(x.status == 'failed' for x in jobs)
+    total = sum(x.duration or 0 for x in jobs)
+    lines.append(f'{len(jobs) - failed} of {len(jobs)} backed up, {total:.1f}s of backups')
+    return '\n'.join(lines)
+
+
+def backup_fleet(config, backup=None):
+    """Plan and run the backups of a fleet config, see the module docs for its format
+
+    :return: the `FleetJob`s, largest database first
+    """
+    retries = config.get('retries', 2)
+    retry_delay = config.get('retry_delay', 30)
+    return run(
+        plan(config, retries=retries, retry_delay=retry_delay),
+        options=config.get('backup', {}),
+        concurrency=config.get('concurrency', 4),
+        per_host=config.get('per_host', 1),
+        retries=retries,
+        retry_delay=retry_delay,
+        backup=backup,
+    )
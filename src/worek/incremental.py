@@ -0,0 +1,222 @@
+"""Incremental table-level backups
+
+An incremental backup is a tar stream holding a `Manifest` followed by a custom format dump. The
+dump always has the full schema, sequence values and large objects, but only has the data of tables
+whose fingerprint changed since the parent backup. For every table the manifest records which
+backup of the chain holds its data, so a restore loads each table from the newest backup that
+dumped it.
+
+A chain starts with an incremental backup without a parent, which dumps every table.
+"""
+
+import dataclasses
+import io
+import logging
+import os
+from pathlib import Path
+import tarfile
+import tempfile
+
+from worek.dialects.postgres import toc_item
+from worek.exc import WorekOperationException
+from worek.manifest import Manifest
+from worek.utils import add_tar_member
+
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+DUMP_NAME = 'backup.dump'
+
+# The fingerprint fields compared when a table has no checksum
+STATS_FIELDS = ('relfilenode', 'inserted', 'updated', 'deleted')
+
+
+def table_changed(current, previous, stats_reset_changed=False):
+    """Return True if a table's data may have changed between two fingerprints
+
+    Checksums are compared when both fingerprints have one, otherwise the statistics are, unless
+    the statistics were reset in between.
+    """
+    if previous is None or current['columns'] != previous['columns']:
+        return True
+
+    if current.get('checksum') and previous.get('checksum'):
+        return current['checksum'] != previous['checksum']
+
+    if stats_reset_changed:
+        return True
+
+    return any(current[x] != previous[x] for x in STATS_FIELDS)
+
+
+def build_manifest(fingerprints, parent=None, **fields):
+    """Return the manifest of a new backup, deciding which tables need their data dumped
+
+    :param fingerprints: a list of `TableFingerprint`
+    :param parent: the `Manifest` of the parent backup, None to start a new chain
+    :param fields: other `Manifest` fields (e.g. `server_version`)
+    """
+    manifest = Manifest(
+        backup_type='incremental',
+        parent=parent.id if parent else None,
+        **fields,
+    )
+    stats_reset_changed = parent is not None and parent.stats_reset != manifest.stats_reset
+
+    for fingerprint in fingerprints:
+        current = dataclasses.asdict(fingerprint)
+        del current['schema'], current['table']
+
+        previous = parent.tables.get(fingerprint.name) if parent else None
+        changed = table_changed(
+            current,
+            previous and previous['fingerprint'],
+            stats_reset_changed,
+        )
+        manifest.tables[fingerprint.name] = {
+            'schema': fingerprint.schema,
+            'table': fingerprint.table,
+            'fingerprint': current,
+            'backup': manifest.id if changed else previous['backup'],
+        }
+
+    return manifest
+
+
+def backup(PG, buf, parent=None, checksums=False, jobs=None, compress_level=None):
+    """Create an incremental backup, only dumping the data of tables changed since `parent`
+
+    :param PG: the `Postgres` dialect to back up
+    :param buf: a binary writable stream for the backup
+    :param parent: the `Manifest` of the previous backup of the chain, None to start a new chain
+    :param checksums: fingerprint tables with a checksum of their rows too. Always done on a
+        standby, whose `pg_stat_user_tables` counters stay at zero whatever is replayed.
+    :param jobs: the number of tables to checksum concurrently
+    :param compress_level: pg_dump's compression level of the dump, 0 when the backup is
+        compressed afterwards
+    :return: the new `Manifest`
+    """
+    if not checksums and PG.is_in_recovery():
+        log.warning('The server is a standby without table statistics, checksumming the tables')
+        checksums = True
+
+    # the fingerprints are read before the dump, changes made while dumping show up next time
+    manifest = build_manifest(
+        PG.get_table_fingerprints(checksums=checksums, jobs=jobs),
+        parent,
+        server_version=PG.server_version,
+        schemas=list(PG.schemas),
+        stats_reset=PG.get_stats_reset(),
+    )
+    unchanged = [
+        (x['schema'], x['table']) for x in manifest.tables.values() if x['backup'] != manifest.id
+    ]
+    log.info(
+        'Dumping the data of %d of %d tables',
+        len(manifest.tables) - len(unchanged),
+        len(manifest.tables),
+    )
+
+    with tempfile.TemporaryFile(prefix='worek-') as dump:
+        PG.backup_binary(dump, exclude_table_data=unchanged, compress_level=compress_level)
+        dump_size = os.fstat(dump.fileno()).st_size
+        dump.seek(0)
+
+        manifest_data = manifest.to_json()
+        with tarfile.open(fileobj=buf, mode='w|') as archive:
+            add_tar_member(archive, MANIFEST_NAME, io.BytesIO(manifest_data), len(manifest_data))
+            add_tar_member(archive, DUMP_NAME, dump, dump_size)
+
+    return manifest
+
+
+def read_manifest(buf):
+    """Return the `Manifest` of an incremental backup, only reading the start of `buf`"""
+    manifest, _ = unpack(buf, None, wanted=())
+    return manifest
+
+
+def unpack(buf, directory, wanted=None):
+    """Read the manifest of an incremental backup and extract its dump into `directory`
+
+    :param buf: a binary readable stream of the backup
+    :param directory: the directory to extract the dump to
+    :param wanted: the backup ids whose dump is needed, the dump of any other backup isn't
+        extracted. By default it always is.
+    :return: a tuple of the `Manifest` and the path of the dump, or None if it wasn't extracted
+    """
+    with tarfile.open(fileobj=buf, mode='r|') as archive:
+        member = archive.next()
+        if member is None or member.name != MANIFEST_NAME:
+            raise WorekOperationException('The backup is not an incremental backup.')
+        manifest = Manifest.from_json(archive.extractfile(member).read())
+
+        if wanted is not None and manifest.id not in wanted:
+            return manifest, None
+
+        member = archive.next()
+        if member is None or member.name != DUMP_NAME:
+            raise WorekOperationException(f'Backup {manifest.id} is incomplete.')
+
+        path = Path(directory) / f'{manifest.id}.dump'
+        with path.open('wb') as dump:
+            reader = archive.extractfile(member)
+            while chunk := reader.read(1024 * 1024):
+                dump.write(chunk)
+
+    return manifest, path
+
+
+def table_data_lines(toc_lines, tables):
+    """Return the TOC lines which restore the data of the passed `(schema, table)` pairs"""
+    wanted = {f'TABLE DATA {schema} {table}' for schema, table in tables}
+    return [line for line in toc_lines if toc_item(line) in wanted]
+
+
+def restore(PG, buf, parents=(), jobs=None):
+    """Restore an incremental backup, loading unchanged tables from the backups of its chain
+
+    The schema, sequence values and the data dumped by the newest backup are restored from `buf`,
+    then the data of the other tables is loaded from the backup which last dumped them. Indexes and
+    constraints are only created once all the data is loaded.
+
+    :param PG: the `Postgres` dialect to restore to
+    :param buf: a binary readable stream of the newest backup of the chain
+    :param parents: binary readable streams of the older backups of the chain, in any order. Only
+        the backups holding data of the newest backup's tables are needed.
+    :param jobs: the number of parallel jobs used to load data and build indexes
+    :return: the `Manifest` of the restored backup
+    """
+    with tempfile.TemporaryDirectory(prefix='worek-') as tmpdir:
+        manifest, dump = unpack(buf, tmpdir)
+
+        tables = {}
+        for entry in manifest.tables.values():
+            tables.setdefault(entry['backup'], []).append((entry['schema'], entry['table']))
+
+        dumps = {}
+        for parent in parents:
+            parent_manifest, path = unpack(parent, tmpdir, wanted=tables.keys())
+            if path is not None:
+                dumps[parent_manifest.id] = path
+
+        missing = tables.keys() - dumps.keys() - {manifest.id}
+        if missing:
+            raise WorekOperationException(
+                f'The backups {", ".join(sorted(missing))} of the chain are needed for the'
+                ' restore.',
+            )
+
+        def restore_dump(path, **kwargs):
+            with path.open('rb') as fp:
+                PG.restore_binary(fp, **kwargs)
+
+        restore_dump(dump, section='pre-data')
+        restore_dump(dump, section='data', jobs=jobs)
+        for backup_id, path in dumps.items():
+            lines = table_data_lines(PG.get_archive_list(path), tables[backup_id])
+            restore_dump(path, section='data', jobs=jobs, use_list=lines)
+        restore_dump(dump, section='post-data', jobs=jobs)
+
+    return manifest
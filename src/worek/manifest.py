@@ -0,0 +1,89 @@
+import dataclasses
+import datetime as dt
+import json
+import os
+from pathlib import Path
+import uuid
+
+from worek import s3
+
+
+FORMAT_VERSION = 1
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def _new_id():
+    return uuid.uuid4().hex
+
+
+def _now():
+    return dt.datetime.now(dt.UTC).isoformat()
+
+
+@dataclasses.dataclass
+class Manifest:
+    """A description of a backup stored alongside it as JSON
+
+    `tables` maps each table's qualified name to a dict with its `schema`, `table`, the
+    `fingerprint` of its data and the id of the `backup` holding that data. `chunks` lists the ids
+    of the chunks of a backup stored in a repository, in order, and `size` is its size in bytes.
+
+    The manifest written next to a backup file also describes how it was made: its `file_format`,
+    `compress` codec, whether it is `encrypted`, the `pg_dump_version` and the `duration` of the
+    backup in seconds. Its `checksums` are a `worek.checksums.Checksums` as a dict.
+    """
+
+    backup_type: str
+    id: str = dataclasses.field(default_factory=_new_id)
+    parent: str | None = None
+    created: str = dataclasses.field(default_factory=_now)
+    server_version: str | None = None
+    schemas: list = dataclasses.field(default_factory=list)
+    stats_reset: str | None = None
+    tables: dict = dataclasses.field(default_factory=dict)
+    chunks: list = dataclasses.field(default_factory=list)
+    size: int | None = None
+    file_format: str | None = None
+    compress: str | None = None
+    encrypted: bool = False
+    pg_dump_version: str | None = None
+    duration: float | None = None
+    checksums: dict | None = None
+    format_version: int = FORMAT_VERSION
+
+    def to_json(self):
+        return json.dumps(dataclasses.asdict(self), indent=2, sort_keys=True).encode()
+
+    @classmethod
+    def from_json(cls, data):
+        values = json.loads(data)
+        if values.get('format_version', FORMAT_VERSION) > FORMAT_VERSION:
+            raise ValueError(f'Unsupported manifest format version {values["format_version"]}.')
+
+        fields = {x.name for x in dataclasses.fields(cls)}
+        return cls(**{k: v for k, v in values.items() if k in fields})
+
+    def save(self, target):
+        """Write the manifest to a path, an ``s3://bucket/key`` URL or a binary file"""
+        if s3.is_url(target):
+            s3.write_bytes(target, self.to_json())
+        elif isinstance(target, str | os.PathLike):
+            Path(target).write_bytes(self.to_json())
+        else:
+            target.write(self.to_json())
+
+    @classmethod
+    def load(cls, source):
+        """Read a manifest from a path, an ``s3://bucket/key`` URL or a binary file"""
+        if s3.is_url(source):
+            return cls.from_json(s3.read_bytes(source))
+        if isinstance(source, str | os.PathLike):
+            return cls.from_json(Path(source).read_bytes())
+        return cls.from_json(source.read())
+
+
+def manifest_path(backup_path):
+    """Return the path of the manifest written next to a backup, or its URL for a backup in S3"""
+    if s3.is_url(backup_path):
+        return f'{backup_path}{MANIFEST_SUFFIX}'
+    return Path(f'{os.fspath(backup_path)}{MANIFEST_SUFFIX}')
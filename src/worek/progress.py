@@ -0,0 +1,299 @@
+import collections
+import dataclasses
+import io
+import os
+import stat
+import threading
+import time
+
+from worek.streams import TailWriter, has_fileno
+
+
+# The number of seconds the current transfer rate is averaged over
+RATE_WINDOW = 5.0
+
+# The `--verbose` messages of pg_dump and pg_restore which name the item being worked on
+ITEM_PREFIXES = (
+    'dumping contents of table',
+    'creating',
+    'processing data for table',
+    'processing item',
+    'launching item',
+)
+
+
+@dataclasses.dataclass
+class ProgressStatus:
+    """A snapshot of the progress of a backup or restore
+
+    :ivar transferred: the number of bytes transferred so far
+    :ivar total: the number of bytes expected, if known. For backups this is the size of the
+        database, which a compressed backup is usually much smaller than, so it is only an estimate.
+    :ivar elapsed: the number of seconds since the start
+    :ivar rate: the bytes per second over the last few seconds
+    :ivar eta: the estimated number of seconds left, if the total is known
+    :ivar item: the item being backed up or restored, if known (e.g. 'creating INDEX "public.x"')
+    :ivar done: True for the final status
+    """
+
+    transferred: int
+    total: int | None
+    elapsed: float
+    rate: float
+    eta: float | None
+    item: str | None
+    done: bool = False
+
+
+class Progress:
+    """Thread safe counters of a running backup or restore which are reported to a callback
+
+    The callback is called with a `ProgressStatus` at most once every `interval` seconds, and once
+    more when the operation is finished. Once `start` is called a thread also reports every
+    `interval` seconds while nothing is transferred, e.g. while the server builds an index, until
+    `close` or `finish` is called. `position` may be set to a callable returning the bytes
+    transferred so far, for data a child process reads from a file without it passing through
+    `add`.
+    """
+
+    def __init__(self, callback=None, total=None, interval=1.0):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+
+        self.transferred = 0
+        self.item = None
+        self.position = None
+        self.started = time.monotonic()
+
+        self._lock = threading.Lock()
+        self._samples = collections.deque([(self.started, 0)])
+        self._reported = float('-inf')
+        self._report_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._timer = None
+
+    def start(self):
+        """Start reporting from a daemon thread, which runs until `close` or `finish`"""
+        if self.callback is None or self.interval <= 0 or self._timer is not None:
+            return
+        self._timer = threading.Thread(target=self._tick, name='worek-progress', daemon=True)
+        self._timer.start()
+
+    def close(self):
+        """Stop the thread reporting the progress, if it runs"""
+        self._stopped.set()
+        if self._timer is not None and self._timer is not threading.current_thread():
+            self._timer.join()
+
+    def add(self, size):
+        with self._lock:
+            self.transferred += size
+        self._maybe_report()
+
+    def set_item(self, item):
+        self.item = item
+        self._maybe_report()
+
+    def status(self, done=False):
+        position = self.position() if self.position is not None else None
+        now = time.monotonic()
+        with self._lock:
+            if position is not None:
+                self.transferred = max(self.transferred, position)
+            self._samples.append((now, self.transferred))
+            while len(self._samples) > 2 and now - self._samples[1][0] > RATE_WINDOW:
+                self._samples.popleft()
+            first_time, first_transferred = self._samples[0]
+            transferred = self.transferred
+
+        rate = (transferred - first_transferred) / (now - first_time) if now > first_time else 0.0
+        eta = None
+        if self.total and rate > 0:
+            eta = max(self.total - transferred, 0) / rate
+
+        return ProgressStatus(
+            transferred=transferred,
+            total=self.total,
+            elapsed=now - self.started,
+            rate=rate,
+            eta=eta,
+            item=self.item,
+            done=done,
+        )
+
+    def _maybe_report(self):
+        if self.callback is None:
+            return
+
+        with self._report_lock:
+            now = time.monotonic()
+            if now - self._reported < self.interval:
+                return
+            self._reported = now
+            self.callback(self.status())
+
+    def _tick(self):
+        delay = self.interval
+        while not self._stopped.wait(delay):
+            self._maybe_report()
+            # a report made by `add` in the meantime pushes the next one back
+            delay = max(self._reported + self.interval - time.monotonic(), 0.01)
+
+    def finish(self):
+        self.close()
+        if self.callback is not None:
+            with self._report_lock:
+                self.callback(self.status(done=True))
+
+
+class CountingWriter:
+    """A writer which counts the bytes written through it to `sink`
+
+    It has no file descriptor, so a child process writing to it is pumped through a pipe, which is
+    what lets the bytes be counted while the child runs.
+    """
+
+    def __init__(self, sink, progress):
+        self.sink = sink
+        self.progress = progress
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        written = self.sink.write(data)
+        self.progress.add(len(data))
+        return written
+
+    def flush(self):
+        if hasattr(self.sink, 'flush'):
+            self.sink.flush()
+
+
+class CountingReader:
+    """A reader which counts the bytes read through it from `stream`
+
+    A regular file is passed through: its name, file descriptor and position stay available, so
+    pg_restore can still be given the file itself rather than a pipe or a spooled copy. Its bytes
+    are then counted by how far the position of the file descriptor moved, which a child process
+    reading from it moves too. A child process given the path of the file opens it on its own, so
+    only the items of its verbose output are seen.
+    """
+
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+        self.is_file = remaining_size(stream) is not None
+        if self.is_file:
+            self._start = os.lseek(stream.fileno(), 0, os.SEEK_CUR)
+            progress.position = self._position
+
+    @property
+    def name(self):
+        return self.stream.name if self.is_file else None
+
+    def fileno(self):
+        if not self.is_file:
+            raise io.UnsupportedOperation('fileno')
+        return self.stream.fileno()
+
+    def seekable(self):
+        return self.is_file
+
+    def tell(self):
+        if not self.is_file:
+            raise io.UnsupportedOperation('tell')
+        return self.stream.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if not self.is_file:
+            raise io.UnsupportedOperation('seek')
+        return self.stream.seek(offset, whence)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        # the bytes of a file are counted by its position, which reading moved
+        self.progress.add(0 if self.is_file else len(data))
+        return data
+
+    def close(self):
+        self.stream.close()
+
+    def _position(self):
+        try:
+            return os.lseek(self.stream.fileno(), 0, os.SEEK_CUR) - self._start
+        except (OSError, ValueError):
+            # the file was closed
+            return None
+
+
+class StderrMonitor(TailWriter):
+    """A writer for the stderr of pg_dump or pg_restore running with `--verbose`
+
+    Each complete line naming an item sets the progress' current item. The last
+    `worek.streams.STDERR_TAIL_SIZE` bytes are kept for error messages.
+    """
+
+    def __init__(self, progress):
+        super().__init__()
+        self.progress = progress
+        self._partial = b''
+
+    def write(self, data):
+        super().write(data)
+
+        *lines, self._partial = (self._partial + data).split(b'\n')
+        for line in lines:
+            # e.g. "pg_restore: creating INDEX "public.users_email""
+            _, _, message = line.decode(errors='replace').partition(': ')
+            if message.startswith(ITEM_PREFIXES):
+                self.progress.set_item(message)
+
+        return len(data)
+
+
+def remaining_size(stream):
+    """Return the number of bytes left to read from a regular file, or None for other streams"""
+    if not has_fileno(stream):
+        return None
+
+    info = os.fstat(stream.fileno())
+    if not stat.S_ISREG(info.st_mode):
+        return None
+
+    try:
+        position = stream.tell()
+    except (AttributeError, OSError):
+        position = 0
+    return max(info.st_size - position, 0)
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+        size /= 1024
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+
+def format_status(status):
+    """Return a one line description of a `ProgressStatus` for a terminal"""
+    parts = [
+        format_bytes(status.transferred),
+        f'{format_bytes(status.rate)}/s',
+        f'elapsed {format_duration(status.elapsed)}',
+    ]
+    if status.eta is not None and not status.done:
+        parts.append(f'ETA {format_duration(status.eta)}')
+    if status.item and not status.done:
+        parts.append(status.item)
+    return '  '.join(parts)
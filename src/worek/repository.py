@@ -0,0 +1,288 @@
+"""A deduplicating backup repository
+
+Backups stored in a repository are split into chunks at content defined boundaries and each unique
+chunk is stored once, compressed, under the hash of its content. A backup is a `Manifest` listing
+its chunks in order. Since the boundaries only depend on the data around them, an insert or delete
+in one part of the backup only changes the chunks around it and the rest are shared with earlier
+backups, so the repository grows with the amount of change rather than the size of the database.
+
+Layout of a repository directory::
+
+    worek-repository.json       the repository's format version
+    backups/<id>.json           the manifest of each backup
+    chunks/<ab>/<hash>          the compressed chunks, fanned out by the first two hash digits
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import tempfile
+import zlib
+
+from worek.compression import compress_block, decompress_block
+from worek.exc import WorekOperationException
+from worek.manifest import Manifest
+from worek.streams import OrderedParallelWriter
+
+
+FORMAT_VERSION = 1
+CONFIG_NAME = 'worek-repository.json'
+
+# chunks are cut at the end of a line once they are MIN_CHUNK_SIZE bytes long, so that the end of
+# each COPY row is a candidate boundary, and are cut regardless once they reach MAX_CHUNK_SIZE
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# the number of bytes before a line end which decide if it is a boundary
+WINDOW_SIZE = 48
+
+
+class WorekRepositoryError(WorekOperationException):
+    pass
+
+
+def chunk_id(data):
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+class Repository:
+    """A directory of deduplicated backups"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    @classmethod
+    def open(cls, path, create=False):
+        """Open the repository at `path`
+
+        :param create: create the repository if it doesn't exist yet
+        """
+        repo = cls(path)
+        config = repo.path / CONFIG_NAME
+        if not config.exists():
+            if not create:
+                raise WorekRepositoryError(f'{path} is not a worek repository.')
+            repo.path.mkdir(parents=True, exist_ok=True)
+            (repo.path / 'backups').mkdir(exist_ok=True)
+            (repo.path / 'chunks').mkdir(exist_ok=True)
+            config.write_text(json.dumps({'format_version': FORMAT_VERSION}))
+
+        version = json.loads(config.read_text())['format_version']
+        if version > FORMAT_VERSION:
+            raise WorekRepositoryError(f'Unsupported repository format version {version}.')
+
+        return repo
+
+    def _chunk_path(self, key):
+        return self.path / 'chunks' / key[:2] / key
+
+    def _write_atomic(self, path, data):
+        """Write a file so that readers never see it partially written"""
+        path.parent.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix='.tmp-', delete=False) as fp:
+            fp.write(data)
+        Path(fp.name).replace(path)
+
+    def has_chunk(self, key):
+        return self._chunk_path(key).exists()
+
+    def put_chunk(self, data, codec='gzip', level=None):
+        """Store a chunk unless the repository already has it
+
+        :return: a tuple of the chunk's id and True if it was stored
+        """
+        key = chunk_id(data)
+        if self.has_chunk(key):
+            return key, False
+
+        self._write_atomic(self._chunk_path(key), compress_block(data, codec, level=level))
+        return key, True
+
+    def get_chunk(self, key):
+        """Return the content of a chunk, verifying it against its id"""
+        try:
+            data = decompress_block(self._chunk_path(key).read_bytes())
+        except FileNotFoundError as err:
+            raise WorekRepositoryError(f'Chunk {key} is missing from the repository.') from err
+        except (OSError, EOFError, zlib.error, WorekOperationException) as err:
+            raise WorekRepositoryError(f'Chunk {key} is corrupt.') from err
+
+        if chunk_id(data) != key:
+            raise WorekRepositoryError(f'Chunk {key} is corrupt.')
+        return data
+
+    def save_manifest(self, manifest):
+        self._write_atomic(self.path / 'backups' / f'{manifest.id}.json', manifest.to_json())
+
+    def load_manifest(self, backup_id=None):
+        """Return the manifest of a backup, by default the latest one"""
+        if backup_id is None:
+            manifests = self.manifests()
+            if not manifests:
+                raise WorekRepositoryError('The repository has no backups.')
+            return manifests[-1]
+
+        try:
+            return Manifest.from_json((self.path / 'backups' / f'{backup_id}.json').read_bytes())
+        except FileNotFoundError as err:
+            raise WorekRepositoryError(f'The repository has no backup {backup_id}.') from err
+
+    def manifests(self):
+        """Return the manifests of all the backups, oldest first"""
+        manifests = [
+            Manifest.from_json(path.read_bytes()) for path in (self.path / 'backups').glob('*.json')
+        ]
+        return sorted(manifests, key=lambda x: x.created)
+
+    def writer(self, manifest, codec='gzip', level=None, threads=None):
+        """Return a `ChunkWriter` adding a backup described by `manifest` to the repository"""
+        return ChunkWriter(self, manifest, codec=codec, level=level, threads=threads)
+
+    def reader(self, manifest, threads=None):
+        """Return a `ChunkReader` streaming the content of a backup"""
+        return ChunkReader(self, manifest.chunks, threads=threads)
+
+
+class _ChunkList(list):
+    """Collects the chunks written by a `ChunkWriter`, in order"""
+
+    def write(self, chunk):
+        if chunk is not None:
+            self.append(chunk)
+
+
+def find_boundary(buffer, start, previous, end):
+    """Return the end of the first line of `buffer[start:end]` which is a chunk boundary
+
+    A line end is a boundary when the hash of the bytes before it is below a threshold proportional
+    to the length of the line, so on average there is a boundary every `AVG_CHUNK_SIZE` bytes no
+    matter how long the lines are.
+
+    :param previous: the position of the line end before `start`, or -1
+    :return: a tuple of the boundary, or None if there isn't one, and the position of the last line
+        end looked at
+    """
+    while (newline := buffer.find(b'\n', start, end)) != -1:
+        window = buffer[max(previous + 1, newline - WINDOW_SIZE) : newline]
+        if zlib.crc32(window) * AVG_CHUNK_SIZE < (newline - previous) << 32:
+            return newline + 1, newline
+        previous = newline
+        start = newline + 1
+
+    return None, previous
+
+
+class ChunkWriter(OrderedParallelWriter):
+    """A writer which splits a stream into content defined chunks and stores them in a repository
+
+    Chunks are hashed, compressed and stored on a thread pool. Once the writer is closed, the
+    manifest lists the backup's chunks and is saved to the repository.
+    """
+
+    def __init__(self, repo, manifest, codec='gzip', level=None, threads=None):
+        super().__init__(_ChunkList(), threads=threads)
+        self.repo = repo
+        self.manifest = manifest
+        self.codec = codec
+        self.level = level
+
+        # where to look for the next boundary and the line end before it, if known yet
+        self._scan = MIN_CHUNK_SIZE
+        self._previous = None
+
+    def next_block(self, buffer):
+        end = min(len(buffer), MAX_CHUNK_SIZE)
+        if self._previous is None:
+            if self._scan >= end:
+                return None
+            self._previous = buffer.rfind(b'\n', 0, self._scan)
+
+        boundary, self._previous = find_boundary(buffer, self._scan, self._previous, end)
+        if boundary is None and len(buffer) >= MAX_CHUNK_SIZE:
+            boundary = MAX_CHUNK_SIZE
+
+        if boundary is None:
+            self._scan = max(self._scan, self._previous + 1)
+            return None
+
+        self._scan = MIN_CHUNK_SIZE
+        self._previous = None
+        return boundary
+
+    def transform(self, index, block, last):
+        if not block:
+            return None
+
+        key, stored = self.repo.put_chunk(block, codec=self.codec, level=self.level)
+        return key, len(block), stored
+
+    @property
+    def size(self):
+        """The number of bytes written so far"""
+        return sum(size for _, size, _ in self.sink)
+
+    @property
+    def stored_size(self):
+        """The number of bytes written so far which weren't in the repository already"""
+        return sum(size for _, size, stored in self.sink if stored)
+
+    def close(self):
+        if self._closed:
+            return
+
+        super().close()
+        self.manifest.chunks = [key for key, _, _ in self.sink]
+        self.manifest.size = self.size
+        self.repo.save_manifest(self.manifest)
+
+    def abort(self):
+        """Stop without saving the manifest, the chunks already stored are left in place"""
+        self._closed = True
+        self._executor.shutdown(cancel_futures=True)
+
+
+class ChunkReader(io.RawIOBase):
+    """A binary reader which streams chunks from a repository in order
+
+    Chunks are read, decompressed and verified ahead on a thread pool, at most `2 * threads` at a
+    time.
+    """
+
+    def __init__(self, repo, chunks, threads=None):
+        self.repo = repo
+        self.threads = threads or os.cpu_count() or 1
+        self._chunks = iter(chunks)
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._current = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while len(self._pending) < 2 * self.threads:
+            key = next(self._chunks, None)
+            if key is None:
+                return
+            self._pending.append(self._executor.submit(self.repo.get_chunk, key))
+
+    def readinto(self, buffer):
+        while not self._current:
+            self._fill()
+            if not self._pending:
+                return 0
+            self._current = memoryview(self._pending.popleft().result())
+
+        size = min(len(buffer), len(self._current))
+        buffer[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+        super().close()
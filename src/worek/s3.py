@@ -0,0 +1,411 @@
+"""Stream backups to and from S3 compatible object storage
+
+Backups given as ``s3://bucket/key`` URLs are uploaded while they are written, with a multipart
+upload whose parts are sent on a thread pool, and restored while they are downloaded, with parallel
+range requests reading ahead of the restore. So they never touch the local disk. The credentials,
+region and endpoint (e.g. ``AWS_ENDPOINT_URL=http://localhost:9000`` for MinIO) come from the
+usual boto3 configuration files and environment variables. Needs the `worek[s3]` extra.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import io
+import logging
+import time
+
+from worek.exc import WorekOperationException
+
+
+log = logging.getLogger(__name__)
+
+SCHEME = 's3://'
+
+# S3 takes at most 10,000 parts of at least 5 MiB, but the last one, per upload
+PART_SIZE = 16 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+# the part size doubles every this many parts, so the size of a backup has no practical limit
+PARTS_PER_SIZE = 1000
+
+# the size of the ranges downloaded by an `ObjectReader`
+RANGE_SIZE = 8 * 1024 * 1024
+
+
+class WorekS3Error(WorekOperationException):
+    pass
+
+
+def _boto3():
+    try:
+        return importlib.import_module('boto3'), importlib.import_module('botocore.exceptions')
+    except ImportError as err:
+        raise WorekS3Error(
+            'S3 backups require the boto3 package. Install it with `pip install worek[s3]`.',
+        ) from err
+
+
+def is_url(value):
+    """Return True if `value` is an ``s3://bucket/key`` URL"""
+    return isinstance(value, str) and value.startswith(SCHEME)
+
+
+def parse_url(url):
+    """Return the bucket and the key of an ``s3://bucket/key`` URL"""
+    bucket, _, key = url[len(SCHEME) :].partition('/')
+    if not bucket or not key:
+        raise WorekS3Error(f'{url} is not an S3 URL of an object, expecting s3://bucket/key.')
+    return bucket, key
+
+
+def client():
+    """Return an S3 client configured from the environment"""
+    boto3, _ = _boto3()
+    return boto3.client('s3')
+
+
+def retrying(call, what, retries=3, retry_delay=1.0):
+    """Return the result of `call()`, retrying failed S3 requests with an exponential backoff
+
+    :param what: what the request does for the error message, e.g. "upload part 3 of s3://b/k"
+    :raises WorekS3Error: when the last attempt failed
+    """
+    _, exceptions = _boto3()
+    for attempt in range(retries + 1):
+        try:
+            return call()
+        except (exceptions.BotoCoreError, exceptions.ClientError) as err:
+            if attempt == retries:
+                raise WorekS3Error(f'Could not {what}: {err}') from err
+            log.warning('Could not %s, retrying: %s', what, err)
+            time.sleep(retry_delay * 2**attempt)
+
+
+def write_bytes(url, data):
+    """Store `data` as the object at `url`"""
+    bucket, key = parse_url(url)
+    s3 = client()
+    retrying(lambda: s3.put_object(Bucket=bucket, Key=key, Body=data), f'upload {url}')
+
+
+def read_bytes(url):
+    """Return the content of the object at `url`"""
+    bucket, key = parse_url(url)
+    s3 = client()
+    return retrying(
+        lambda: s3.get_object(Bucket=bucket, Key=key)['Body'].read(),
+        f'download {url}',
+    )
+
+
+def exists(url):
+    """Return True if there is an object at `url`"""
+    bucket, key = parse_url(url)
+    _, exceptions = _boto3()
+    try:
+        client().head_object(Bucket=bucket, Key=key)
+    except exceptions.ClientError as err:
+        if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise WorekS3Error(f'Could not read {url}: {err}') from err
+    return True
+
+
+class MultipartWriter:
+    """A writable stream uploading everything written to it to `bucket`/`key`
+
+    The data is cut into parts which are uploaded `threads` at a time, each part retried on its own
+    when it fails. Writes block while all threads are busy, so at most `threads + 1` parts are held
+    in memory however fast the data is written. Data smaller than a part is sent with a single
+    request when the writer is closed.
+
+    The object only appears once the writer is closed. Use it as a context manager to abort the
+    upload, and delete the parts already uploaded, when the backup fails.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        key,
+        s3=None,
+        part_size=PART_SIZE,
+        threads=4,
+        retries=3,
+        retry_delay=1.0,
+    ):
+        if part_size < MIN_PART_SIZE:
+            raise WorekS3Error(f'S3 upload parts must be at least {MIN_PART_SIZE} bytes.')
+
+        self.bucket = bucket
+        self.key = key
+        self.s3 = s3 or client()
+        self.part_size = part_size
+        self.threads = threads
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.upload_id = None
+        self.parts = []
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._closed = False
+
+    @classmethod
+    def for_url(cls, url, **kwargs):
+        bucket, key = parse_url(url)
+        return cls(bucket, key, **kwargs)
+
+    @property
+    def url(self):
+        return f'{SCHEME}{self.bucket}/{self.key}'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def _next_part_size(self):
+        return self.part_size * 2 ** ((len(self.parts) + len(self._pending)) // PARTS_PER_SIZE)
+
+    def _retrying(self, call, what):
+        return retrying(call, what, retries=self.retries, retry_delay=self.retry_delay)
+
+    def _upload_part(self, number, data):
+        response = self._retrying(
+            lambda: self.s3.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                Body=data,
+            ),
+            f'upload part {number} of {self.url}',
+        )
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def _submit(self, data):
+        if self.upload_id is None:
+            response = self._retrying(
+                lambda: self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key),
+                f'start the upload of {self.url}',
+            )
+            self.upload_id = response['UploadId']
+
+        while len(self._pending) >= self.threads:
+            self.parts.append(self._pending.popleft().result())
+
+        number = len(self.parts) + len(self._pending) + 1
+        if number > MAX_PARTS:
+            raise WorekS3Error(f'{self.url} is too large for an S3 multipart upload.')
+        self._pending.append(self._executor.submit(self._upload_part, number, data))
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError(f'The upload of {self.url} is closed.')
+
+        self._buffer += data
+        while len(self._buffer) >= (size := self._next_part_size()):
+            part = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._submit(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Upload the remaining data and complete the upload, which creates the object"""
+        if self._closed:
+            return
+
+        try:
+            if self.upload_id is None:
+                data = bytes(self._buffer)
+                self._retrying(
+                    lambda: self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=data),
+                    f'upload {self.url}',
+                )
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                while self._pending:
+                    self.parts.append(self._pending.popleft().result())
+                self._retrying(
+                    lambda: self.s3.complete_multipart_upload(
+                        Bucket=self.bucket,
+                        Key=self.key,
+                        UploadId=self.upload_id,
+                        MultipartUpload={'Parts': self.parts},
+                    ),
+                    f'complete the upload of {self.url}',
+                )
+        except BaseException:
+            self.abort()
+            raise
+
+        self._closed = True
+        self._buffer.clear()
+        self._executor.shutdown()
+
+    def abort(self):
+        """Stop the upload and delete the parts uploaded so far, the object isn't created"""
+        if self._closed:
+            return
+        self._closed = True
+        self._buffer.clear()
+        self._executor.shutdown(cancel_futures=True)
+
+        if self.upload_id is not None:
+            try:
+                self._retrying(
+                    lambda: self.s3.abort_multipart_upload(
+                        Bucket=self.bucket,
+                        Key=self.key,
+                        UploadId=self.upload_id,
+                    ),
+                    f'abort the upload of {self.url}',
+                )
+            except WorekS3Error:
+                log.exception('The parts of %s are left in the bucket', self.url)
+
+
+class ObjectReader(io.RawIOBase):
+    """A seekable reader of the object at `bucket`/`key`, downloaded with parallel range requests
+
+    The object is fetched in `range_size` ranges, up to `threads` of them at once ahead of the
+    position being read, each retried on its own when it fails. Ranges are returned in order as
+    they complete, so the download overlaps with whatever reads the object and a slow request only
+    holds the reader up once it needs that range. At most `threads + 1` ranges are in memory.
+
+    Seeking within the range being read is free, seeking elsewhere drops the ranges read ahead.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        key,
+        s3=None,
+        range_size=RANGE_SIZE,
+        threads=8,
+        retries=3,
+        retry_delay=1.0,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.s3 = s3 or client()
+        self.range_size = range_size
+        self.threads = threads
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        head = self._retrying(
+            lambda: self.s3.head_object(Bucket=bucket, Key=key),
+            f'read {self.url}',
+        )
+        self.size = head['ContentLength']
+        # every range must come from the same version of the object
+        self.etag = head['ETag']
+
+        self.position = 0
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._next = 0
+        self._range = b''
+        self._range_start = 0
+
+    @classmethod
+    def for_url(cls, url, **kwargs):
+        bucket, key = parse_url(url)
+        return cls(bucket, key, **kwargs)
+
+    @property
+    def url(self):
+        return f'{SCHEME}{self.bucket}/{self.key}'
+
+    @property
+    def name(self):
+        return self.url
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        if start + offset < 0:
+            raise ValueError(f'Can not seek to {start + offset}, before the start of {self.url}.')
+        self.position = start + offset
+        return self.position
+
+    def _retrying(self, call, what):
+        return retrying(call, what, retries=self.retries, retry_delay=self.retry_delay)
+
+    def _download(self, start):
+        end = min(start + self.range_size, self.size) - 1
+
+        def download():
+            return self.s3.get_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Range=f'bytes={start}-{end}',
+                IfMatch=self.etag,
+            )['Body'].read()
+
+        data = self._retrying(download, f'download bytes {start}-{end} of {self.url}')
+        if len(data) != end - start + 1:
+            raise WorekS3Error(f'Got {len(data)} bytes of {self.url} at {start}, expecting more.')
+        return data
+
+    def _read_ahead(self):
+        while len(self._pending) < self.threads and self._next < self.size:
+            self._pending.append((self._next, self._executor.submit(self._download, self._next)))
+            self._next += self.range_size
+
+    def _next_range(self):
+        if not self._pending or self._pending[0][0] != self.position:
+            # a seek away from the ranges read ahead, start over from the new position
+            for _, future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._next = self.position
+
+        self._read_ahead()
+        self._range_start, future = self._pending.popleft()
+        self._range = future.result()
+        self._read_ahead()
+
+    def readinto(self, buffer):
+        """Fill `buffer` unless the end of the object is reached, like a regular file"""
+        size = 0
+        while size < len(buffer) and self.position < self.size:
+            offset = self.position - self._range_start
+            if not 0 <= offset < len(self._range):
+                self._next_range()
+                offset = 0
+
+            data = memoryview(self._range)[offset : offset + len(buffer) - size]
+            buffer[size : size + len(data)] = data
+            size += len(data)
+            self.position += len(data)
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(cancel_futures=True)
+            self._pending.clear()
+            self._range = b''
+        super().close()
@@ -0,0 +1,534 @@
+import contextlib
+import dataclasses
+import logging
+import os
+from pathlib import Path
+import tarfile
+import time
+
+import sqlalchemy as sa
+
+from worek import incremental, s3, toc
+from worek.checksums import DEFAULT_ALGORITHM, ChecksumWriter
+from worek.compression import (
+    MAGIC_SIZE,
+    DecompressingReader,
+    detect_compression,
+    open_compressor,
+)
+from worek.crypto import MAGIC, Decryptor, Encryptor, WorekEncryptionError, is_encrypted
+from worek.dialects import get_dialect
+import worek.dialects.postgres as pgdialect
+from worek.exc import WorekOperationException
+from worek.manifest import Manifest
+from worek.progress import CountingReader, CountingWriter, Progress, remaining_size
+from worek.repository import Repository
+from worek.streams import fan_out, sniff
+from worek.utils import binary_stream, first_tar_member
+
+
+log = logging.getLogger(__name__)
+
+
+class Session:
+    """A reusable handle for running many backups and restores against a database
+
+    Calling `worek.backup` or `worek.restore` creates a new engine and looks up the server version
+    and schemas every time. A session keeps a pooled engine open instead and fetches the server
+    version and non-system schemas in a single query, caching them for `cache_ttl` seconds. This
+    makes it a better fit for long running services that back up or restore over and over.
+
+    Sessions can be used as a context manager, the engine is disposed on exit.
+    """
+
+    def __init__(self, saengine=None, cache_ttl=60, dialect='postgres', **params):
+        """
+        :param saengine: an optional sqlalchemy engine, if this is passed, this will be used for
+            the session and other connection type parameters (e.g. driver, host, port) will be
+            ignored. The session won't dispose of an engine it didn't create.
+        :param cache_ttl: the number of seconds the server version and schemas are cached for
+        :param dialect: the name of the database dialect, see `worek.dialects.DIALECTS`
+        :param driver: the driver to use for connecting to the database
+        :param host: the host of the database server
+        :param port: the port of the database server
+        :param user: the user of the database server
+        :param password: the password of the database server
+        :param dbname: the database name to connect to
+        """
+        self.dialect = get_dialect(dialect)
+        self.owns_engine = saengine is None
+        self.engine = saengine or self.dialect.construct_engine_from_params(**params)
+        self.cache_ttl = cache_ttl
+
+        self._server_info = None
+        self._server_info_expires = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.owns_engine:
+            self.engine.dispose()
+
+    def server_info(self):
+        """Return the cached server version and schemas, refreshing them once they expire
+
+        Fetching the server info also checks that the database is reachable.
+
+        :return: a `worek.dialects.postgres.ServerInfo`
+        """
+        if self._server_info is None or time.monotonic() >= self._server_info_expires:
+            try:
+                self._server_info = self.dialect(self.engine).get_server_info()
+            except sa.exc.DBAPIError as err:
+                raise WorekOperationException("Can't connect to the database.") from err
+            self._server_info_expires = time.monotonic() + self.cache_ttl
+
+        return self._server_info
+
+    def invalidate(self):
+        """Drop the cached server info so it is fetched again on next use"""
+        self._server_info = None
+
+    def postgres(self, schemas=None, version=None, executor=None, progress=None):
+        """Return the session's dialect, a `Postgres` by default, sharing its engine and server info
+
+        :param schemas: schemas you want to restore or backup, by default all non-system schemas
+        :param version: the version of PG client executables to use
+        :param executor: the method for executing the PG commands, see `Postgres`
+        :param progress: a `worek.progress.Progress` to report the current item to
+        """
+        info = self.server_info()
+        return self.dialect(
+            self.engine,
+            schemas=list(schemas) if schemas else list(info.schemas),
+            executor=executor,
+            version=version,
+            server_version=info.version,
+            progress=progress,
+        )
+
+    def backup(
+        self,
+        backup_file,
+        backup_type='full',
+        file_format='c',
+        jobs=None,
+        compress=None,
+        compress_level=None,
+        compress_threads=None,
+        key=None,
+        parent=None,
+        checksums=False,
+        repo=None,
+        progress=None,
+        index=None,
+        manifest=None,
+        checksum_algorithm=DEFAULT_ALGORITHM,
+        schemas=None,
+        version=None,
+    ):
+        """Create backup of the database to the backup file
+
+        See `worek.backup` for the description of the parameters.
+        """
+        if repo is not None:
+            if manifest is not None:
+                raise WorekOperationException('Repository backups have manifests of their own.')
+            if backup_type != 'full' or file_format != 'c' or key is not None:
+                raise WorekOperationException(
+                    'Repository backups are always full, custom format and unencrypted backups.',
+                )
+            return self._backup_to_repository(
+                repo,
+                compress=compress,
+                compress_level=compress_level,
+                compress_threads=compress_threads,
+                progress=progress,
+                schemas=schemas,
+                version=version,
+            )
+
+        if backup_type not in ('full', 'incremental'):
+            raise NotImplementedError(
+                f'Got an unexpected backup_type. {backup_type} is not a valid type, expecting'
+                ' "full" or "incremental".',
+            )
+
+        if file_format not in ('c', 'd', 'n'):
+            raise NotImplementedError(
+                f'Got an unexpected file_format. {file_format} is not a valid type, expecting'
+                ' "c", "d" or "n".',
+            )
+
+        if backup_type == 'full':
+            if parent is not None:
+                raise WorekOperationException('Only incremental backups have a parent backup.')
+            if file_format == 'c' and jobs and jobs > 1:
+                raise WorekOperationException(
+                    'Parallel backups require the directory format (-F d) or the native format'
+                    ' (-F n).',
+                )
+        elif file_format != 'c':
+            raise WorekOperationException('Incremental backups use the custom format (-F c).')
+
+        if index is not None and (backup_type != 'full' or file_format != 'c' or compress or key):
+            raise WorekOperationException(
+                'Only full custom format backups without compression or encryption are indexed.',
+            )
+
+        parent_manifest = None
+        if parent is not None:
+            with contextlib.ExitStack() as stack:
+                parent_manifest = incremental.read_manifest(open_backup(stack, parent, key))
+
+        tracker = Progress(progress) if progress else None
+        PG = self.postgres(schemas=schemas, version=version, progress=tracker)
+
+        started = time.monotonic()
+        with contextlib.ExitStack() as outputs:
+            sink = open_outputs(outputs, backup_file)
+
+            # the backup is compressed before it is encrypted, encrypted data doesn't compress
+            writers = []
+            if manifest is not None:
+                # the checksums are those of the backup file, after compression and encryption
+                sink = summer = ChecksumWriter(
+                    binary_stream(sink),
+                    checksum_algorithm,
+                    threads=compress_threads,
+                )
+                writers.append(sink)
+            if index is not None:
+                sink = indexer = toc.IndexingWriter(binary_stream(sink))
+            if key is not None:
+                sink = Encryptor(binary_stream(sink), key, threads=compress_threads)
+                writers.append(sink)
+            if compress:
+                sink = open_compressor(
+                    binary_stream(sink),
+                    compress,
+                    level=compress_level,
+                    threads=compress_threads,
+                )
+                writers.append(sink)
+            if tracker:
+                # the output is counted before compression, to compare it with the database size
+                tracker.total = PG.get_database_size()
+                sink = CountingWriter(binary_stream(sink), tracker)
+                tracker.start()
+                outputs.callback(tracker.close)
+
+            # data compressed by pg_dump wouldn't compress again, only the in-process codec runs
+            dump_level = 0 if compress else None
+            try:
+                if backup_type == 'incremental':
+                    result = incremental.backup(
+                        PG,
+                        binary_stream(sink),
+                        parent=parent_manifest,
+                        checksums=checksums,
+                        jobs=jobs,
+                        compress_level=dump_level,
+                    )
+                elif file_format == 'c':
+                    result = PG.backup_binary(sink, compress_level=dump_level)
+                elif file_format == 'n':
+                    result = PG.backup_native(binary_stream(sink), jobs=jobs)
+                else:
+                    result = PG.backup_directory(sink, jobs=jobs, compress_level=dump_level)
+            finally:
+                # close the outermost writer first so its final output reaches the next one
+                for writer in reversed(writers):
+                    writer.close()
+
+        if index is not None:
+            indexer.finish().save(index)
+        if manifest is not None:
+            file_checksums = summer.finish()
+            if backup_type == 'incremental':
+                description = dataclasses.replace(result)
+            else:
+                description = Manifest(
+                    backup_type=backup_type,
+                    server_version=PG.server_version,
+                    schemas=list(PG.schemas),
+                )
+            description.size = file_checksums.size
+            description.file_format = file_format
+            description.compress = compress
+            description.encrypted = key is not None
+            description.pg_dump_version = PG.get_client_version()
+            description.duration = round(time.monotonic() - started, 3)
+            description.checksums = dataclasses.asdict(file_checksums)
+            description.save(manifest)
+        if tracker:
+            tracker.finish()
+        return result
+
+    def _backup_to_repository(
+        self,
+        repo,
+        compress=None,
+        compress_level=None,
+        compress_threads=None,
+        progress=None,
+        schemas=None,
+        version=None,
+    ):
+        """Back up to a deduplicating repository, see `worek.repository`
+
+        The dump is uncompressed so that unchanged data produces identical chunks, the chunks
+        are compressed as they are stored instead.
+        """
+        if not isinstance(repo, Repository):
+            repo = Repository.open(repo, create=True)
+
+        tracker = Progress(progress) if progress else None
+        PG = self.postgres(schemas=schemas, version=version, progress=tracker)
+        manifest = Manifest(
+            backup_type='full',
+            server_version=PG.server_version,
+            schemas=list(PG.schemas),
+        )
+        writer = repo.writer(
+            manifest,
+            codec=compress or 'gzip',
+            level=compress_level,
+            threads=compress_threads,
+        )
+
+        sink = writer
+        if tracker:
+            tracker.total = PG.get_database_size()
+            sink = CountingWriter(writer, tracker)
+            tracker.start()
+
+        try:
+            PG.backup_binary(sink, compress_level=0)
+        except BaseException:
+            if tracker:
+                tracker.close()
+            writer.abort()
+            raise
+        writer.close()
+
+        if tracker:
+            tracker.finish()
+
+        log.info(
+            'Backup %s stored %d of %d bytes in the repository',
+            manifest.id,
+            writer.stored_size,
+            writer.size,
+        )
+        return manifest
+
+    def restore(
+        self,
+        restore_file,
+        file_format=None,
+        clean_existing_database=True,
+        jobs=None,
+        clean_jobs=None,
+        key=None,
+        parents=(),
+        repo=None,
+        backup_id=None,
+        progress=None,
+        index=None,
+        tables=(),
+        exclude_tables=(),
+        schemas=None,
+        version=None,
+    ):
+        """Restore a backup file to the database
+
+        See `worek.restore` for the description of the parameters.
+        """
+        if repo is not None:
+            if not isinstance(repo, Repository):
+                repo = Repository.open(repo)
+            with contextlib.closing(repo.reader(repo.load_manifest(backup_id))) as reader:
+                return self.restore(
+                    reader,
+                    file_format='c',
+                    clean_existing_database=clean_existing_database,
+                    jobs=jobs,
+                    clean_jobs=clean_jobs,
+                    progress=progress,
+                    tables=tables,
+                    exclude_tables=exclude_tables,
+                    schemas=schemas,
+                    version=version,
+                )
+
+        if s3.is_url(restore_file):
+            with contextlib.closing(s3.ObjectReader.for_url(restore_file)) as reader:
+                return self.restore(
+                    reader,
+                    file_format=file_format,
+                    clean_existing_database=clean_existing_database,
+                    jobs=jobs,
+                    clean_jobs=clean_jobs,
+                    key=key,
+                    parents=parents,
+                    progress=progress,
+                    index=index,
+                    tables=tables,
+                    exclude_tables=exclude_tables,
+                    schemas=schemas,
+                    version=version,
+                )
+
+        if index is not None:
+            # only the header, the TOC and the data being restored are read, unless that's all
+            if file_format not in (None, 'c') or not getattr(restore_file, 'seekable', bool)():
+                raise WorekOperationException(
+                    'An index is only used with an uncompressed custom format backup file.',
+                )
+            if not isinstance(index, toc.ArchiveIndex):
+                index = toc.ArchiveIndex.load(index)
+            selected = toc.select_entries(
+                index.entries,
+                schemas or self.server_info().schemas,
+                tables,
+                exclude_tables,
+            )
+            wanted = {x.dump_id for x in selected if x.size}
+            if wanted != index.data_ids():
+                restore_file, file_format = index.reader(restore_file, wanted), 'c'
+
+        tracker = Progress(progress) if progress else None
+        if tracker and hasattr(restore_file, 'read'):
+            # the backup is counted as it is read, before it is decrypted and decompressed
+            tracker.total = remaining_size(restore_file)
+            restore_file = CountingReader(restore_file, tracker)
+
+        restore_file = decoded(restore_file, key=key)
+        if file_format is None and hasattr(restore_file, 'read'):
+            # the header is buffered and replayed, so this works on pipes without spooling them
+            header, restore_file = sniff(restore_file, tarfile.BLOCKSIZE)
+            if first_tar_member(header) == incremental.MANIFEST_NAME:
+                file_format = 'i'
+            else:
+                file_format = pgdialect.detect_format(header)
+
+        if file_format == 't' and jobs and jobs > 1:
+            raise WorekOperationException('Parallel restores are not available for text backups.')
+        if file_format == 't' and schemas:
+            raise WorekOperationException('Text backups are always restored with every schema.')
+        if (tables or exclude_tables) and file_format not in ('c', 'd'):
+            raise WorekOperationException(
+                'Tables can only be selected in custom and directory format backups.',
+            )
+
+        if parents and file_format != 'i':
+            raise WorekOperationException(
+                'Parent backups are only used to restore an incremental backup.',
+            )
+
+        PG = self.postgres(schemas=schemas, version=version, progress=tracker)
+
+        # restoring some tables leaves the rest of the database alone, only the tables are dropped
+        selection = {
+            'tables': tables,
+            'exclude_tables': exclude_tables,
+            'clean': bool(clean_existing_database and tables),
+        }
+
+        if tracker:
+            tracker.start()
+        try:
+            if clean_existing_database and not tables:
+                PG.clean_existing_database(parallel=clean_jobs)
+
+            # perform the restore
+            if file_format == 'c':
+                result = PG.restore_binary(restore_file, jobs=jobs, **selection)
+            elif file_format == 'd':
+                result = PG.restore_directory(restore_file, jobs=jobs, **selection)
+            elif file_format == 't':
+                result = PG.restore_text(restore_file)
+            elif file_format == 'n':
+                result = PG.restore_native(binary_stream(restore_file), jobs=jobs)
+            elif file_format == 'i':
+                with contextlib.ExitStack() as stack:
+                    result = incremental.restore(
+                        PG,
+                        binary_stream(restore_file),
+                        parents=[open_backup(stack, x, key) for x in parents],
+                        jobs=jobs,
+                    )
+            elif file_format is None:
+                result = PG.restore(restore_file, jobs=jobs)
+            else:
+                raise NotImplementedError(
+                    f'Got an unexpected file_format. {file_format} is not a valid type, expecting'
+                    ' "c", "d", "t", "n", "i", or nothing.',
+                )
+        finally:
+            if tracker:
+                tracker.close()
+            # the restore may have created new schemas
+            self.invalidate()
+
+        if tracker:
+            tracker.finish()
+        return result
+
+
+def open_outputs(stack, backup_file):
+    """Return a writer for `backup_file`, a destination of a backup or a list of them
+
+    ``s3://bucket/key`` URLs are uploaded, the uploads are completed when `stack` exits without an
+    error and aborted otherwise. Several destinations are all written at once by a
+    `worek.streams.fan_out`, without copying the backup for each of them when possible.
+
+    :param stack: a `contextlib.ExitStack` which closes the writers opened here
+    """
+    destinations = backup_file if isinstance(backup_file, list | tuple) else [backup_file]
+    sinks = [
+        stack.enter_context(s3.MultipartWriter.for_url(x)) if s3.is_url(x) else x
+        for x in destinations
+    ]
+    if len(sinks) == 1:
+        return sinks[0]
+    return stack.enter_context(fan_out([binary_stream(x) for x in sinks]))
+
+
+def open_backup(stack, source, key=None):
+    """Open a backup given as a path or a file-like object for reading, decoding it as needed
+
+    :param stack: a `contextlib.ExitStack` which closes the files opened here
+    """
+    if isinstance(source, str | os.PathLike):
+        source = stack.enter_context(Path(source).open('rb'))  # noqa: SIM115
+    return decoded(source, key=key)
+
+
+def decoded(restore_file, key=None):
+    """Return `restore_file`, wrapped in a decryptor and decompressor as its content requires
+
+    Only readable file-like objects are inspected, anything else (e.g. a file descriptor) is
+    returned unchanged.
+
+    :raises WorekEncryptionError: when the backup is encrypted and no key is given
+    """
+    if not hasattr(restore_file, 'read'):
+        return restore_file
+
+    header, restore_file = sniff(binary_stream(restore_file), max(len(MAGIC), MAGIC_SIZE))
+    if is_encrypted(header):
+        if key is None:
+            raise WorekEncryptionError('The backup is encrypted, a key is needed to restore it.')
+        restore_file = Decryptor(restore_file, key)
+        header, restore_file = sniff(restore_file, MAGIC_SIZE)
+
+    codec = detect_compression(header)
+    if codec is None:
+        return restore_file
+    return DecompressingReader(restore_file, codec)
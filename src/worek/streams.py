@@ -0,0 +1,507 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import ctypes
+import errno
+import fcntl
+import io
+import os
+import stat
+import subprocess
+import sys
+import threading
+
+
+# The size of the chunks copied between Python streams and the pipes of child processes
+CHUNK_SIZE = 1024 * 1024
+
+# The size of the blocks processed by an `OrderedParallelWriter`
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# The amount of a child process' stderr kept for error messages
+STDERR_TAIL_SIZE = 64 * 1024
+
+# The capacity asked for the pipes of a `fan_out`, the size of the data duplicated at once
+FAN_OUT_PIPE_SIZE = 1024 * 1024
+
+
+def has_fileno(stream):
+    """Return True if `stream` is backed by an OS file descriptor a child process can use"""
+    try:
+        stream.fileno()
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return False
+    return True
+
+
+def needs_pump(stream):
+    """Return True if `stream` is a Python object that has to be pumped to/from a child process
+
+    Integers (file descriptors and `subprocess` constants like PIPE) and None are handled by
+    `subprocess` itself, as are objects with a real file descriptor.
+    """
+    return stream is not None and not isinstance(stream, int) and not has_fileno(stream)
+
+
+class _Pump(threading.Thread):
+    def __init__(self, copy):
+        super().__init__(daemon=True)
+        self.copy = copy
+        self.error = None
+
+    def run(self):
+        try:
+            self.copy()
+        except BrokenPipeError:
+            # the child exited without reading everything, its exit code tells what happened
+            pass
+        except BaseException as err:
+            self.error = err
+
+    def finish(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+@contextlib.contextmanager
+def pump_to(writer, chunk_size=CHUNK_SIZE):
+    """Yield a file descriptor for a child's output which is copied to `writer` on a thread
+
+    This allows any object with a `write` method (e.g. a compressor, an upload or a `BytesIO`) to
+    receive the output of a child process without holding all of it in memory.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def copy():
+        try:
+            while chunk := os.read(read_fd, chunk_size):
+                writer.write(chunk)
+        finally:
+            os.close(read_fd)
+
+    pump = _Pump(copy)
+    pump.start()
+    try:
+        yield write_fd
+    finally:
+        # the child has its own copy, closing ours lets the pump see the end of the output
+        os.close(write_fd)
+        pump.finish()
+
+
+@contextlib.contextmanager
+def pump_from(reader, chunk_size=CHUNK_SIZE):
+    """Yield a file descriptor for a child's input which is filled from `reader` on a thread
+
+    This allows any object with a `read` method (e.g. a decompressor or a download) to be the input
+    of a child process.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def copy():
+        try:
+            while chunk := reader.read(chunk_size):
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(write_fd, view) :]
+        finally:
+            os.close(write_fd)
+
+    pump = _Pump(copy)
+    pump.start()
+    try:
+        yield read_fd
+    finally:
+        # closing our copy of the read end makes the pump fail fast if the child stopped reading
+        os.close(read_fd)
+        pump.finish()
+
+
+def _load_tee():
+    """Return a wrapper of the tee(2) system call, which `os` doesn't expose, or None off Linux"""
+    if not sys.platform.startswith('linux') or not hasattr(os, 'splice'):
+        return None
+    try:
+        tee = ctypes.CDLL(None, use_errno=True).tee
+    except (OSError, AttributeError):
+        return None
+    tee.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint)
+    tee.restype = ctypes.c_ssize_t
+
+    def call(fd_in, fd_out, size):
+        while (result := tee(fd_in, fd_out, size, 0)) < 0:
+            code = ctypes.get_errno()
+            if code != errno.EINTR:
+                raise OSError(code, os.strerror(code))
+        return result
+
+    return call
+
+
+_tee = _load_tee()
+
+
+class FanOutWriter:
+    """A writer which writes everything written to it to each of `sinks`"""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        for sink in self.sinks:
+            sink.write(data)
+        return len(data)
+
+    def flush(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'flush'):
+                sink.flush()
+
+
+def _can_splice(fd):
+    """Return True if data can be spliced into `fd`: a file, pipe or socket not in append mode"""
+    mode = os.fstat(fd).st_mode
+    if not (stat.S_ISREG(mode) or stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)):
+        return False
+    return not fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND
+
+
+def _pipe_size(fd):
+    """Grow the capacity of the pipe `fd` to `FAN_OUT_PIPE_SIZE` if allowed, return its capacity"""
+    with contextlib.suppress(OSError):
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, FAN_OUT_PIPE_SIZE)
+    return fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+
+
+def _splice_all(fd_in, fd_out, size):
+    while size:
+        moved = os.splice(fd_in, fd_out, size)
+        if not moved:
+            raise EOFError('The pipe ended before the data duplicated from it was moved.')
+        size -= moved
+
+
+def _splice_copy(read_fd, fds):
+    """Copy the pipe `read_fd` to every one of `fds` without the data leaving the kernel
+
+    Each round, tee(2) duplicates the data waiting in the pipe into an empty pipe per extra sink,
+    then the copies and the original are spliced into their sinks.
+    """
+    *copies, last = fds
+    pipes = [os.pipe() for _ in copies]
+    try:
+        size = min(_pipe_size(x) for x in (read_fd, *(w for _, w in pipes)))
+        while not pipes and os.splice(read_fd, last, size):
+            pass
+        while pipes:
+            duplicated = None
+            for _, write_fd in pipes:
+                # the pipes are empty and at least as large as `size`, so all get the same data
+                duplicated = _tee(read_fd, write_fd, duplicated or size)
+                if not duplicated:
+                    return
+            for (pipe_fd, _), fd in zip(pipes, copies, strict=True):
+                _splice_all(pipe_fd, fd, duplicated)
+            _splice_all(read_fd, last, duplicated)
+    finally:
+        for pipe in pipes:
+            for fd in pipe:
+                os.close(fd)
+
+
+def _write_copy(read_fd, fds):
+    """Copy the pipe `read_fd` to every one of `fds`, reading each chunk once"""
+    while chunk := os.read(read_fd, CHUNK_SIZE):
+        for fd in fds:
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view) :]
+
+
+@contextlib.contextmanager
+def fan_out(sinks):
+    """Yield a binary file whose data is written to every one of `sinks`
+
+    The file is the write end of a pipe, so a child process can write to it directly. Sinks with a
+    file descriptor are written with the descriptor. On Linux, when all of them are files, pipes or
+    sockets, the data is duplicated with tee(2) and splice(2) without ever being copied to user
+    space. Otherwise each chunk is read once and written to every sink. Python sinks without a
+    file descriptor share a pipe, whose data is written to each of them on a thread.
+
+    :param sinks: binary writers, buffered data of file objects is flushed first
+    """
+    fds = []
+    others = []
+    for sink in sinks:
+        if has_fileno(sink):
+            sink.flush()
+            fds.append(sink.fileno())
+        else:
+            others.append(sink)
+
+    with contextlib.ExitStack() as stack:
+        if others:
+            fds.append(stack.enter_context(pump_to(FanOutWriter(others))))
+
+        read_fd, write_fd = os.pipe()
+        copy = _splice_copy if _tee is not None and all(map(_can_splice, fds)) else _write_copy
+
+        def pump_copy():
+            try:
+                copy(read_fd, fds)
+            finally:
+                os.close(read_fd)
+
+        pump = _Pump(pump_copy)
+        pump.start()
+        try:
+            with os.fdopen(write_fd, 'wb') as writer:
+                yield writer
+        finally:
+            pump.finish()
+
+
+class TailWriter:
+    """A writer which only keeps the last `size` bytes written to it"""
+
+    def __init__(self, size=STDERR_TAIL_SIZE):
+        self.size = size
+        self._tail = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._tail += data
+        del self._tail[: -self.size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tail(self):
+        return bytes(self._tail)
+
+
+def run(args, stdin=None, stdout=None, stderr=None, **kwargs):
+    """Run a child process like `subprocess.run`, with bounded memory whatever its streams are
+
+    Each stream may be anything `subprocess.Popen` takes or a Python file-like object (e.g. a
+    compressor, an upload or a `BytesIO`), which is pumped to or from the child in `CHUNK_SIZE`
+    chunks on a thread. PIPE has the meaning it has for `subprocess.run`, but stdin is then empty
+    and only the last `STDERR_TAIL_SIZE` bytes of stderr are kept. Only a stdout PIPE is captured
+    in full, it is meant for short outputs like listings.
+
+    The child is killed when waiting for it is interrupted, e.g. by a KeyboardInterrupt.
+
+    :param kwargs: passed to `subprocess.Popen`
+    :return: a `subprocess.CompletedProcess`
+    """
+    output = errors = None
+    if stdin == subprocess.PIPE:
+        stdin = subprocess.DEVNULL
+    if stdout == subprocess.PIPE:
+        stdout = output = io.BytesIO()
+    if stderr == subprocess.PIPE:
+        stderr = errors = TailWriter()
+
+    with contextlib.ExitStack() as stack:
+        if needs_pump(stdin):
+            stdin = stack.enter_context(pump_from(stdin))
+        if needs_pump(stdout):
+            stdout = stack.enter_context(pump_to(stdout))
+        if needs_pump(stderr):
+            stderr = stack.enter_context(pump_to(stderr))
+
+        process = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
+        try:
+            returncode = process.wait()
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+
+    return subprocess.CompletedProcess(
+        args,
+        returncode,
+        stdout=None if output is None else output.getvalue(),
+        stderr=None if errors is None else errors.tail(),
+    )
+
+
+class PrefixedReader(io.RawIOBase):
+    """A reader which returns `prefix` followed by the rest of `stream`
+
+    Used to put back bytes which had to be read from a non-seekable stream to inspect it.
+    """
+
+    def __init__(self, prefix, stream):
+        self.prefix = memoryview(prefix)
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            size = min(len(buffer), len(self.prefix))
+            buffer[:size] = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+            return size
+
+        data = self.stream.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+class RangeReader(io.RawIOBase):
+    """A reader which returns the `(start, end)` byte ranges of the seekable `stream`, in order
+
+    Used to read only the parts of a large file which are needed, e.g. with a backup's index.
+    """
+
+    def __init__(self, stream, ranges):
+        self.stream = stream
+        self.ranges = collections.deque(ranges)
+        self.position = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.ranges:
+            start, end = self.ranges[0]
+            if self.position is None:
+                self.position = self.stream.seek(start)
+            if self.position < end:
+                break
+            self.ranges.popleft()
+            self.position = None
+        else:
+            return 0
+
+        data = self.stream.read(min(len(buffer), end - self.position))
+        if not data:
+            raise EOFError(f'The stream ends at {self.position}, before the end of its range.')
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def sniff(stream, size):
+    """Return the first `size` bytes of `stream` without consuming them
+
+    :return: a tuple of the bytes read and the stream to continue reading from. For seekable
+        streams that is `stream` itself, rewound to where it was. Other streams are wrapped in a
+        `PrefixedReader` which returns the sniffed bytes again.
+    """
+    try:
+        seekable = stream.seekable()
+    except (AttributeError, ValueError):
+        seekable = False
+
+    if seekable and has_fileno(stream):
+        # read without moving the file position, a child process given the file descriptor would
+        # otherwise miss the header when the stream only seeked within its own buffer
+        return os.pread(stream.fileno(), size, stream.tell()), stream
+
+    if seekable:
+        position = stream.tell()
+        header = stream.read(size)
+        stream.seek(position)
+        return header, stream
+
+    header = b''
+    while len(header) < size and (data := stream.read(size - len(header))):
+        header += data
+    return header, PrefixedReader(header, stream)
+
+
+class OrderedParallelWriter:
+    """A writable stream which transforms blocks of data on a thread pool
+
+    Data written is split into `block_size` blocks, each block is passed to `transform` on a pool
+    of `threads` threads and the results are written to `sink` in the original order. At most
+    `2 * threads` blocks are in flight at once, so memory use stays bounded no matter how fast the
+    data is written.
+
+    Subclasses implement `transform(index, block, last)`. `last` is True only for the final block,
+    which is shorter than `block_size` or empty.
+    """
+
+    def __init__(self, sink, threads=None, block_size=BLOCK_SIZE):
+        self.sink = sink
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._index = 0
+        self._closed = False
+
+    def transform(self, index, block, last):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def writable(self):
+        return True
+
+    def _submit(self, block, last):
+        while len(self._pending) >= 2 * self.threads:
+            self.sink.write(self._pending.popleft().result())
+
+        self._pending.append(self._executor.submit(self.transform, self._index, block, last))
+        self._index += 1
+
+    def next_block(self, buffer):
+        """Return the size of the next block to cut from the start of `buffer`
+
+        Subclasses may override this to split the data differently, e.g. at content defined
+        boundaries. Whatever is left when the writer is closed is the last block.
+
+        :return: the size of the block or None to wait for more data
+        """
+        # a full block is only sent once more data arrives so the final block is always known
+        return self.block_size if len(buffer) > self.block_size else None
+
+    def write(self, data):
+        self._buffer += data
+
+        while (size := self.next_block(self._buffer)) is not None:
+            block = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._submit(block, last=False)
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Transform the remaining data and write all results to the sink
+
+        The sink itself is flushed but not closed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer.clear()
+            while self._pending:
+                self.sink.write(self._pending.popleft().result())
+            if hasattr(self.sink, 'flush'):
+                self.sink.flush()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
@@ -0,0 +1,613 @@
+"""A persisted index of the table of contents (TOC) of custom format backups
+
+pg_restore reads a custom format archive to list it, and to restore part of a backup it can't seek
+in (e.g. one coming from object storage) it reads everything in front of the data it needs. An
+index records every TOC entry with the byte offset and size of its data block, so a backup is listed
+without reading it and a restore only reads the header, the TOC and the data blocks it needs.
+
+The index is stored as JSON in a sidecar file named after the backup with `INDEX_SUFFIX` appended.
+It is built while a backup streams by (`IndexingWriter`) or from an existing backup
+(`index_archive`). The archive format is described in PostgreSQL's `pg_backup_archiver.c`.
+"""
+
+import dataclasses
+import fnmatch
+import hashlib
+import itertools
+import json
+import os
+from pathlib import Path
+
+from worek import s3
+from worek.exc import WorekOperationException
+from worek.streams import CHUNK_SIZE, PrefixedReader, RangeReader
+
+
+FORMAT_VERSION = 1
+INDEX_SUFFIX = '.toc.json'
+
+# the archive format versions which can be indexed, PostgreSQL 9.0 to 17
+MIN_ARCHIVE_VERSION = (1, 12)
+MAX_ARCHIVE_VERSION = (1, 16)
+
+ARCHIVE_CUSTOM = 1
+ARCHIVE_DIRECTORY = 5
+SECTIONS = {1: 'none', 2: 'pre-data', 3: 'data', 4: 'post-data'}
+
+# entries pg_restore handles itself and leaves out of its listing
+UNLISTED = ('ENCODING', 'STDSTRINGS', 'SEARCHPATH', 'DATABASE')
+
+# the entries matched by table patterns, and the entries which are restored with them
+RELATIONS = ('TABLE', 'VIEW', 'MATERIALIZED VIEW', 'SEQUENCE', 'FOREIGN TABLE')
+DEPENDENTS = (
+    'ACL',
+    'CHECK CONSTRAINT',
+    'COMMENT',
+    'CONSTRAINT',
+    'DEFAULT',
+    'FK CONSTRAINT',
+    'INDEX',
+    'INDEX ATTACH',
+    'MATERIALIZED VIEW DATA',
+    'POLICY',
+    'ROW SECURITY',
+    'RULE',
+    'SECURITY LABEL',
+    'SEQUENCE',
+    'SEQUENCE OWNED BY',
+    'SEQUENCE SET',
+    'STATISTICS',
+    'TABLE ATTACH',
+    'TABLE DATA',
+    'TRIGGER',
+)
+
+# the states of the data offset of a TOC entry
+OFFSET_NOT_SET = 1
+OFFSET_SET = 2
+OFFSET_NO_DATA = 3
+
+# the types of the data blocks following the TOC
+BLOCK_DATA = 1
+BLOCK_BLOBS = 3
+
+
+class WorekTocError(WorekOperationException):
+    pass
+
+
+@dataclasses.dataclass
+class TocEntry:
+    """An entry of the TOC of a custom format backup
+
+    :ivar offset: the position in the archive of the entry's data block, None without data
+    :ivar size: the size of the data block in bytes
+    """
+
+    dump_id: int
+    desc: str
+    tag: str
+    namespace: str | None = None
+    owner: str | None = None
+    section: str = 'none'
+    tableoid: int = 0
+    oid: int = 0
+    dependencies: list = dataclasses.field(default_factory=list)
+    offset: int | None = None
+    size: int = 0
+
+    def list_line(self):
+        """Return the entry's line as listed by `pg_restore -l`, usable with its `--use-list`"""
+        return (
+            f'{self.dump_id}; {self.tableoid} {self.oid} {self.desc}'
+            f' {_sanitize(self.namespace, "-")} {_sanitize(self.tag)} {_sanitize(self.owner)}'
+        )
+
+
+@dataclasses.dataclass
+class ArchiveIndex:
+    """The index of a custom format backup
+
+    :ivar archive_version: the version of the archive format, e.g. "1.15.0"
+    :ivar toc_size: the size of the header and TOC of the archive, its data blocks follow them
+    :ivar toc_digest: the SHA-256 of the header and TOC, to check the index matches a backup
+    :ivar size: the size of the archive in bytes
+    """
+
+    archive_version: str
+    dbname: str | None
+    server_version: str | None
+    dump_version: str | None
+    toc_size: int
+    toc_digest: str
+    size: int
+    entries: list = dataclasses.field(default_factory=list)
+    format_version: int = FORMAT_VERSION
+
+    def to_json(self):
+        return json.dumps(dataclasses.asdict(self), indent=2, sort_keys=True).encode()
+
+    @classmethod
+    def from_json(cls, data):
+        values = json.loads(data)
+        if values.get('format_version', FORMAT_VERSION) > FORMAT_VERSION:
+            raise WorekTocError(f'Unsupported index format version {values["format_version"]}.')
+
+        values['entries'] = [TocEntry(**x) for x in values.get('entries', [])]
+        fields = {x.name for x in dataclasses.fields(cls)}
+        return cls(**{k: v for k, v in values.items() if k in fields})
+
+    def save(self, target):
+        """Write the index to a path, an ``s3://bucket/key`` URL or a binary file"""
+        if s3.is_url(target):
+            s3.write_bytes(target, self.to_json())
+        elif isinstance(target, str | os.PathLike):
+            Path(target).write_bytes(self.to_json())
+        else:
+            target.write(self.to_json())
+
+    @classmethod
+    def load(cls, source):
+        """Read an index from a path, an ``s3://bucket/key`` URL or a binary file"""
+        if s3.is_url(source):
+            return cls.from_json(s3.read_bytes(source))
+        if isinstance(source, str | os.PathLike):
+            return cls.from_json(Path(source).read_bytes())
+        return cls.from_json(source.read())
+
+    def check(self, stream):
+        """Raise `WorekTocError` unless the seekable `stream` holds the backup this index describes
+
+        The position of `stream` is left unchanged.
+        """
+        position = stream.tell()
+        try:
+            size = stream.seek(0, os.SEEK_END)
+            stream.seek(0)
+            header = stream.read(self.toc_size)
+        finally:
+            stream.seek(position)
+
+        if size != self.size or hashlib.sha256(header).hexdigest() != self.toc_digest:
+            raise WorekTocError('The index does not match the backup, rebuild it with worek index.')
+
+    def data_ids(self, schemas=None):
+        """Return the dump ids of the entries with data, only those in `schemas` if given"""
+        return {
+            x.dump_id
+            for x in self.entries
+            if x.size and (schemas is None or x.namespace in schemas)
+        }
+
+    def ranges(self, dump_ids):
+        """Return the `(start, end)` byte ranges of the archive holding the header, the TOC and the
+        data of the `dump_ids` entries, in order and with adjacent ranges merged
+        """
+        entries = sorted(
+            (x for x in self.entries if x.dump_id in dump_ids and x.size),
+            key=lambda x: x.offset,
+        )
+        ranges = [(0, self.toc_size)]
+        for entry in entries:
+            if entry.offset == ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], entry.offset + entry.size)
+            else:
+                ranges.append((entry.offset, entry.offset + entry.size))
+        return ranges
+
+    def reader(self, stream, dump_ids):
+        """Return a reader of the backup in the seekable `stream` with only the data of `dump_ids`
+
+        pg_restore reads it like a backup coming from a pipe: it looks for the data blocks it
+        needs in order, so it must not need the data of an entry which isn't in `dump_ids`.
+        """
+        self.check(stream)
+        return RangeReader(stream, self.ranges(dump_ids))
+
+
+def index_path(backup_path):
+    """Return the path of the sidecar index of a backup, or its URL for a backup stored in S3"""
+    if s3.is_url(backup_path):
+        return f'{backup_path}{INDEX_SUFFIX}'
+    return Path(f'{os.fspath(backup_path)}{INDEX_SUFFIX}')
+
+
+def read_toc(stream):
+    """Read the TOC of the archive at the start of `stream` without consuming it
+
+    :return: a tuple of the `TocEntry`s, without data offsets, and the stream to read the archive
+        from. For seekable streams that is `stream` itself, moved back to where it was. Other
+        streams are wrapped in a `PrefixedReader` returning the header and TOC again.
+    """
+    try:
+        seekable = stream.seekable()
+    except (AttributeError, ValueError):
+        seekable = False
+
+    if seekable:
+        position = stream.tell()
+        try:
+            _, entries = _run(_parse_toc(_Archive()), stream)
+        finally:
+            stream.seek(position)
+        return [x for x, _ in entries], stream
+
+    recorder = _RecordingReader(stream)
+    _, entries = _run(_parse_toc(_Archive()), recorder)
+    return [x for x, _ in entries], PrefixedReader(bytes(recorder.data), stream)
+
+
+def select_entries(entries, schemas=None, tables=(), exclude_tables=()):
+    """Return the entries restoring the tables matching `tables` and the objects which go with them
+
+    Patterns are shell style globs matched against "schema.name", or just the name when they have
+    no dot. Relations (tables, views, sequences...) are matched, the objects which go with a table
+    are its data, indexes, constraints, triggers, column defaults, the sequences owned by its
+    columns and so on. A foreign key is only restored when the tables on both sides are.
+
+    Without `tables` every entry is returned but those of the relations matching `exclude_tables`,
+    and anything which depends on them.
+
+    :param schemas: only return the entries of these schemas
+    :return: the selected entries, in the order of `entries`
+    """
+    entries = [
+        x for x in entries if x.desc not in UNLISTED and (schemas is None or x.namespace in schemas)
+    ]
+    relations = [x for x in entries if x.desc in RELATIONS]
+    excluded = {x.dump_id for x in relations if _matches(x, exclude_tables)}
+
+    if tables:
+        picked = {x.dump_id for x in relations if _matches(x, tables)} - excluded
+        picked = _with_dependents(entries, picked, DEPENDENTS, all)
+        return [x for x in entries if x.dump_id in picked]
+
+    excluded = _with_dependents(entries, excluded, RELATIONS + DEPENDENTS, any)
+    return [x for x in entries if x.dump_id not in excluded]
+
+
+def _matches(entry, patterns):
+    name = f'{entry.namespace}.{entry.tag}'
+    return any(fnmatch.fnmatchcase(name if '.' in x else entry.tag, x) for x in patterns)
+
+
+def _with_dependents(entries, dump_ids, kinds, check):
+    """Return `dump_ids` with the ids of the entries of the `kinds` depending on them
+
+    An entry depends on the set when `check` (`all` or `any`) is true for its dependencies on
+    relations and their dependents, the others (schemas, types, functions) are left out.
+    """
+    dump_ids = set(dump_ids)
+    objects = {x.dump_id for x in entries if x.desc in RELATIONS + DEPENDENTS}
+
+    changed = True
+    while changed:
+        changed = False
+        for entry in entries:
+            if entry.dump_id in dump_ids or entry.desc not in kinds:
+                continue
+            dependencies = [x for x in entry.dependencies if x in objects]
+            if dependencies and check(x in dump_ids for x in dependencies):
+                dump_ids.add(entry.dump_id)
+                changed = True
+    return dump_ids
+
+
+def _sanitize(value, empty=''):
+    # like pg_restore, which puts each entry on a single line
+    return (value or '').replace('\n', ' ').replace('\r', ' ') or empty
+
+
+class _RecordingReader:
+    """A reader keeping a copy of everything read from `stream`"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.data = bytearray()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.data += data
+        return data
+
+
+class _Archive:
+    """The state of parsing an archive: the position and the sizes of its integers"""
+
+    def __init__(self):
+        self.position = 0
+        self.int_size = 4
+        self.offset_size = 8
+        self.digest = None
+
+
+# The parser is made of generators yielding `(size, skip)` requests for the next bytes of the
+# archive, so the same code parses a file it reads and a backup written through it. A driver sends
+# back the next `size` bytes (fewer at the end of the archive) or, when `skip` is True, the number
+# of bytes it discarded.
+
+
+def _read(archive, size):
+    data = yield size, False
+    if len(data) < size:
+        raise WorekTocError('The backup ends unexpectedly, it may be truncated.')
+    archive.position += size
+    if archive.digest is not None:
+        archive.digest.update(data)
+    return data
+
+
+def _skip(archive, size):
+    skipped = yield size, True
+    if skipped < size:
+        raise WorekTocError('The backup ends unexpectedly, it may be truncated.')
+    archive.position += size
+
+
+def _read_int(archive):
+    # a sign byte followed by the absolute value in little endian
+    data = yield from _read(archive, archive.int_size + 1)
+    value = int.from_bytes(data[1:], 'little')
+    return -value if data[0] else value
+
+
+def _read_str(archive):
+    size = yield from _read_int(archive)
+    if size < 0:
+        return None
+    return (yield from _read(archive, size)).decode(errors='replace')
+
+
+def _parse_toc(archive):
+    """Parse the header and the TOC of an archive
+
+    :return: a tuple of the header fields and a list of `(TocEntry, offset state)` pairs
+    """
+    archive.digest = hashlib.sha256()
+    if (yield from _read(archive, 5)) != b'PGDMP':
+        raise WorekTocError('The backup is not a custom format archive.')
+
+    version = tuple((yield from _read(archive, 3)))
+    if not MIN_ARCHIVE_VERSION <= version[:2] <= MAX_ARCHIVE_VERSION:
+        raise WorekTocError(f'Unsupported archive version {".".join(map(str, version))}.')
+
+    archive.int_size, archive.offset_size, archive_format = yield from _read(archive, 3)
+    if archive_format not in (ARCHIVE_CUSTOM, ARCHIVE_DIRECTORY):
+        raise WorekTocError('The backup is not a custom format archive.')
+
+    if version >= (1, 15):
+        yield from _read(archive, 1)  # the compression algorithm
+    else:
+        yield from _read_int(archive)  # the compression level
+    for _ in range(7):
+        yield from _read_int(archive)  # the creation time
+    header = {
+        'archive_version': '.'.join(map(str, version)),
+        'dbname': (yield from _read_str(archive)),
+        'server_version': (yield from _read_str(archive)),
+        'dump_version': (yield from _read_str(archive)),
+    }
+
+    entries = []
+    for _ in range((yield from _read_int(archive))):
+        dump_id = yield from _read_int(archive)
+        yield from _read_int(archive)  # whether the entry has data
+        tableoid = yield from _read_str(archive)
+        oid = yield from _read_str(archive)
+        tag = yield from _read_str(archive)
+        desc = yield from _read_str(archive)
+        section = yield from _read_int(archive)
+        yield from _read_str(archive)  # the definition
+        yield from _read_str(archive)  # the drop statement
+        yield from _read_str(archive)  # the copy statement
+        namespace = yield from _read_str(archive)
+        yield from _read_str(archive)  # the tablespace
+        if version >= (1, 14):
+            yield from _read_str(archive)  # the table access method
+        if version >= (1, 16):
+            yield from _read_int(archive)  # the relation kind
+        owner = yield from _read_str(archive)
+        yield from _read_str(archive)  # "with oids", no longer supported
+
+        dependencies = []
+        while (dependency := (yield from _read_str(archive))) is not None:
+            dependencies.append(int(dependency))
+
+        if archive_format == ARCHIVE_DIRECTORY:
+            # the data is in a file of its own
+            yield from _read_str(archive)
+            state, offset = OFFSET_NO_DATA, None
+        else:
+            state = (yield from _read(archive, 1))[0]
+            offset = int.from_bytes((yield from _read(archive, archive.offset_size)), 'little')
+        entry = TocEntry(
+            dump_id=dump_id,
+            desc=desc,
+            tag=tag,
+            namespace=namespace or None,
+            owner=owner or None,
+            section=SECTIONS.get(section, 'none'),
+            tableoid=int(tableoid or 0),
+            oid=int(oid or 0),
+            dependencies=dependencies,
+            offset=offset if state == OFFSET_SET else None,
+        )
+        entries.append((entry, state))
+
+    header['toc_size'] = archive.position
+    header['toc_digest'] = archive.digest.hexdigest()
+    archive.digest = None
+    return header, entries
+
+
+def _skip_chunks(archive):
+    while size := (yield from _read_int(archive)):
+        yield from _skip(archive, size)
+
+
+def _parse_blocks(archive, expected):
+    """Parse the data blocks following the TOC, until the `expected` number of blocks is found
+
+    pg_dump writing to a file through STDOUT appends the TOC with the data offsets after the data,
+    which is why the blocks aren't parsed to the end of the archive.
+
+    :return: a list of the `(dump_id, start, end)` of the blocks
+    """
+    blocks = []
+    while len(blocks) < expected:
+        start = archive.position
+        data = yield 1, False
+        if not data:
+            break
+
+        archive.position += 1
+        dump_id = yield from _read_int(archive)
+        if data[0] == BLOCK_DATA:
+            yield from _skip_chunks(archive)
+        elif data[0] == BLOCK_BLOBS:
+            while (yield from _read_int(archive)) != 0:  # the oid of the next large object
+                yield from _skip_chunks(archive)
+        else:
+            raise WorekTocError(f'Unexpected data block type {data[0]} at offset {start}.')
+        blocks.append((dump_id, start, archive.position))
+    return blocks
+
+
+def _build_index(header, entries, blocks, size):
+    blocks = {dump_id: (start, end) for dump_id, start, end in blocks}
+    for entry, _ in entries:
+        if entry.dump_id in blocks:
+            start, end = blocks[entry.dump_id]
+            entry.offset, entry.size = start, end - start
+        else:
+            entry.offset, entry.size = None, 0
+    return ArchiveIndex(size=size, entries=[x for x, _ in entries], **header)
+
+
+def _with_data(entries):
+    return [x for x, state in entries if state != OFFSET_NO_DATA]
+
+
+def _run(parser, stream, size=None):
+    """Drive a parser with the data read from `stream`, seeking over skipped data if `size` is
+    given, i.e. the stream is seekable
+    """
+    request = next(parser)
+    try:
+        while True:
+            count, skip = request
+            if skip and size is not None:
+                position = stream.tell()
+                request = parser.send(stream.seek(min(position + count, size)) - position)
+                continue
+
+            data = b''
+            while len(data) < count and (chunk := stream.read(min(count - len(data), CHUNK_SIZE))):
+                data += chunk
+            request = parser.send(len(data) if skip else data)
+    except StopIteration as stop:
+        return stop.value
+
+
+def index_archive(stream):
+    """Return the `ArchiveIndex` of the custom format archive read from `stream`, from its start
+
+    When the stream is seekable and pg_dump recorded the data offsets in the TOC, which it does
+    when writing to a regular file given with `--file`, only the header and TOC are read. Otherwise
+    the data blocks are walked, seeking over their content when possible.
+    """
+    try:
+        seekable = stream.seekable()
+    except (AttributeError, ValueError):
+        seekable = False
+
+    archive = _Archive()
+    if seekable:
+        stream.seek(0)
+    header, entries = _run(_parse_toc(archive), stream)
+    with_data = _with_data(entries)
+
+    if not seekable:
+        blocks = _run(_parse_blocks(archive, len(with_data)), stream)
+        size = archive.position
+        while data := stream.read(CHUNK_SIZE):
+            size += len(data)
+        return _build_index(header, entries, blocks, size)
+
+    size = stream.seek(0, os.SEEK_END)
+    if all(x.offset is not None for x in with_data):
+        # each block ends where the next one starts, the last one at the end of the archive
+        offsets = sorted(x.offset for x in with_data)
+        ends = dict(itertools.pairwise([*offsets, size]))
+        blocks = [(x.dump_id, x.offset, ends[x.offset]) for x in with_data]
+    else:
+        stream.seek(archive.position)
+        blocks = _run(_parse_blocks(archive, len(with_data)), stream, size)
+    return _build_index(header, entries, blocks, size)
+
+
+class IndexingWriter:
+    """A writer passing a custom format archive to `sink` while building its index
+
+    It has no file descriptor, so pg_dump writing to it is pumped through a pipe. Call `finish` once
+    the archive is complete to get its `ArchiveIndex`.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._archive = _Archive()
+        self._parser = self._parse()
+        self._request = next(self._parser)
+        self._buffer = bytearray()
+        self._skipped = 0
+        self._size = 0
+        self._parsed = None
+
+    def _parse(self):
+        header, entries = yield from _parse_toc(self._archive)
+        blocks = yield from _parse_blocks(self._archive, len(_with_data(entries)))
+        return header, entries, blocks
+
+    def _send(self, value):
+        try:
+            self._request = self._parser.send(value)
+        except StopIteration as stop:
+            self._request = None
+            self._parsed = stop.value
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        written = self.sink.write(data)
+        view = memoryview(data).cast('B')
+        self._size += len(view)
+        while view and self._request is not None:
+            count, skip = self._request
+            if skip:
+                size = min(count - self._skipped, len(view))
+                self._skipped += size
+                view = view[size:]
+                if self._skipped == count:
+                    self._skipped = 0
+                    self._send(count)
+            else:
+                size = min(count - len(self._buffer), len(view))
+                self._buffer += view[:size]
+                view = view[size:]
+                if len(self._buffer) == count:
+                    data, self._buffer = bytes(self._buffer), bytearray()
+                    self._send(data)
+        return written
+
+    def flush(self):
+        if hasattr(self.sink, 'flush'):
+            self.sink.flush()
+
+    def finish(self):
+        """Return the index of the archive written, which must be complete"""
+        if self._request is not None:
+            # the end of the archive
+            _, skip = self._request
+            self._send(self._skipped if skip else bytes(self._buffer))
+        return _build_index(*self._parsed, self._size)
@@ -1,5 +1,105 @@
+import contextlib
 import os
 from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+
+
+# The size of the buffer used when copying a stream into a temporary file
+SPOOL_BUFFER_SIZE = 1024 * 1024
+
+
+def binary_stream(buf):
+    """Return the binary stream underlying `buf`
+
+    Text streams (e.g. sys.stdout or a file opened with mode 'w') are flushed and their binary
+    buffer is returned so that raw backup bytes can be written to or read from them. Binary streams
+    are returned unchanged.
+    """
+    raw = getattr(buf, 'buffer', None)
+    if raw is None:
+        return buf
+
+    buf.flush()
+    return raw
+
+
+def pack_directory(directory, buf):
+    """Write the contents of `directory` to `buf` as an uncompressed tar stream
+
+    The tar is written in streaming mode so `buf` does not need to be seekable.
+    """
+    directory = Path(directory)
+    with tarfile.open(fileobj=binary_stream(buf), mode='w|') as tar:
+        for path in sorted(directory.iterdir()):
+            tar.add(path, arcname=path.name, recursive=False)
+
+
+def add_tar_member(archive, name, fileobj, size):
+    """Add `size` bytes read from `fileobj` to a tar archive as a regular file called `name`"""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    archive.addfile(info, fileobj)
+
+
+def first_tar_member(header):
+    """Return the name of the first member of the tar stream starting with `header`
+
+    :param header: at least the first 512 bytes of the stream
+    :return: the name or None if `header` isn't the start of a tar stream
+    """
+    try:
+        info = tarfile.TarInfo.frombuf(header[: tarfile.BLOCKSIZE], 'utf-8', 'surrogateescape')
+    except tarfile.HeaderError:
+        return None
+    return info.name
+
+
+def unpack_directory(buf, directory):
+    """Extract a tar stream created by `pack_directory` from `buf` into `directory`"""
+    with tarfile.open(fileobj=binary_stream(buf), mode='r|') as tar:
+        tar.extractall(directory, filter='data')
+
+
+def file_path(buf):
+    """Return the path of the regular file backing `buf` or None if it is not backed by one
+
+    Only files positioned at their start are considered, otherwise passing the path on to another
+    program would include data the caller has already consumed.
+    """
+    name = getattr(buf, 'name', None)
+    if not isinstance(name, str) or not Path(name).is_file():
+        return None
+
+    try:
+        if not buf.seekable() or buf.tell() != 0:
+            return None
+    except (AttributeError, OSError, ValueError):
+        return None
+
+    return name
+
+
+@contextlib.contextmanager
+def spooled_path(buf, buffer_size=SPOOL_BUFFER_SIZE):
+    """Yield a path to a seekable file with the contents of `buf`
+
+    When `buf` is a regular file its path is used directly. Otherwise (e.g. a pipe from openssl or
+    gzip) the stream is copied, `buffer_size` bytes at a time, into a temporary file which is
+    removed on exit.
+    """
+    path = file_path(buf)
+    if path is not None:
+        yield path
+        return
+
+    with tempfile.TemporaryDirectory(prefix='worek-') as tmpdir:
+        path = Path(tmpdir) / 'restore.backup'
+        with path.open('wb') as fp:
+            shutil.copyfileobj(binary_stream(buf), fp, buffer_size)
+        yield str(path)
 
 
 def latest_version(executable):
@@ -0,0 +1,164 @@
+"""Check a backup file without restoring it
+
+A backup is checked two ways. When it has a manifest, see `worek.manifest`, its chunks are hashed
+in parallel and compared with the checksums computed while it was written, which catches any
+change to the file. Its structure is checked by decoding it in full, which checks the
+authentication tags of an encrypted backup and the framing of a compressed one, while pg_restore
+lists the table of contents of the archive. No database is needed for either.
+"""
+
+import contextlib
+import dataclasses
+from pathlib import Path
+import tarfile
+import tempfile
+
+from worek.checksums import Checksums, WorekChecksumError, verify_file
+from worek.crypto import MAGIC, is_encrypted
+from worek.dialects.postgres import (
+    NATIVE_BLOBS_NAME,
+    NATIVE_SCHEMA_NAME,
+    NATIVE_TOC_NAME,
+    PostgresCLIError,
+    detect_format,
+    list_archive,
+)
+from worek.exc import WorekOperationException
+from worek.manifest import Manifest
+from worek.session import open_backup
+from worek.streams import BLOCK_SIZE, sniff
+from worek.utils import binary_stream
+
+
+@dataclasses.dataclass
+class VerifyResult:
+    """What `verify` found out about a backup
+
+    `checksummed` tells whether the file was checked against the checksums of a manifest and
+    `entries` is the number of items in the archive's table of contents, None when its structure
+    wasn't checked. `errors` describes every problem found, the backup is good without any.
+    """
+
+    path: str
+    size: int
+    file_format: str | None = None
+    checksummed: bool = False
+    entries: int | None = None
+    errors: list = dataclasses.field(default_factory=list)
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def verify(path, manifest=None, key=None, threads=None):
+    """Check the backup file at `path` against its manifest and list its archive
+
+    :param manifest: the `Manifest` of the backup, or the path of its JSON. Without it only the
+        structure of the backup is checked.
+    :param key: the key of an encrypted backup, whose structure isn't checked without it
+    :param threads: the number of chunks hashed at a time, by default one per CPU
+    :return: a `VerifyResult`
+    """
+    path = Path(path)
+    result = VerifyResult(path=str(path), size=path.stat().st_size)
+
+    if manifest is not None:
+        if not isinstance(manifest, Manifest):
+            manifest = Manifest.load(manifest)
+        result.file_format = manifest.file_format
+        if manifest.checksums is None:
+            result.errors.append('The manifest has no checksums of the backup.')
+        else:
+            _check_chunks(path, Checksums(**manifest.checksums), threads, result)
+
+    with contextlib.ExitStack() as stack:
+        fp = stack.enter_context(path.open('rb'))
+        header, fp = sniff(fp, len(MAGIC))
+        if is_encrypted(header) and key is None:
+            return result
+
+        try:
+            _check_structure(open_backup(stack, fp, key), result)
+        except Exception as err:
+            # the codecs have errors of their own, any of them means the backup is damaged
+            result.errors.append(f'The backup can not be read: {_describe(err)}')
+
+    return result
+
+
+def _check_chunks(path, checksums, threads, result):
+    try:
+        bad = verify_file(path, checksums, threads=threads)
+    except WorekChecksumError as err:
+        result.errors.append(str(err))
+        return
+
+    result.checksummed = True
+    for index in bad:
+        start, end = checksums.chunk_range(index)
+        result.errors.append(f'Chunk {index} (bytes {start}-{end}) does not match its checksum.')
+
+
+def _check_structure(stream, result):
+    header, stream = sniff(binary_stream(stream), tarfile.BLOCKSIZE)
+    file_format = detect_format(header)
+    result.file_format = result.file_format or file_format
+
+    if file_format == 'c':
+        result.entries = len(list_archive(stream))
+        # pg_restore stops after the TOC, the data is decoded to the end to check it can be
+        _drain(stream)
+    elif file_format == 'd':
+        result.entries = _list_directory(stream)
+    elif file_format == 'n':
+        result.entries = _list_native(stream)
+    else:
+        result.errors.append('The backup is not an archive worek can check.')
+
+
+def _list_directory(stream):
+    """List a directory format backup packed as a tar stream, which is read to the end"""
+    with (
+        tempfile.TemporaryDirectory(prefix='worek-') as tmpdir,
+        tarfile.open(fileobj=stream, mode='r|') as tar,
+    ):
+        # pg_restore only needs the TOC of a directory to list it
+        for member in tar:
+            if member.name == 'toc.dat':
+                tar.extract(member, tmpdir, filter='data')
+        if not (Path(tmpdir) / 'toc.dat').exists():
+            raise WorekOperationException('The directory backup has no toc.dat.')
+        return len(list_archive(tmpdir))
+
+
+def _list_native(stream):
+    """List the schema and large objects dumps of a native archive, which is read to the end"""
+    entries = None
+    blobs = 0
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            if member.name == NATIVE_SCHEMA_NAME:
+                schema = tar.extractfile(member)
+                entries = len(list_archive(schema))
+                _drain(schema)
+            elif member.name == NATIVE_BLOBS_NAME:
+                dump = tar.extractfile(member)
+                blobs = len(list_archive(dump))
+                _drain(dump)
+            elif member.name != NATIVE_TOC_NAME:
+                _drain(tar.extractfile(member))
+    if entries is None:
+        raise WorekOperationException('The native archive has no schema.')
+    return entries + blobs
+
+
+def _drain(stream):
+    while stream.read(BLOCK_SIZE):
+        pass
+
+
+def _describe(err):
+    if isinstance(err, PostgresCLIError):
+        return err.command_result.stderr.decode(errors='replace').strip()
+    return str(err) or type(err).__name__
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+import pytest
+import sqlalchemy as sa
+
+from worek import aio
+from worek.exc import WorekOperationException
+from worek_tests.conftest import DBNAME
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+class AsyncSink:
+    def __init__(self, block=None):
+        self.chunks = []
+        self.block = block
+
+    async def write(self, data):
+        self.chunks.append(data)
+        if self.block is not None:
+            await self.block.wait()
+
+
+async def replay(chunks):
+    for chunk in chunks:
+        await asyncio.sleep(0)
+        yield chunk
+
+
+class TestAsyncBackupRestore(PostgresDialectTestBase):
+    def drop_table(self, engine, table):
+        with engine.connect() as conn:
+            conn.execute(sa.text(f'DROP TABLE {table}'))
+            conn.commit()
+
+    def test_backup_and_restore_path(self, tmp_path, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'items')
+        backup_file = tmp_path / 'backup.dump'
+
+        asyncio.run(aio.backup(backup_file, dbname=DBNAME))
+        assert backup_file.read_bytes()[:5] == b'PGDMP'
+
+        self.drop_table(pg_clean_engine, 'items')
+        asyncio.run(aio.restore(backup_file, jobs=2, clean_jobs=2, dbname=DBNAME))
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*) FROM items')).scalar() == 0
+
+    def test_async_sink_and_source(self, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'items')
+        sink = AsyncSink()
+
+        async def run():
+            limit = asyncio.Semaphore(1)
+            await asyncio.gather(
+                aio.backup(sink, dbname=DBNAME, semaphore=limit),
+                aio.backup(AsyncSink(), dbname=DBNAME, semaphore=limit),
+            )
+
+            engine = aio.construct_engine_from_params(dbname=DBNAME)
+            async with engine.connect() as conn:
+                await conn.execute(sa.text('DROP TABLE items'))
+                await conn.commit()
+            await aio.restore(replay(sink.chunks), saengine=engine)
+            await engine.dispose()
+
+        asyncio.run(run())
+
+        assert b''.join(sink.chunks)[:5] == b'PGDMP'
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*) FROM items')).scalar() == 0
+
+    def test_cancel_kills_pg_dump(self, pg_clean_engine):
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('CREATE TABLE numbers AS SELECT generate_series(1, 500000) AS id'))
+            conn.commit()
+
+        async def run():
+            sink = AsyncSink(block=asyncio.Event())
+            task = asyncio.create_task(aio.backup(sink, compress_level=0, dbname=DBNAME))
+            while not sink.chunks:
+                await asyncio.sleep(0.01)
+
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+
+        # the server notices the killed pg_dump's connection is gone shortly after
+        sql = sa.text("SELECT count(*) FROM pg_stat_activity WHERE application_name = 'pg_dump'")
+        for _ in range(50):
+            with pg_clean_engine.connect() as conn:
+                if conn.execute(sql).scalar() == 0:
+                    break
+            time.sleep(0.1)
+        else:
+            pytest.fail('pg_dump is still connected')
+
+    def test_parallel_restore_needs_path(self):
+        with pytest.raises(WorekOperationException, match='given as a path'):
+            asyncio.run(aio.restore(replay([]), jobs=2, dbname=DBNAME))
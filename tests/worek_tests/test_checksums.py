@@ -0,0 +1,118 @@
+import hashlib
+import io
+import os
+from pathlib import Path
+
+from click.testing import CliRunner
+import pytest
+
+import worek
+from worek import checksums
+from worek.cli import cli
+from worek.manifest import Manifest, manifest_path
+from worek.verify import verify
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+class TestChecksums:
+    @pytest.mark.parametrize('algorithm', checksums.ALGORITHMS)
+    def test_writer(self, algorithm):
+        if algorithm == 'xxh3':
+            pytest.importorskip('xxhash')
+        data = os.urandom(100_000)
+        out = io.BytesIO()
+
+        writer = checksums.ChecksumWriter(out, algorithm, chunk_size=30_000, threads=3)
+        for start in range(0, len(data), 7_000):
+            writer.write(data[start : start + 7_000])
+        result = writer.finish()
+
+        assert out.getvalue() == data
+        assert result.size == len(data)
+        assert result.digest == checksums.digest(algorithm, data)
+        assert result.chunks == [
+            checksums.digest(algorithm, data[x : x + 30_000]) for x in range(0, len(data), 30_000)
+        ]
+        if algorithm == 'blake2b':
+            # the whole file digest is the one of b2sum
+            assert result.digest == hashlib.blake2b(data).hexdigest()
+
+    def test_verify_file(self, tmp_path):
+        data = os.urandom(10_000)
+        writer = checksums.ChecksumWriter(io.BytesIO(), chunk_size=1_000)
+        writer.write(data)
+        result = writer.finish()
+
+        path = tmp_path / 'backup'
+        path.write_bytes(data)
+        assert checksums.verify_file(path, result, threads=4) == []
+
+        corrupted = bytearray(data)
+        corrupted[4_321] ^= 1
+        path.write_bytes(corrupted)
+        assert checksums.verify_file(path, result, threads=4) == [4]
+
+        path.write_bytes(data[:-1])
+        with pytest.raises(checksums.WorekChecksumError, match='has 9999 bytes'):
+            checksums.verify_file(path, result)
+
+    def test_unknown_algorithm(self):
+        with pytest.raises(checksums.WorekChecksumError, match='Unknown checksum md5'):
+            checksums.ChecksumWriter(io.BytesIO(), 'md5')
+
+
+class TestVerify(PostgresDialectTestBase):
+    @pytest.mark.parametrize(('file_format', 'compress'), [('c', None), ('c', 'gzip'), ('n', None)])
+    def test_backup_manifest(self, tmp_path, pg_clean_engine, file_format, compress):
+        self.create_table(pg_clean_engine, 'items')
+        path = tmp_path / 'test.dump'
+
+        with path.open('wb') as fp:
+            worek.backup(
+                fp,
+                file_format=file_format,
+                compress=compress,
+                manifest=manifest_path(path),
+                saengine=pg_clean_engine,
+            )
+
+        manifest = Manifest.load(manifest_path(path))
+        assert manifest.size == path.stat().st_size
+        assert manifest.checksums['digest'] == hashlib.blake2b(path.read_bytes()).hexdigest()
+        assert manifest.file_format == file_format
+        assert manifest.compress == compress
+        assert manifest.pg_dump_version.startswith('pg_dump (PostgreSQL)')
+        assert manifest.server_version
+        assert 'public' in manifest.schemas
+        assert manifest.duration > 0
+
+        result = verify(path, manifest=manifest, threads=2)
+        assert result.ok, result.errors
+        assert result.checksummed
+        assert result.entries > 0
+
+    def test_cli_verify(self, tmp_path, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'items')
+        path = tmp_path / 'test.dump'
+        with path.open('wb') as fp:
+            worek.backup(fp, manifest=manifest_path(path), saengine=pg_clean_engine)
+
+        result = CliRunner().invoke(cli, ['verify', str(path)])
+        assert result.exit_code == 0, result.output
+        assert 'checksums: checked against the manifest' in result.output
+        assert 'TOC entries' in result.output
+
+        data = bytearray(path.read_bytes())
+        data[-10] ^= 1
+        path.write_bytes(data)
+        result = CliRunner().invoke(cli, ['verify', str(path)])
+        assert result.exit_code == 1
+        assert 'Chunk 0 (bytes 0-' in result.output
+
+    def test_verify_damaged_archive(self, tmp_path):
+        path = Path(tmp_path / 'test.dump')
+        path.write_bytes(b'PGDMP' + os.urandom(1000))
+
+        result = verify(path)
+        assert not result.checksummed
+        assert result.errors[0].startswith('The backup can not be read: pg_restore:')
@@ -1,9 +1,16 @@
+import contextlib
+import os
 from pathlib import Path
+import subprocess
+import sys
 
 from click.testing import CliRunner
 import sqlalchemy as sa
 
+from worek import toc
 from worek.cli import cli
+import worek.dialects.postgres as pgdialect
+from worek.dialects.postgres import Postgres as PG
 from worek_tests.helpers import PostgresDialectTestBase
 
 
@@ -53,3 +60,148 @@ class TestCLIPGBackup(PostgresDialectTestBase):
                 assert conn.execute(sa.text('SELECT * from manualtest'))
         except sa.exc.ProgrammingError as e:
             assert 'relation "manualtest" does not exist' in str(e)
+
+    def test_cli_backup_progress(self, tmpdir, pg_clean_engine):
+        backup_file = tmpdir.join('test.backup.bin').strpath
+
+        result = CliRunner().invoke(
+            cli,
+            [
+                'backup',
+                '--progress',
+                '-f',
+                backup_file,
+                *self.engine_to_cli_params(pg_clean_engine),
+            ],
+        )
+
+        assert result.exit_code == 0
+        assert 'elapsed 00:00:' in result.stderr
+        assert result.stderr.endswith('\n')
+
+    def test_cli_parallel_restore_progress_uses_the_file(
+        self,
+        tmpdir,
+        pg_clean_engine,
+        monkeypatch,
+    ):
+        self.create_table(pg_clean_engine, 'items')
+        backup_file = tmpdir.join('test.backup.bin').strpath
+        with Path(backup_file).open('wb') as fp:
+            PG(pg_clean_engine).backup_binary(fp)
+
+        # pg_restore is given the backup file itself, it isn't spooled to a temporary copy
+        spooled = []
+        spooled_path = pgdialect.spooled_path
+
+        @contextlib.contextmanager
+        def spy(buf):
+            with spooled_path(buf) as path:
+                spooled.append(path)
+                yield path
+
+        monkeypatch.setattr(pgdialect, 'spooled_path', spy)
+
+        result = CliRunner().invoke(
+            cli,
+            [
+                'restore',
+                '--progress',
+                '-j',
+                '2',
+                '-f',
+                backup_file,
+                *self.engine_to_cli_params(pg_clean_engine),
+            ],
+        )
+
+        assert result.exit_code == 0, result.output
+        assert spooled == [backup_file]
+        assert 'elapsed 00:00:' in result.stderr
+
+    def test_cli_backup_to_several_files(self, tmpdir, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'items')
+        one = Path(tmpdir.join('one.bin').strpath)
+        two = Path(tmpdir.join('two.bin').strpath)
+
+        result = CliRunner().invoke(
+            cli,
+            [
+                'backup',
+                '-f',
+                str(one),
+                '-f',
+                str(two),
+                '--index',
+                *self.engine_to_cli_params(pg_clean_engine),
+            ],
+        )
+
+        assert result.exit_code == 0, result.output
+        assert one.read_bytes()[:5] == b'PGDMP'
+        assert one.read_bytes() == two.read_bytes()
+        assert toc.index_path(one).exists()
+
+    def test_cli_restore_from_stdin_detects_format(self, tmpdir, pg_clean_engine):
+        backup_file = tmpdir.join('test.backup.sql').strpath
+        self.create_table(pg_clean_engine, 'piped')
+
+        with Path(backup_file).open('wb') as fp:
+            PG(pg_clean_engine).backup_text(fp)
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DROP TABLE piped'))
+            conn.commit()
+
+        result = CliRunner().invoke(
+            cli,
+            ['restore', *self.engine_to_cli_params(pg_clean_engine)],
+            input=Path(backup_file).read_bytes(),
+        )
+        assert result.exit_code == 0, result.output
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT * FROM piped')).fetchall() == []
+
+
+# `python -X importtime -c 'import worek.cli'` takes about 60ms, it was over 300ms when the CLI
+# imported SQLAlchemy and psycopg2 at load
+IMPORT_TIME_BUDGET_US = 150_000
+HEAVY_MODULES = ('sqlalchemy', 'psycopg2', 'worek.core', 'worek.dialects.postgres')
+
+
+class TestStartup:
+    def python(self, *args):
+        return subprocess.run(
+            [sys.executable, *args],
+            capture_output=True,
+            text=True,
+            check=True,
+            env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)},
+        )
+
+    def test_import_time(self):
+        # the best of a few runs, to leave out a slow start of the machine
+        times = []
+        for _ in range(3):
+            result = self.python('-X', 'importtime', '-c', 'import worek.cli')
+            line = next(x for x in result.stderr.splitlines() if x.endswith('| worek.cli'))
+            times.append(int(line.split('|')[1]))
+        assert min(times) < IMPORT_TIME_BUDGET_US
+
+    def test_help_does_not_import_the_database_code(self):
+        code = (
+            'import sys\n'
+            'from click.testing import CliRunner\n'
+            'from worek.cli import cli\n'
+            "for args in (['--help'], ['backup', '--help'], ['restore', '-e', 'mysql']):\n"
+            '    CliRunner().invoke(cli, args)\n'
+            'print(" ".join(sorted(sys.modules)))\n'
+        )
+        modules = self.python('-c', code).stdout.split()
+        assert not [x for x in modules if x.startswith(HEAVY_MODULES)]
+
+    def test_unknown_engine(self):
+        result = CliRunner().invoke(cli, ['restore', '-e', 'mysql'])
+        assert result.exit_code == 2
+        assert "Invalid value for '-e' / '--engine': 'mysql'" in result.output
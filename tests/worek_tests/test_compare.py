@@ -0,0 +1,130 @@
+from click.testing import CliRunner
+import pytest
+import sqlalchemy as sa
+from sqlalchemy import text
+
+from worek.cli import cli
+from worek.compare import compare
+from worek.dialects.postgres import Postgres as PG
+from worek_tests.conftest import DBNAME
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+COPY_DBNAME = f'{DBNAME}-copy'
+
+
+def execute(engine, *statements):
+    with engine.connect() as conn:
+        for sql in statements:
+            conn.execute(text(sql))
+        conn.commit()
+
+
+@pytest.fixture
+def pg_copy_engine(pg_clean_engine):
+    """Return a function copying the test database, which is dropped after the test"""
+    admin_engine = PG.construct_engine_from_params(dbname='postgres').execution_options(
+        isolation_level='AUTOCOMMIT',
+    )
+
+    def copy():
+        # a database can only be used as a template while nobody is connected to it
+        pg_clean_engine.dispose()
+        execute(
+            admin_engine,
+            f'DROP DATABASE IF EXISTS "{COPY_DBNAME}"',
+            f'CREATE DATABASE "{COPY_DBNAME}" TEMPLATE "{DBNAME}"',
+        )
+        return PG.construct_engine_from_params(dbname=COPY_DBNAME)
+
+    yield copy
+
+    execute(admin_engine, f'DROP DATABASE IF EXISTS "{COPY_DBNAME}" WITH (FORCE)')
+
+
+class TestCompare(PostgresDialectTestBase):
+    def fill(self, engine):
+        self.create_table(engine, 'items')
+        self.create_table(engine, 'orders')
+        self.create_table(engine, 'gone')
+        execute(
+            engine,
+            'INSERT INTO items SELECT generate_series(1, 1000)',
+            'INSERT INTO orders SELECT generate_series(1, 10)',
+        )
+
+    def test_compare(self, pg_clean_engine, pg_copy_engine):
+        self.fill(pg_clean_engine)
+        copy_engine = pg_copy_engine()
+
+        tables = compare(pg_clean_engine, copy_engine, jobs=2)
+        assert [(x.name, x.status, x.rows) for x in tables] == [
+            ('public.gone', 'ok', 0),
+            ('public.items', 'ok', 1000),
+            ('public.orders', 'ok', 10),
+        ]
+        assert all(x.matches for x in tables)
+
+        execute(
+            copy_engine,
+            'UPDATE items SET id = -id WHERE id = 500',
+            'DELETE FROM orders WHERE id = 1',
+            'DROP TABLE gone',
+            'CREATE TABLE extra (id integer)',
+        )
+        tables = compare(pg_clean_engine, copy_engine, jobs=2)
+        copy_engine.dispose()
+
+        assert {x.name: x.status for x in tables} == {
+            'public.extra': 'missing from the source',
+            'public.gone': 'missing from the target',
+            'public.items': 'data differs',
+            'public.orders': 'row counts differ',
+        }
+
+    def test_checksum_ignores_session_settings(self, pg_clean_engine):
+        execute(
+            pg_clean_engine,
+            'CREATE TABLE events (at timestamptz, took interval, ratio float8, data bytea)',
+            "INSERT INTO events VALUES (now(), '1 day 2 hours', 0.1, '\\x00ff')",
+        )
+        options = '-c TimeZone=Pacific/Auckland -c DateStyle=German -c IntervalStyle=iso_8601'
+        other_engine = sa.create_engine(
+            pg_clean_engine.url,
+            connect_args={'options': f'{options} -c extra_float_digits=-3 -c bytea_output=escape'},
+        )
+        try:
+            with other_engine.connect() as conn:
+                assert conn.execute(text('SHOW TimeZone')).scalar() == 'Pacific/Auckland'
+            checksum = PG(other_engine).get_table_checksum('public', 'events')
+        finally:
+            other_engine.dispose()
+
+        assert checksum == PG(pg_clean_engine).get_table_checksum('public', 'events')
+
+    def test_cli(self, pg_clean_engine, pg_copy_engine):
+        self.fill(pg_clean_engine)
+        copy_engine = pg_copy_engine()
+        execute(copy_engine, 'ALTER TABLE items ADD COLUMN name text')
+        copy_engine.dispose()
+
+        args = [
+            'compare',
+            '--source',
+            pg_clean_engine.url.render_as_string(hide_password=False),
+            '--target',
+            copy_engine.url.render_as_string(hide_password=False),
+        ]
+        result = CliRunner().invoke(cli, args)
+
+        assert result.exit_code == 1, result.output
+        assert 'columns differ           public.items\n' in result.output
+        assert 'ok                       public.orders  10 rows\n' in result.output
+        assert result.output.endswith('2 tables match, 1 differ\n')
+
+        result = CliRunner().invoke(cli, [*args, '-s', 'public', '-s', 'other', '-j', '1'])
+        assert result.exit_code == 1
+
+        result = CliRunner().invoke(cli, ['compare', '--source', 'sqlite://', '--target', 'x'])
+        assert result.exit_code == 1
+        assert 'Only Postgres databases can be compared' in result.output
@@ -0,0 +1,78 @@
+import io
+import os
+import subprocess
+
+import pytest
+
+from worek.compression import (
+    CODECS,
+    DecompressingReader,
+    WorekCompressionError,
+    detect_compression,
+    open_compressor,
+)
+from worek.streams import OrderedParallelWriter, sniff
+
+
+class TestCompression:
+    @pytest.mark.parametrize('codec', CODECS)
+    def test_compress_and_decompress(self, codec):
+        pytest.importorskip({'zstd': 'zstandard', 'lz4': 'lz4'}.get(codec, 'gzip'))
+        data = os.urandom(50_000) * 10 + b'worek' * 100_000
+        out = io.BytesIO()
+
+        compressor = open_compressor(out, codec, threads=4)
+        compressor.block_size = 64 * 1024
+        for start in range(0, len(data), 10_000):
+            compressor.write(data[start : start + 10_000])
+        compressor.close()
+
+        compressed = out.getvalue()
+        assert len(compressed) < len(data)
+        assert detect_compression(compressed[:4]) == codec
+        assert DecompressingReader(io.BytesIO(compressed), codec).read() == data
+
+    def test_detect_uncompressed(self):
+        assert detect_compression(b'PGDMP') is None
+
+    def test_unknown_codec(self):
+        with pytest.raises(WorekCompressionError, match='Unknown compression'):
+            open_compressor(io.BytesIO(), 'bzip2')
+
+
+class Upper(OrderedParallelWriter):
+    def transform(self, index, block, last):
+        return f'{index}{"!" if last else ""}:'.encode() + block.upper()
+
+
+class TestStreams:
+    def test_ordered_parallel_writer(self):
+        out = io.BytesIO()
+        with Upper(out, threads=3, block_size=2) as writer:
+            writer.write(b'abcde')
+            writer.write(b'f')
+
+        assert out.getvalue() == b'0:AB1:CD2!:EF'
+
+    def test_ordered_parallel_writer_empty(self):
+        out = io.BytesIO()
+        Upper(out).close()
+
+        assert out.getvalue() == b'0!:'
+
+    def test_sniff_seekable(self):
+        stream = io.BytesIO(b'PGDMP...')
+        header, result = sniff(stream, 5)
+
+        assert header == b'PGDMP'
+        assert result is stream
+        assert stream.read() == b'PGDMP...'
+
+    def test_sniff_non_seekable(self):
+        proc = subprocess.Popen(['echo', '-n', 'PGDMP...'], stdout=subprocess.PIPE)
+
+        with proc, proc.stdout as stream:
+            header, result = sniff(stream, 5)
+
+            assert header == b'PGDMP'
+            assert result.read() == b'PGDMP...'
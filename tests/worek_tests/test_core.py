@@ -1,8 +1,18 @@
+import gzip
+import io
+import os
 from pathlib import Path
+import re
+import subprocess
+import tarfile
 
+import pytest
 import sqlalchemy as sa
 
 import worek
+from worek.compression import detect_compression
+from worek.crypto import WorekEncryptionError, is_encrypted
+from worek.dialects.postgres import Postgres as PG
 from worek_tests.helpers import PostgresDialectTestBase
 
 
@@ -27,3 +37,137 @@ class TestCorePGBackup(PostgresDialectTestBase):
                 conn.execute(sa.text('SELECT * FROM should_be_removed;'))
         except sa.exc.ProgrammingError as e:
             assert 'relation "should_be_removed" does not exist' in str(e)
+
+    def test_backup_directory_format_with_jobs(self, tmpdir, pg_clean_engine):
+        backup_file = tmpdir.join('test.backup.tar').strpath
+        self.create_table(pg_clean_engine, 'should_be_restored')
+
+        with Path(backup_file).open('wb') as fp:
+            worek.backup(fp, file_format='d', jobs=2, saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DROP TABLE should_be_restored;'))
+            conn.commit()
+
+        with Path(backup_file).open('rb') as fp:
+            worek.restore(fp, file_format='d', saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT * FROM should_be_restored;')).fetchall() == []
+
+    def test_backup_encrypted_and_restore(self, tmpdir, pg_clean_engine):
+        pytest.importorskip('cryptography')
+        key = os.urandom(32).hex()
+        backup_file = tmpdir.join('test.backup.enc').strpath
+        self.create_table(pg_clean_engine, 'should_be_restored')
+
+        with Path(backup_file).open('wb') as fp:
+            worek.backup(fp, compress='gzip', key=key, saengine=pg_clean_engine)
+
+        with Path(backup_file).open('rb') as fp:
+            assert is_encrypted(fp.read(8))
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DROP TABLE should_be_restored;'))
+            conn.commit()
+
+        with Path(backup_file).open('rb') as fp, pytest.raises(WorekEncryptionError):
+            worek.restore(fp, saengine=pg_clean_engine)
+
+        with Path(backup_file).open('rb') as fp:
+            worek.restore(fp, key=key, saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT * FROM should_be_restored;')).fetchall() == []
+
+    def test_backup_custom_format_rejects_jobs(self, pg_clean_engine):
+        with pytest.raises(worek.core.WorekOperationException, match='directory format'):
+            worek.backup(io.BytesIO(), jobs=2, saengine=pg_clean_engine)
+
+    @pytest.mark.parametrize('codec', ['gzip', 'zstd'])
+    def test_backup_compressed_and_restore(self, tmpdir, pg_clean_engine, codec):
+        pytest.importorskip({'zstd': 'zstandard'}.get(codec, 'gzip'))
+        backup_file = tmpdir.join('test.backup.bin').strpath
+        self.create_table(pg_clean_engine, 'should_be_restored')
+
+        with Path(backup_file).open('wb') as fp:
+            worek.backup(fp, compress=codec, compress_threads=2, saengine=pg_clean_engine)
+
+        with Path(backup_file).open('rb') as fp:
+            assert detect_compression(fp.read(4)) == codec
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DROP TABLE should_be_restored;'))
+            conn.commit()
+
+        with Path(backup_file).open('rb') as fp:
+            worek.restore(fp, saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT * FROM should_be_restored;')).fetchall() == []
+
+    @pytest.mark.parametrize(
+        ('file_format', 'backup_type'),
+        [('c', 'full'), ('c', 'incremental'), ('d', 'full')],
+    )
+    def test_compressed_backup_has_uncompressed_dump(
+        self,
+        tmp_path,
+        pg_clean_engine,
+        file_format,
+        backup_type,
+    ):
+        self.create_table(pg_clean_engine, 'items')
+        backup = io.BytesIO()
+        worek.backup(
+            backup,
+            file_format=file_format,
+            backup_type=backup_type,
+            compress='gzip',
+            saengine=pg_clean_engine,
+        )
+
+        # pg_dump left the data to the in-process codec, it isn't compressed twice
+        data = gzip.decompress(backup.getvalue())
+        archive = tmp_path / 'backup.dump'
+        if file_format == 'c' and backup_type == 'full':
+            archive.write_bytes(data)
+        else:
+            with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                if file_format == 'd':
+                    assert not [x for x in tar.getnames() if x.endswith('.gz')]
+                    # pg_restore lists a directory backup from its toc.dat
+                    tar.extract('toc.dat', tmp_path, filter='data')
+                    archive = tmp_path
+                else:
+                    archive.write_bytes(tar.extractfile('backup.dump').read())
+        listing = subprocess.run(
+            ['pg_restore', '-l', str(archive)],
+            capture_output=True,
+            check=True,
+        ).stdout.decode()
+        assert re.search(r'^; +Compression: (none|0)$', listing, re.MULTILINE), listing
+
+    @pytest.mark.parametrize('file_format', ['c', 'd', 't'])
+    def test_restore_detects_format_from_pipe(self, tmpdir, pg_clean_engine, file_format):
+        backup_file = tmpdir.join('test.backup').strpath
+        self.create_table(pg_clean_engine, 'should_be_restored')
+
+        if file_format == 't':
+            sql = io.BytesIO()
+            PG(pg_clean_engine).backup_text(sql)
+            Path(backup_file).write_bytes(gzip.compress(sql.getvalue()))
+        else:
+            with Path(backup_file).open('wb') as fp:
+                worek.backup(fp, file_format=file_format, compress='gzip', saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DROP TABLE should_be_restored;'))
+            conn.commit()
+
+        # a pipe can't be seeked, the format is detected without spooling it
+        with subprocess.Popen(['cat', backup_file], stdout=subprocess.PIPE) as proc:
+            worek.restore(proc.stdout, saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT * FROM should_be_restored;')).fetchall() == []
@@ -0,0 +1,96 @@
+import base64
+import io
+import os
+
+import pytest
+
+from worek.crypto import (
+    HEADER,
+    MAGIC,
+    Decryptor,
+    Encryptor,
+    WorekEncryptionError,
+    is_encrypted,
+    load_key,
+    parse_key,
+)
+
+
+pytest.importorskip('cryptography')
+
+KEY = bytes(range(32))
+
+
+def encrypt(data, key=KEY, chunk_size=1024):
+    out = io.BytesIO()
+    with Encryptor(out, key, threads=4, chunk_size=chunk_size) as encryptor:
+        for start in range(0, len(data), 700):
+            encryptor.write(data[start : start + 700])
+    return out.getvalue()
+
+
+class TestEncryption:
+    @pytest.mark.parametrize('size', [0, 1024, 10_000])
+    def test_encrypt_and_decrypt(self, size):
+        data = os.urandom(size)
+        encrypted = encrypt(data)
+
+        assert is_encrypted(encrypted)
+        assert data not in encrypted or not data
+        assert Decryptor(io.BytesIO(encrypted), KEY, threads=2).read() == data
+
+    def test_wrong_key(self):
+        encrypted = encrypt(b'worek' * 1000)
+        with pytest.raises(WorekEncryptionError, match='Chunk 0'):
+            Decryptor(io.BytesIO(encrypted), bytes(32)).read()
+
+    def test_corrupted_chunk(self):
+        encrypted = bytearray(encrypt(os.urandom(5000)))
+        # flip a byte in the third chunk
+        encrypted[HEADER.size + 2 * (4 + 1024 + 16) + 10] ^= 1
+        with pytest.raises(WorekEncryptionError, match='Chunk 2'):
+            Decryptor(io.BytesIO(bytes(encrypted)), KEY).read()
+
+    def test_truncated(self):
+        encrypted = encrypt(os.urandom(5000))
+        frame_size = 4 + 1024 + 16
+        with pytest.raises(WorekEncryptionError, match='final chunk missing'):
+            Decryptor(io.BytesIO(encrypted[: HEADER.size + 2 * frame_size]), KEY).read()
+        with pytest.raises(WorekEncryptionError, match='truncated'):
+            Decryptor(io.BytesIO(encrypted[:-10]), KEY).read()
+
+    def test_trailing_data(self):
+        encrypted = encrypt(b'worek')
+        with pytest.raises(WorekEncryptionError, match='after the end'):
+            Decryptor(io.BytesIO(encrypted + encrypted), KEY).read()
+
+    def test_not_encrypted(self):
+        with pytest.raises(WorekEncryptionError, match='not encrypted'):
+            Decryptor(io.BytesIO(b'PGDMP' + bytes(100)), KEY)
+        assert not is_encrypted(b'PGDMP')
+        assert is_encrypted(MAGIC)
+
+
+class TestKeys:
+    def test_parse_key(self):
+        assert parse_key(KEY) == KEY
+        assert parse_key(KEY.hex()) == KEY
+        assert parse_key(KEY.hex().encode() + b'\n') == KEY
+        assert parse_key(base64.b64encode(KEY)) == KEY
+
+    def test_parse_key_wrong_size(self):
+        with pytest.raises(WorekEncryptionError, match='32 bytes'):
+            parse_key('abcd')
+
+    def test_load_key(self, tmp_path, monkeypatch):
+        key_file = tmp_path / 'backup.key'
+        key_file.write_text(KEY.hex() + '\n')
+        monkeypatch.setenv('WOREK_TEST_KEY', base64.b64encode(KEY).decode())
+
+        assert load_key(key_file=key_file) == KEY
+        assert load_key(key_env='WOREK_TEST_KEY') == KEY
+        assert load_key() is None
+
+        monkeypatch.delenv('WOREK_TEST_KEY')
+        with pytest.raises(WorekEncryptionError, match='not set'):
+            load_key(key_env='WOREK_TEST_KEY')
@@ -0,0 +1,157 @@
+from pathlib import Path
+import threading
+import time
+
+from click.testing import CliRunner
+import sqlalchemy as sa
+
+from worek import fleet
+from worek.cli import cli
+from worek_tests.conftest import DBNAME
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+def job(host, dbname, size, **server):
+    return fleet.FleetJob(
+        server={'host': host, **server},
+        dbname=dbname,
+        size=size,
+        output=Path(dbname),
+    )
+
+
+class Recorder:
+    """A fake backup recording the order and concurrency of the backups"""
+
+    def __init__(self, failures=None):
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = {}
+        self.max_running = {}
+        self.max_total = 0
+        self.failures = dict(failures or {})
+
+    def __call__(self, job, options):
+        with self.lock:
+            self.started.append(job.dbname)
+            self.running[job.host] = self.running.get(job.host, 0) + 1
+            self.max_running[job.host] = max(
+                self.max_running.get(job.host, 0),
+                self.running[job.host],
+            )
+            self.max_total = max(self.max_total, sum(self.running.values()))
+            failure = self.failures.pop(job.dbname, None)
+
+        time.sleep(0.02)
+        with self.lock:
+            self.running[job.host] -= 1
+        if failure is not None:
+            raise failure
+
+
+class TestFleetScheduling:
+    def test_limits_and_order(self):
+        jobs = [job('a', f'a{i}', 100 - i) for i in range(6)]
+        jobs += [job('b', f'b{i}', 50 - i, per_host=3) for i in range(6)]
+        backup = Recorder()
+
+        fleet.run(sorted(jobs, key=lambda x: -x.size), concurrency=4, per_host=1, backup=backup)
+
+        assert all(x.status == 'done' for x in jobs)
+        assert backup.max_running == {'a:5432': 1, 'b:5432': 3}
+        assert backup.max_total == 4
+        assert [x for x in backup.started if x.startswith('a')] == [f'a{i}' for i in range(6)]
+
+    def test_retries_transient_errors(self):
+        jobs = [job('a', 'flaky', 10), job('a', 'broken', 5)]
+        backup = Recorder(
+            failures={
+                'flaky': sa.exc.OperationalError('SELECT 1', {}, Exception('too many clients')),
+                'broken': ValueError('bad option'),
+            },
+        )
+
+        fleet.run(jobs, retries=2, retry_delay=0.05, backup=backup)
+
+        flaky, broken = jobs
+        assert (flaky.status, flaky.attempts) == ('done', 2)
+        assert (broken.status, broken.attempts, broken.error) == ('failed', 1, 'bad option')
+
+        summary = fleet.summary(jobs)
+        assert 'bad option' in summary
+        assert summary.splitlines()[-1].startswith('1 of 2 backed up')
+
+
+class TestFleetBackup(PostgresDialectTestBase):
+    def test_retries_connection_errors(self, tmp_path):
+        unreachable = fleet.FleetJob(
+            server={'host': 'localhost', 'port': 1},
+            dbname=DBNAME,
+            size=0,
+            output=tmp_path / 'unreachable.dump',
+        )
+
+        fleet.run([unreachable], retries=1, retry_delay=0.01)
+
+        assert (unreachable.status, unreachable.attempts) == ('failed', 2)
+        assert unreachable.error == "Can't connect to the database."
+        assert not list(tmp_path.iterdir())
+
+    def test_backup_all(self, tmp_path, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'items')
+        config = tmp_path / 'fleet.yaml'
+        config.write_text(
+            f"""
+            output: {tmp_path}/{{host}}/{{dbname}}.dump
+            concurrency: 2
+            servers:
+              - databases: [{DBNAME}, postgres]
+            """,
+        )
+
+        runner = CliRunner()
+        result = runner.invoke(cli, ['backup-all', '--config', str(config), '--dry-run'])
+        assert result.exit_code == 0
+        assert len(result.output.splitlines()) == 2
+
+        result = runner.invoke(cli, ['backup-all', '--config', str(config)])
+        assert result.exit_code == 0, result.output
+        assert result.output.splitlines()[-1].startswith('2 of 2 backed up')
+
+        backup = tmp_path / 'localhost' / f'{DBNAME}.dump'
+        assert backup.read_bytes()[:5] == b'PGDMP'
+        assert not list(tmp_path.glob('localhost/.*.partial'))
+
+    def test_unreachable_server(self, tmp_path, pg_clean_engine):
+        config = tmp_path / 'fleet.yaml'
+        config.write_text(
+            f"""
+            output: {tmp_path}/{{host}}/{{port}}/{{dbname}}.dump
+            retries: 1
+            retry_delay: 0.01
+            servers:
+              - host: localhost
+                port: 1
+              - databases: [{DBNAME}]
+            """,
+        )
+
+        result = CliRunner().invoke(cli, ['backup-all', '--config', str(config)])
+
+        # the other server is still backed up, the unreachable one is a failure of the summary
+        assert result.exit_code == 1, result.output
+        lines = result.output.splitlines()
+        assert lines[1].startswith('done     localhost:5432')
+        assert lines[2].split()[:3] == ['failed', 'localhost:1', '*']
+        assert lines[2].endswith('failed: Connection refused')
+        assert lines[-1].startswith('1 of 2 backed up')
+        assert (tmp_path / 'localhost' / '5432' / f'{DBNAME}.dump').exists()
+
+    def test_missing_database(self, tmp_path):
+        config = tmp_path / 'fleet.json'
+        config.write_text('{"servers": [{"databases": ["no-such-database"]}]}')
+
+        result = CliRunner().invoke(cli, ['backup-all', '--config', str(config)])
+
+        assert result.exit_code == 1
+        assert 'has no databases no-such-database' in result.stderr
@@ -0,0 +1,159 @@
+import io
+from pathlib import Path
+
+import pytest
+import sqlalchemy as sa
+
+import worek
+from worek import incremental
+from worek.core import WorekOperationException
+from worek.dialects.postgres import Postgres as PG
+from worek.dialects.postgres import TableFingerprint
+from worek.manifest import Manifest
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+def fingerprint(table, inserted=0, checksum=None, columns='abc'):
+    return TableFingerprint(
+        schema='public',
+        table=table,
+        relfilenode=1,
+        inserted=inserted,
+        updated=0,
+        deleted=0,
+        columns=columns,
+        checksum=checksum,
+    )
+
+
+class TestIncrementalManifest:
+    def test_new_chain_dumps_every_table(self):
+        manifest = incremental.build_manifest([fingerprint('a'), fingerprint('b')])
+
+        assert manifest.parent is None
+        assert {x['backup'] for x in manifest.tables.values()} == {manifest.id}
+
+    def test_only_changed_tables_are_dumped(self):
+        base = incremental.build_manifest([fingerprint('a'), fingerprint('b'), fingerprint('c')])
+        manifest = incremental.build_manifest(
+            [fingerprint('a'), fingerprint('b', inserted=5), fingerprint('c', columns='xyz')],
+            base,
+        )
+
+        assert manifest.parent == base.id
+        assert manifest.tables['public.a']['backup'] == base.id
+        assert manifest.tables['public.b']['backup'] == manifest.id
+        assert manifest.tables['public.c']['backup'] == manifest.id
+
+        # unchanged tables keep pointing to the backup which last dumped them
+        child = incremental.build_manifest(
+            [fingerprint('a'), fingerprint('b', inserted=5)],
+            manifest,
+        )
+        assert child.tables['public.a']['backup'] == base.id
+        assert child.tables['public.b']['backup'] == manifest.id
+
+    def test_checksums_take_precedence_over_statistics(self):
+        base = incremental.build_manifest([fingerprint('a', checksum='1:2')])
+
+        manifest = incremental.build_manifest([fingerprint('a', inserted=5, checksum='1:2')], base)
+        assert manifest.tables['public.a']['backup'] == base.id
+
+        manifest = incremental.build_manifest([fingerprint('a', checksum='2:3')], base)
+        assert manifest.tables['public.a']['backup'] == manifest.id
+
+    def test_stats_reset_dumps_every_table(self):
+        base = incremental.build_manifest([fingerprint('a')], stats_reset=None)
+        manifest = incremental.build_manifest([fingerprint('a')], base, stats_reset='2024-01-01')
+
+        assert manifest.tables['public.a']['backup'] == manifest.id
+
+    def test_manifest_json_round_trip(self):
+        manifest = incremental.build_manifest([fingerprint('a')], server_version='16.1')
+        assert Manifest.from_json(manifest.to_json()) == manifest
+
+    def test_table_data_lines(self):
+        lines = [
+            '3340; 1259 16385 TABLE public a postgres',
+            '3341; 0 16385 TABLE DATA public a postgres',
+            '3342; 0 16390 TABLE DATA public b postgres',
+            '3343; 0 16395 TABLE DATA other a postgres',
+        ]
+        assert incremental.table_data_lines(lines, [('public', 'a'), ('other', 'a')]) == [
+            lines[1],
+            lines[3],
+        ]
+
+
+class TestIncrementalBackup(PostgresDialectTestBase):
+    def write(self, engine, sql):
+        with engine.connect() as conn:
+            conn.execute(sa.text(sql))
+            # make this backend publish its statistics right away
+            conn.execute(sa.text('SELECT pg_stat_force_next_flush()'))
+            conn.commit()
+
+    def rows(self, engine, table):
+        with engine.connect() as conn:
+            return [x for (x,) in conn.execute(sa.text(f'SELECT id FROM {table} ORDER BY id'))]
+
+    @pytest.mark.parametrize('checksums', [False, True])
+    def test_backup_and_restore_chain(self, tmpdir, pg_clean_engine, checksums):
+        self.create_table(pg_clean_engine, 'static')
+        self.create_table(pg_clean_engine, 'growing')
+        self.write(pg_clean_engine, 'INSERT INTO static VALUES (1), (2)')
+        self.write(pg_clean_engine, 'INSERT INTO growing VALUES (1)')
+
+        base_file = tmpdir.join('base.backup').strpath
+        with Path(base_file).open('wb') as fp:
+            base = worek.backup(
+                fp,
+                backup_type='incremental',
+                checksums=checksums,
+                saengine=pg_clean_engine,
+            )
+
+        self.write(pg_clean_engine, 'INSERT INTO growing VALUES (2)')
+
+        buf = io.BytesIO()
+        manifest = worek.backup(
+            buf,
+            backup_type='incremental',
+            parent=base_file,
+            checksums=checksums,
+            saengine=pg_clean_engine,
+        )
+        assert manifest.parent == base.id
+        assert manifest.tables['public.static']['backup'] == base.id
+        assert manifest.tables['public.growing']['backup'] == manifest.id
+
+        self.write(pg_clean_engine, 'DROP TABLE static, growing')
+
+        buf.seek(0)
+        with pytest.raises(WorekOperationException, match=base.id):
+            worek.restore(buf, saengine=pg_clean_engine)
+
+        buf.seek(0)
+        worek.restore(buf, parents=[base_file], saengine=pg_clean_engine)
+
+        assert self.rows(pg_clean_engine, 'static') == [1, 2]
+        assert self.rows(pg_clean_engine, 'growing') == [1, 2]
+
+    def test_standby_backups_are_checksummed(self, pg_clean_engine, monkeypatch):
+        self.create_table(pg_clean_engine, 'items')
+        self.write(pg_clean_engine, 'INSERT INTO items VALUES (1)')
+        monkeypatch.setattr(PG, 'is_in_recovery', lambda self: True)
+
+        manifest = worek.backup(io.BytesIO(), backup_type='incremental', saengine=pg_clean_engine)
+        assert manifest.tables['public.items']['fingerprint']['checksum'] == PG(
+            pg_clean_engine,
+        ).get_table_checksum('public', 'items')
+
+    def test_incremental_backup_requires_custom_format(self, pg_clean_engine):
+        with pytest.raises(WorekOperationException, match='custom format'):
+            worek.backup(
+                io.BytesIO(),
+                backup_type='incremental',
+                file_format='d',
+                saengine=pg_clean_engine,
+            )
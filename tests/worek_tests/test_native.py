@@ -0,0 +1,234 @@
+import io
+import json
+import subprocess
+import tarfile
+
+import sqlalchemy as sa
+
+import worek
+from worek.dialects.postgres import (
+    NATIVE_BLOBS_NAME,
+    NATIVE_SCHEMA_NAME,
+    NATIVE_TOC_NAME,
+    NativeTable,
+    Postgres,
+    native_post_data_plan,
+)
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+class TestNativeBackup(PostgresDialectTestBase):
+    def create_tables(self, engine):
+        with engine.connect() as conn:
+            conn.execute(
+                sa.text(
+                    """
+                    CREATE TABLE numbers AS
+                        SELECT g AS id, g * 1.5 AS amount FROM generate_series(1, 10000) AS g;
+                    CREATE TABLE items (
+                        id serial PRIMARY KEY,
+                        name text,
+                        doubled int GENERATED ALWAYS AS (id * 2) STORED
+                    );
+                    INSERT INTO items (name) VALUES ('a'), ('b'), ('c');
+                    """,
+                ),
+            )
+            conn.commit()
+
+    def read_archive(self, buf):
+        buf.seek(0)
+        with tarfile.open(fileobj=buf, mode='r|') as archive:
+            return {x.name: archive.extractfile(x).read() for x in archive}
+
+    def test_backup_native(self, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        buf = io.BytesIO()
+
+        toc = Postgres(pg_clean_engine).backup_native(buf, jobs=2)
+
+        members = self.read_archive(buf)
+        assert json.loads(members[NATIVE_TOC_NAME]) == toc
+        assert members[NATIVE_SCHEMA_NAME].startswith(b'PGDMP')
+
+        tables = {x['table']: x for x in toc['tables']}
+        # biggest first, generated columns are left out
+        assert toc['tables'][0]['table'] == 'numbers'
+        assert tables['items']['columns'] == ['id', 'name']
+        assert toc['sequences'] == [
+            {'schema': 'public', 'name': 'items_id_seq', 'value': 3, 'is_called': True},
+        ]
+
+        for index, _ in enumerate(toc['tables']):
+            assert members[f'data/{index}.copy'].startswith(b'PGCOPY\n\xff\r\n\0')
+
+    def test_backup_native_through_core(self, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        buf = io.BytesIO()
+
+        worek.backup(buf, file_format='n', jobs=2, saengine=pg_clean_engine)
+
+        members = self.read_archive(buf)
+        assert list(members)[:2] == [NATIVE_TOC_NAME, NATIVE_SCHEMA_NAME]
+        assert len(members) == 4
+
+    def test_backup_and_restore_native(self, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        with pg_clean_engine.connect() as conn:
+            conn.execute(
+                sa.text(
+                    """
+                    ALTER TABLE numbers ADD PRIMARY KEY (id);
+                    CREATE INDEX numbers_amount ON numbers (amount);
+                    CREATE TABLE orders (
+                        id int PRIMARY KEY,
+                        number_id int REFERENCES numbers (id),
+                        item_id int REFERENCES items (id)
+                    );
+                    INSERT INTO orders VALUES (1, 10, 1), (2, 20, 3);
+                    CREATE FUNCTION touch() RETURNS trigger AS $$ BEGIN RETURN NEW; END $$
+                        LANGUAGE plpgsql;
+                    CREATE TRIGGER orders_touch BEFORE UPDATE ON orders
+                        FOR EACH ROW EXECUTE FUNCTION touch();
+                    """,
+                ),
+            )
+            conn.commit()
+
+        buf = io.BytesIO()
+        worek.backup(buf, file_format='n', jobs=2, saengine=pg_clean_engine)
+        buf.seek(0)
+        worek.restore(buf, jobs=3, saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*), sum(amount) FROM numbers')).one() == (
+                10000,
+                75007500,
+            )
+            doubled = conn.execute(sa.text('SELECT doubled FROM items ORDER BY id'))
+            assert doubled.scalars().all() == [2, 4, 6]
+            assert conn.execute(sa.text("SELECT nextval('items_id_seq')")).scalar() == 4
+
+            indexes = conn.execute(
+                sa.text("SELECT indexname FROM pg_indexes WHERE schemaname = 'public'"),
+            )
+            assert set(indexes.scalars()) == {
+                'items_pkey',
+                'numbers_pkey',
+                'numbers_amount',
+                'orders_pkey',
+            }
+            constraints = conn.execute(
+                sa.text("SELECT conname FROM pg_constraint WHERE contype = 'f'"),
+            )
+            assert set(constraints.scalars()) == {'orders_number_id_fkey', 'orders_item_id_fkey'}
+            triggers = conn.execute(sa.text('SELECT tgname FROM pg_trigger WHERE NOT tgisinternal'))
+            assert triggers.scalars().all() == ['orders_touch']
+
+    def test_backup_and_restore_native_large_objects(self, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('CREATE SCHEMA other'))
+            conn.execute(sa.text('CREATE TABLE other.things AS SELECT 1 AS id'))
+            oid = conn.execute(sa.text("SELECT lo_from_bytea(0, 'large object')")).scalar()
+            conn.commit()
+
+        buf = io.BytesIO()
+        worek.backup(buf, file_format='n', jobs=2, saengine=pg_clean_engine)
+        members = self.read_archive(buf)
+        assert list(members)[-1] == NATIVE_BLOBS_NAME
+        # only the large objects, the data of the tables of every schema is in its own member
+        blobs = subprocess.run(
+            ['pg_restore', '-l'],
+            input=members[NATIVE_BLOBS_NAME],
+            capture_output=True,
+            check=True,
+        ).stdout.decode()
+        assert 'TABLE DATA' not in blobs
+
+        # cleaning the database keeps large objects, they are replaced by those of the backup
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text("SELECT lo_put(:oid, 0, 'changed')"), {'oid': oid})
+            conn.commit()
+        buf.seek(0)
+        worek.restore(buf, jobs=2, saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            data = conn.execute(sa.text('SELECT lo_get(:oid)'), {'oid': oid}).scalar()
+            assert bytes(data) == b'large object'
+            conn.execute(sa.text('SELECT lo_unlink(:oid)'), {'oid': oid})
+            conn.commit()
+
+        buf.seek(0)
+        worek.restore(buf, jobs=2, saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            data = conn.execute(sa.text('SELECT lo_get(:oid)'), {'oid': oid}).scalar()
+            assert bytes(data) == b'large object'
+            assert (
+                conn.execute(sa.text('SELECT count(*) FROM pg_largeobject_metadata')).scalar() == 1
+            )
+            assert conn.execute(sa.text('SELECT count(*) FROM numbers')).scalar() == 10000
+            assert conn.execute(sa.text('SELECT count(*) FROM other.things')).scalar() == 1
+
+    def test_copy_table_in_keeps_connection_settings(self, tmp_path, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        path = tmp_path / 'items.copy'
+        with pg_clean_engine.connect() as conn, path.open('wb') as fp:
+            cursor = conn.connection.driver_connection.cursor()
+            cursor.copy_expert('COPY items (id, name) TO STDOUT (FORMAT binary)', fp)
+            conn.execute(sa.text('TRUNCATE items'))
+            conn.commit()
+
+        # a single pooled connection, so the setting would be seen by the next use of the pool
+        engine = sa.create_engine(pg_clean_engine.url, pool_size=1, max_overflow=0)
+        table = NativeTable(schema='public', table='items', columns=['id', 'name'], size=0)
+        try:
+            Postgres(engine)._copy_table_in(table, path)
+            with engine.connect() as conn:
+                assert conn.execute(sa.text('SELECT count(*) FROM items')).scalar() == 3
+                assert conn.execute(sa.text('SHOW synchronous_commit')).scalar() == 'on'
+        finally:
+            engine.dispose()
+
+
+class TestNativePostDataPlan:
+    def test_plan(self):
+        toc = {
+            'tables': [
+                {'schema': 'public', 'table': 'small', 'size': 10},
+                {'schema': 'public', 'table': 'big', 'size': 1000},
+            ],
+            'indexes': [
+                {'schema': 'public', 'name': 'small_pkey', 'table': 'small'},
+                {'schema': 'public', 'name': 'big_idx', 'table': 'big'},
+            ],
+            'constraints': [
+                {
+                    'schema': 'public',
+                    'table': 'small',
+                    'name': 'small_pkey',
+                    'referenced_schema': None,
+                    'referenced_table': None,
+                },
+                {
+                    'schema': 'public',
+                    'table': 'small',
+                    'name': 'small_big_fkey',
+                    'referenced_schema': 'public',
+                    'referenced_table': 'big',
+                },
+            ],
+        }
+        lines = [
+            '10; 2606 1 CONSTRAINT public small small_pkey postgres',
+            '11; 1259 2 INDEX public big_idx postgres',
+            '12; 2620 3 TRIGGER public small small_trigger postgres',
+            '13; 2606 4 FK CONSTRAINT public small small_big_fkey postgres',
+        ]
+
+        builds, foreign_keys, others = native_post_data_plan(lines, toc)
+
+        assert builds == [lines[1], lines[0]]
+        assert foreign_keys == [(lines[3], {('public', 'small'), ('public', 'big')})]
+        assert others == [lines[2]]
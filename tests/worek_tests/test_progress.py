@@ -0,0 +1,152 @@
+import io
+import os
+import time
+
+import pytest
+import sqlalchemy as sa
+
+import worek
+from worek.progress import (
+    CountingReader,
+    CountingWriter,
+    Progress,
+    ProgressStatus,
+    StderrMonitor,
+    format_status,
+    remaining_size,
+)
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+class TestProgress:
+    def test_counts_and_reports(self):
+        statuses = []
+        progress = Progress(statuses.append, total=1000, interval=0)
+        sink = io.BytesIO()
+
+        writer = CountingWriter(sink, progress)
+        writer.write(b'x' * 100)
+        writer.write(b'y' * 150)
+        progress.finish()
+
+        assert sink.getvalue() == b'x' * 100 + b'y' * 150
+        assert [x.transferred for x in statuses] == [100, 250, 250]
+        assert statuses[-1].done
+        assert statuses[-1].total == 1000
+        assert statuses[-1].eta is not None
+
+    def test_reports_at_most_once_per_interval(self):
+        statuses = []
+        progress = Progress(statuses.append, interval=3600)
+
+        for _ in range(10):
+            progress.add(1)
+        progress.finish()
+
+        assert [x.transferred for x in statuses] == [1, 10]
+
+    def test_reports_while_idle(self):
+        statuses = []
+        progress = Progress(statuses.append, interval=0.05)
+        progress.add(10)
+        progress.start()
+
+        time.sleep(0.5)
+        progress.finish()
+        reported = len(statuses)
+        time.sleep(0.2)
+
+        assert reported >= 4
+        assert all(x.transferred == 10 for x in statuses)
+        assert len(statuses) == reported
+        assert statuses[-1].done
+
+    def test_stderr_monitor_sets_item(self):
+        progress = Progress()
+        monitor = StderrMonitor(progress)
+
+        monitor.write(b'pg_restore: connecting to database for restore\npg_restore: creat')
+        assert progress.item is None
+        monitor.write(b'ing INDEX "public.users_email"\npg_restore: error: oops\n')
+
+        assert progress.item == 'creating INDEX "public.users_email"'
+        assert monitor.tail().endswith(b'error: oops\n')
+
+    def test_remaining_size(self, tmp_path):
+        path = tmp_path / 'backup'
+        path.write_bytes(b'x' * 100)
+
+        with path.open('rb') as fp:
+            fp.read(40)
+            assert remaining_size(fp) == 60
+        assert remaining_size(io.BytesIO(b'x')) is None
+
+    def test_counting_reader_passes_files_through(self, tmp_path):
+        path = tmp_path / 'backup'
+        path.write_bytes(b'x' * 100)
+        progress = Progress()
+
+        with path.open('rb', buffering=0) as fp:
+            reader = CountingReader(fp, progress)
+            assert reader.name == str(path)
+            assert reader.fileno() == fp.fileno()
+            assert reader.seekable()
+            # a child process given the file descriptor moves its position
+            os.lseek(fp.fileno(), 30, os.SEEK_SET)
+            assert reader.tell() == 30
+            assert progress.status().transferred == 30
+            reader.read(20)
+            assert progress.status().transferred == 50
+
+        reader = CountingReader(io.BytesIO(b'x' * 100), progress := Progress())
+        reader.read(40)
+        assert progress.status().transferred == 40
+        assert reader.name is None
+        assert not reader.seekable()
+        with pytest.raises(io.UnsupportedOperation):
+            reader.fileno()
+
+    def test_format_status(self):
+        status = ProgressStatus(
+            transferred=3 * 1024 * 1024,
+            total=None,
+            elapsed=75,
+            rate=1024 * 1024,
+            eta=3661,
+            item='dumping contents of table "public.users"',
+        )
+
+        assert format_status(status) == (
+            '3.0 MB  1.0 MB/s  elapsed 00:01:15  ETA 01:01:01'
+            '  dumping contents of table "public.users"'
+        )
+
+
+class TestProgressBackupRestore(PostgresDialectTestBase):
+    def test_backup_and_restore_report_progress(self, tmp_path, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'numbers')
+        backup_file = tmp_path / 'backup.dump'
+
+        statuses = []
+        with backup_file.open('wb') as fp:
+            worek.backup(fp, progress=statuses.append, saengine=pg_clean_engine)
+
+        final = statuses[-1]
+        assert final.done
+        assert final.transferred == backup_file.stat().st_size
+        with pg_clean_engine.connect() as conn:
+            size = conn.execute(sa.text('SELECT pg_database_size(current_database())')).scalar()
+        assert final.total == size
+        assert 'numbers' in final.item
+
+        statuses = []
+        with backup_file.open('rb') as fp:
+            worek.restore(fp, progress=statuses.append, saengine=pg_clean_engine)
+
+        final = statuses[-1]
+        assert final.done
+        assert final.transferred == final.total == backup_file.stat().st_size
+        assert final.item is not None
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*) FROM numbers')).scalar() == 0
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+import sqlalchemy as sa
+
+import worek
+from worek.manifest import Manifest
+from worek.repository import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, Repository, WorekRepositoryError
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+def rows(count, seed=0):
+    rand = random.Random(seed)
+    return [f'{i}\t{rand.getrandbits(64)}\tsome text {i * 7}\n'.encode() for i in range(count)]
+
+
+def store(repo, data, write_size=100_000):
+    manifest = Manifest(backup_type='full')
+    writer = repo.writer(manifest, threads=4)
+    for start in range(0, len(data), write_size):
+        writer.write(data[start : start + write_size])
+    writer.close()
+    return manifest, writer
+
+
+class TestRepository:
+    def test_store_and_read(self, tmp_path):
+        repo = Repository.open(tmp_path / 'repo', create=True)
+        data = b''.join(rows(200_000))
+
+        manifest, writer = store(repo, data)
+
+        assert writer.size == len(data) == manifest.size
+        assert len(manifest.chunks) > 1
+        assert repo.load_manifest().id == manifest.id
+        assert repo.reader(manifest, threads=2).read() == data
+
+    def test_chunk_sizes(self, tmp_path):
+        repo = Repository.open(tmp_path / 'repo', create=True)
+        data = b''.join(rows(200_000)) + b'x' * (2 * MAX_CHUNK_SIZE)
+
+        manifest, _ = store(repo, data)
+
+        sizes = [len(repo.get_chunk(x)) for x in manifest.chunks]
+        assert all(MIN_CHUNK_SIZE <= x <= MAX_CHUNK_SIZE for x in sizes[:-1])
+        assert sum(sizes) == len(data)
+
+    def test_changes_only_store_new_chunks(self, tmp_path):
+        repo = Repository.open(tmp_path / 'repo', create=True)
+        lines = rows(200_000)
+        first, _ = store(repo, b''.join(lines))
+
+        # insert and delete rows in the middle, the chunks after them must realign
+        lines[100_000:100_010] = rows(20, seed=1)
+        second, writer = store(repo, b''.join(lines), write_size=65_536)
+
+        new_chunks = [x for x in second.chunks if x not in first.chunks]
+        assert len(new_chunks) <= 2
+        assert writer.stored_size == sum(len(repo.get_chunk(x)) for x in new_chunks)
+        assert repo.reader(second).read() == b''.join(lines)
+
+    def test_corrupt_chunk(self, tmp_path):
+        repo = Repository.open(tmp_path / 'repo', create=True)
+        key, stored = repo.put_chunk(b'worek' * 1000)
+        assert stored
+        assert repo.put_chunk(b'worek' * 1000) == (key, False)
+
+        repo._chunk_path(key).write_bytes(b'garbage')
+        with pytest.raises(WorekRepositoryError, match='corrupt'):
+            repo.get_chunk(key)
+
+    def test_not_a_repository(self, tmp_path):
+        with pytest.raises(WorekRepositoryError, match='not a worek repository'):
+            Repository.open(tmp_path)
+
+
+class TestRepositoryBackup(PostgresDialectTestBase):
+    def test_backup_and_restore(self, tmp_path, pg_clean_engine):
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('CREATE TABLE numbers AS SELECT generate_series(1, 100000) AS id'))
+            conn.commit()
+
+        repo_path = tmp_path / 'repo'
+        first = worek.backup(None, repo=repo_path, saengine=pg_clean_engine)
+        second = worek.backup(None, repo=repo_path, saengine=pg_clean_engine)
+        assert len(Repository.open(repo_path).manifests()) == 2
+        assert set(second.chunks) <= set(first.chunks) | {second.chunks[0]}
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DROP TABLE numbers'))
+            conn.commit()
+
+        worek.restore(None, repo=repo_path, backup_id=first.id, saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*) FROM numbers')).scalar() == 100000
@@ -0,0 +1,187 @@
+import io
+import os
+
+from click.testing import CliRunner
+import pytest
+import sqlalchemy as sa
+
+import worek
+from worek import s3, toc
+from worek.cli import cli
+from worek.dialects.postgres import Postgres as PG
+from worek_tests.conftest import DBNAME
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+BUCKET = 'backups'
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    """An S3 client of an in-process S3 stand-in with an empty `BUCKET`"""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    with moto.mock_aws():
+        client = s3.client()
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def read_object(client, key):
+    return client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+
+class FlakyClient:
+    """An S3 client whose first `failures` calls of `method` fail"""
+
+    def __init__(self, client, failures, method='upload_part'):
+        self.client = client
+        self.failures = failures
+        self.method = method
+
+    def __getattr__(self, name):
+        call = getattr(self.client, name)
+        if name != self.method:
+            return call
+
+        def flaky(**kwargs):
+            if self.failures:
+                self.failures -= 1
+                raise s3._boto3()[1].EndpointConnectionError(endpoint_url='http://s3')
+            return call(**kwargs)
+
+        return flaky
+
+
+class TestMultipartWriter:
+    def test_parallel_parts(self, s3_client):
+        data = os.urandom(s3.MIN_PART_SIZE * 2 + 1000)
+        writer = s3.MultipartWriter(BUCKET, 'big', s3=s3_client, part_size=s3.MIN_PART_SIZE)
+
+        with writer:
+            for start in range(0, len(data), 1024 * 1024):
+                writer.write(data[start : start + 1024 * 1024])
+
+        assert [x['PartNumber'] for x in writer.parts] == [1, 2, 3]
+        assert read_object(s3_client, 'big') == data
+
+    @pytest.mark.parametrize('size', [0, 1000])
+    def test_small_object(self, s3_client, size):
+        data = os.urandom(size)
+        with s3.MultipartWriter.for_url(f's3://{BUCKET}/small', s3=s3_client) as writer:
+            writer.write(data)
+
+        assert writer.upload_id is None
+        assert read_object(s3_client, 'small') == data
+
+    def test_retries_parts(self, s3_client):
+        data = os.urandom(s3.MIN_PART_SIZE + 10)
+        client = FlakyClient(s3_client, failures=2)
+
+        writer = s3.MultipartWriter(BUCKET, 'flaky', s3=client, part_size=s3.MIN_PART_SIZE)
+        writer.retry_delay = 0.01
+        with writer:
+            writer.write(data)
+
+        assert read_object(s3_client, 'flaky') == data
+
+        client.failures = 100
+        writer = s3.MultipartWriter(BUCKET, 'broken', s3=client, part_size=s3.MIN_PART_SIZE)
+        writer.retries, writer.retry_delay = 2, 0.01
+        error = 'Could not upload part 1 of s3://backups/broken'
+        with pytest.raises(s3.WorekS3Error, match=error), writer:
+            writer.write(data)
+
+    def test_abort(self, s3_client):
+        writer = s3.MultipartWriter(BUCKET, 'failed', s3=s3_client, part_size=s3.MIN_PART_SIZE)
+        with pytest.raises(RuntimeError), writer:
+            writer.write(os.urandom(s3.MIN_PART_SIZE + 1))
+            raise RuntimeError
+
+        assert writer.upload_id is not None
+        assert not s3_client.list_multipart_uploads(Bucket=BUCKET).get('Uploads')
+        assert 'Contents' not in s3_client.list_objects_v2(Bucket=BUCKET)
+
+    def test_bad_url(self):
+        with pytest.raises(s3.WorekS3Error, match='expecting s3://bucket/key'):
+            s3.parse_url('s3://bucket')
+
+
+class TestS3Backup(PostgresDialectTestBase):
+    def test_backup_and_restore(self, s3_client, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'items')
+
+        url = f's3://{BUCKET}/test.dump'
+        worek.backup(url, index=toc.index_path(url), saengine=pg_clean_engine)
+
+        data = read_object(s3_client, 'test.dump')
+        assert data[:5] == b'PGDMP'
+        index = toc.ArchiveIndex.from_json(read_object(s3_client, 'test.dump.toc.json'))
+        assert index.size == len(data)
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DROP TABLE items'))
+            conn.commit()
+
+        worek.restore(url, index=toc.index_path(url), jobs=2, saengine=pg_clean_engine)
+        assert PG(pg_clean_engine).get_table_list_from_db('public') == ['items']
+
+    def test_cli_backup(self, s3_client, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'items')
+
+        result = CliRunner().invoke(
+            cli,
+            ['backup', '-d', DBNAME, '-f', f's3://{BUCKET}/cli.dump', '--compress', 'gzip'],
+        )
+        assert result.exit_code == 0, result.output
+        assert read_object(s3_client, 'cli.dump')[:2] == b'\x1f\x8b'
+
+        result = CliRunner().invoke(cli, ['restore', '-d', DBNAME, '-f', f's3://{BUCKET}/cli.dump'])
+        assert result.exit_code == 0, result.output
+        assert PG(pg_clean_engine).get_table_list_from_db('public') == ['items']
+
+
+class TestObjectReader:
+    def test_read_and_seek(self, s3_client):
+        data = os.urandom(1000)
+        s3_client.put_object(Bucket=BUCKET, Key='data', Body=data)
+        reader = s3.ObjectReader(BUCKET, 'data', s3=s3_client, range_size=64, threads=3)
+
+        assert reader.read(100) == data[:100]
+        assert reader.seek(10) == 10
+        assert reader.read(20) == data[10:30]
+        reader.seek(900)
+        assert reader.read() == data[900:]
+        reader.seek(-50, io.SEEK_END)
+        assert reader.read(10) == data[950:960]
+        reader.seek(0)
+        assert reader.readall() == data
+        assert reader.read(1) == b''
+        reader.close()
+
+    def test_retries_ranges(self, s3_client):
+        s3_client.put_object(Bucket=BUCKET, Key='data', Body=b'x' * 1000)
+        client = FlakyClient(s3_client, failures=2, method='get_object')
+        reader = s3.ObjectReader(BUCKET, 'data', s3=client, range_size=100, retry_delay=0.01)
+
+        assert reader.read() == b'x' * 1000
+
+        client.failures = 100
+        reader = s3.ObjectReader(BUCKET, 'data', s3=client, retries=1, retry_delay=0.01)
+        with pytest.raises(s3.WorekS3Error, match='Could not download bytes 0-999 of'):
+            reader.read()
+
+    def test_changed_object(self, s3_client):
+        s3_client.put_object(Bucket=BUCKET, Key='data', Body=b'x' * 1000)
+        reader = s3.ObjectReader(BUCKET, 'data', s3=s3_client, range_size=100, threads=1)
+        assert reader.read(100) == b'x' * 100
+
+        s3_client.put_object(Bucket=BUCKET, Key='data', Body=b'y' * 1000)
+        reader.seek(500)
+        with pytest.raises(s3.WorekS3Error, match='PreconditionFailed'):
+            reader.read(100)
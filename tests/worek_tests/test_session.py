@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import pytest
+import sqlalchemy as sa
+
+import worek
+from worek.dialects.postgres import Postgres as PG
+from worek.exc import WorekOperationException
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+def count_queries(engine):
+    queries = []
+    sa.event.listen(engine, 'before_cursor_execute', lambda *args: queries.append(args[2]))
+    return queries
+
+
+class TestSession(PostgresDialectTestBase):
+    def test_server_info_is_fetched_in_one_query_and_cached(self, pg_unclean_engine):
+        queries = count_queries(pg_unclean_engine)
+        session = worek.Session(saengine=pg_unclean_engine)
+
+        info = session.server_info()
+        assert session.server_info() is info
+        pg = session.postgres()
+
+        assert len(queries) == 1
+        assert 'public' in info.schemas
+        assert pg.schemas == info.schemas
+        assert pg._default_version() == info.version.split('.')[0]
+        assert len(queries) == 1
+
+    def test_server_info_expires(self, pg_unclean_engine):
+        queries = count_queries(pg_unclean_engine)
+        session = worek.Session(saengine=pg_unclean_engine, cache_ttl=0)
+
+        session.server_info()
+        session.server_info()
+
+        assert len(queries) == 2
+
+    def test_server_info_invalidate(self, pg_unclean_engine):
+        queries = count_queries(pg_unclean_engine)
+        session = worek.Session(saengine=pg_unclean_engine)
+
+        session.server_info()
+        session.invalidate()
+        session.server_info()
+
+        assert len(queries) == 2
+
+    def test_server_info_raises_when_cant_connect(self):
+        with (
+            worek.Session(host='localhost', port=1, dbname='nope') as session,
+            pytest.raises(WorekOperationException, match="Can't connect"),
+        ):
+            session.server_info()
+
+    def test_dialect_registry(self, pg_unclean_engine):
+        assert worek.Session(saengine=pg_unclean_engine).dialect is PG
+
+        with pytest.raises(WorekOperationException, match='Unknown database engine mysql'):
+            worek.Session(saengine=pg_unclean_engine, dialect='mysql')
+
+    def test_session_backup_and_restore(self, tmpdir, pg_clean_engine):
+        backup_file = Path(tmpdir.join('test.backup.bin').strpath)
+        self.create_table(pg_clean_engine, 'keep')
+
+        with worek.Session(saengine=pg_clean_engine) as session:
+            with backup_file.open('wb') as fp:
+                session.backup(fp)
+
+            self.create_table(pg_clean_engine, 'should_be_removed')
+
+            with backup_file.open('rb') as fp:
+                session.restore(fp)
+
+        with pg_clean_engine.connect() as conn:
+            tables = conn.execute(
+                sa.text("SELECT tablename FROM pg_tables WHERE schemaname = 'public'"),
+            )
+            assert [x[0] for x in tables] == ['keep']
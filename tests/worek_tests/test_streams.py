@@ -0,0 +1,102 @@
+import hashlib
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+from worek import streams
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+class HashingWriter:
+    """A sink without a file descriptor which only keeps a digest of what is written"""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.largest_write = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self.largest_write = max(self.largest_write, len(data))
+        return len(data)
+
+
+class TestRun:
+    def test_pumps_python_streams(self):
+        data = bytes(range(256)) * 40_000
+        sink = HashingWriter()
+
+        code = 'import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)'
+        result = streams.run(python(code), stdin=io.BytesIO(data), stdout=sink)
+
+        assert result.returncode == 0
+        assert result.stdout is None
+        assert sink.size == len(data)
+        assert sink.digest.hexdigest() == hashlib.sha256(data).hexdigest()
+        assert sink.largest_write <= streams.CHUNK_SIZE
+
+    def test_pipes(self):
+        code = 'import sys; print(sys.stdin.read() or "empty"); sys.stderr.write("x" * 99999 + "z")'
+        result = streams.run(
+            python(code),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        assert result.stdout == b'empty\n'
+        assert len(result.stderr) == streams.STDERR_TAIL_SIZE
+        assert result.stderr.endswith(b'xz')
+
+    def test_returncode(self):
+        result = streams.run(python('raise SystemExit(3)'), stderr=subprocess.DEVNULL)
+        assert result.returncode == 3
+        assert result.stderr is None
+
+
+class TestFanOut:
+    def write(self, sinks, data):
+        with streams.fan_out(sinks) as writer:
+            code = 'import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)'
+            streams.run(python(code), stdin=io.BytesIO(data), stdout=writer)
+            writer.write(b'end')
+        return data + b'end'
+
+    @pytest.mark.parametrize('mode', ['wb', 'ab'])
+    def test_files_and_python_sinks(self, tmp_path, monkeypatch, mode):
+        spliced = []
+        splice_copy = streams._splice_copy
+        monkeypatch.setattr(
+            streams,
+            '_splice_copy',
+            lambda *args: spliced.append(True) or splice_copy(*args),
+        )
+        data = os.urandom(5 * 1024 * 1024 + 10)
+        memory = io.BytesIO()
+        hashed = HashingWriter()
+
+        with (tmp_path / 'one').open(mode) as one, (tmp_path / 'two').open(mode) as two:
+            one.write(b'head')
+            expected = self.write([one, two, memory, hashed], data)
+
+        assert (tmp_path / 'one').read_bytes() == b'head' + expected
+        assert (tmp_path / 'two').read_bytes() == expected
+        assert memory.getvalue() == expected
+        assert hashed.digest.hexdigest() == hashlib.sha256(expected).hexdigest()
+        # files in append mode can't be spliced into
+        assert spliced == ([True] if mode == 'wb' and streams._tee else [])
+
+    def test_sink_error(self, tmp_path):
+        class Broken:
+            def write(self, data):
+                raise ValueError('broken sink')
+
+        with pytest.raises(ValueError, match='broken sink'):
+            self.write([io.BytesIO(), Broken()], os.urandom(1024))
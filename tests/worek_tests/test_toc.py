@@ -0,0 +1,285 @@
+import io
+from pathlib import Path
+import subprocess
+
+from click.testing import CliRunner
+import pytest
+import sqlalchemy as sa
+
+import worek
+from worek import toc
+from worek.cli import cli
+from worek.dialects.postgres import Postgres as PG
+from worek.dialects.postgres import PostgresCommand
+from worek.exc import WorekOperationException
+from worek_tests.conftest import DBNAME
+from worek_tests.helpers import PostgresDialectTestBase
+
+
+def pg_restore_list(path):
+    lines = subprocess.run(['pg_restore', '-l', path], capture_output=True, check=True).stdout
+    return [x for x in lines.decode().splitlines() if x and not x.startswith(';')]
+
+
+class TestArchiveIndex(PostgresDialectTestBase):
+    def create_tables(self, engine):
+        with engine.connect() as conn:
+            for schema in ('one', 'two'):
+                conn.execute(sa.text(f'CREATE SCHEMA {schema}'))
+                conn.execute(
+                    sa.text(
+                        f'CREATE TABLE {schema}.items AS'
+                        ' SELECT g AS id, md5(g::text) AS name FROM generate_series(1, 1000) AS g',
+                    ),
+                )
+            conn.commit()
+
+    def test_backup_writes_index(self, tmpdir, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        backup_file = Path(tmpdir.join('test.dump').strpath)
+        index_file = toc.index_path(backup_file)
+
+        with backup_file.open('wb') as fp:
+            worek.backup(fp, index=index_file, saengine=pg_clean_engine)
+
+        index = toc.ArchiveIndex.load(index_file)
+        assert index.size == backup_file.stat().st_size
+        assert index.dbname == DBNAME
+
+        lines = [x.list_line() for x in index.entries if x.desc not in toc.UNLISTED]
+        assert lines == pg_restore_list(backup_file)
+
+        data = {(x.namespace, x.tag): x for x in index.entries if x.size}
+        assert set(data) == {('one', 'items'), ('two', 'items')}
+        with backup_file.open('rb') as fp:
+            for entry in data.values():
+                fp.seek(entry.offset)
+                assert fp.read(1) == bytes([toc.BLOCK_DATA])
+
+            assert toc.index_archive(fp) == index
+
+    def test_index_with_data_offsets(self, tmpdir, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        backup_file = Path(tmpdir.join('test.dump').strpath)
+
+        # pg_dump records the data offsets in the TOC when it writes to a file given with --file
+        PG(pg_clean_engine)._execute_cli_command(
+            PostgresCommand.BACKUP,
+            ['--format', 'custom', '--file', str(backup_file)],
+        )
+        with backup_file.open('rb') as fp:
+            index = toc.index_archive(fp)
+
+        assert all(x.offset is not None for x in index.entries if x.size)
+        writer = toc.IndexingWriter(io.BytesIO())
+        writer.write(backup_file.read_bytes())
+        assert writer.finish() == index
+
+    def test_restore_reads_only_selected_data(self, tmpdir, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        backup_file = Path(tmpdir.join('test.dump').strpath)
+        index_file = toc.index_path(backup_file)
+
+        with backup_file.open('wb') as fp:
+            worek.backup(fp, index=index_file, saengine=pg_clean_engine)
+
+        index = toc.ArchiveIndex.load(index_file)
+        one = index.data_ids(['one'])
+        assert len(one) == 1
+        assert sum(end - start for start, end in index.ranges(one)) < index.size * 0.75
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DROP TABLE one.items'))
+            conn.commit()
+
+        with backup_file.open('rb') as fp:
+            worek.restore(fp, index=index_file, schemas=['one'], saengine=pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*) FROM one.items')).scalar() == 1000
+
+    def test_mismatched_index(self, tmpdir, pg_clean_engine):
+        self.create_table(pg_clean_engine, 'items')
+        backup_file = Path(tmpdir.join('test.dump').strpath)
+
+        with backup_file.open('wb') as fp:
+            worek.backup(fp, index=toc.index_path(backup_file), saengine=pg_clean_engine)
+        index = toc.ArchiveIndex.load(toc.index_path(backup_file))
+
+        with pytest.raises(toc.WorekTocError, match='does not match'):
+            index.check(io.BytesIO(backup_file.read_bytes() + b'\0'))
+
+        writer = toc.IndexingWriter(io.BytesIO())
+        writer.write(backup_file.read_bytes()[: index.toc_size + 10])
+        with pytest.raises(toc.WorekTocError, match='truncated'):
+            writer.finish()
+
+    def test_index_needs_plain_custom_format(self, pg_clean_engine):
+        with pytest.raises(worek.core.WorekOperationException, match='are indexed'):
+            worek.backup(
+                io.BytesIO(),
+                index=io.BytesIO(),
+                compress='gzip',
+                saengine=pg_clean_engine,
+            )
+
+    def test_cli_index_and_list(self, tmpdir, pg_clean_engine):
+        self.create_tables(pg_clean_engine)
+        backup_file = Path(tmpdir.join('test.dump').strpath)
+        with backup_file.open('wb') as fp:
+            PG(pg_clean_engine).backup_binary(fp)
+
+        runner = CliRunner()
+        result = runner.invoke(cli, ['index', str(backup_file)])
+        assert result.exit_code == 0, result.output
+        assert toc.index_path(backup_file).exists()
+
+        result = runner.invoke(cli, ['list', str(backup_file)])
+        assert result.exit_code == 0, result.output
+        assert result.output.splitlines() == pg_restore_list(backup_file)
+
+        result = runner.invoke(cli, ['list', '--schema', 'two', '--sizes', str(backup_file)])
+        lines = result.output.splitlines()
+        assert all(' two ' in x for x in lines)
+        assert any(x.endswith('KB)') for x in lines)
+
+
+class TestSelectiveRestore(PostgresDialectTestBase):
+    def create_shop(self, engine):
+        with engine.connect() as conn:
+            for sql in (
+                'CREATE SCHEMA shop',
+                'CREATE TABLE shop.customers (id serial PRIMARY KEY, name text)',
+                (
+                    'CREATE TABLE shop.orders (id serial PRIMARY KEY,'
+                    ' code int GENERATED ALWAYS AS IDENTITY,'
+                    ' customer_id int REFERENCES shop.customers (id))'
+                ),
+                'CREATE INDEX orders_customer ON shop.orders (customer_id)',
+                "COMMENT ON TABLE shop.orders IS 'orders'",
+                'CREATE TABLE shop.notes (body text)',
+                "INSERT INTO shop.customers (name) VALUES ('one'), ('two')",
+                'INSERT INTO shop.orders (customer_id) VALUES (1), (2), (2)',
+                "INSERT INTO shop.notes VALUES ('note')",
+            ):
+                conn.execute(sa.text(sql))
+            conn.commit()
+
+    def backup(self, tmpdir, engine):
+        backup_file = Path(tmpdir.join('test.dump').strpath)
+        with backup_file.open('wb') as fp:
+            worek.backup(fp, saengine=engine)
+        return backup_file
+
+    def test_select_entries(self, tmpdir, pg_clean_engine):
+        self.create_shop(pg_clean_engine)
+        with self.backup(tmpdir, pg_clean_engine).open('rb') as fp:
+            entries, _ = toc.read_toc(fp)
+
+        def selected(**kwargs):
+            return {(x.desc, x.tag) for x in toc.select_entries(entries, ['shop'], **kwargs)}
+
+        orders = selected(tables=['shop.ord*'])
+        assert orders == {
+            ('TABLE', 'orders'),
+            ('TABLE DATA', 'orders'),
+            ('SEQUENCE', 'orders_id_seq'),
+            ('SEQUENCE OWNED BY', 'orders_id_seq'),
+            ('SEQUENCE SET', 'orders_id_seq'),
+            ('DEFAULT', 'orders id'),
+            ('SEQUENCE', 'orders_code_seq'),
+            ('SEQUENCE SET', 'orders_code_seq'),
+            ('CONSTRAINT', 'orders orders_pkey'),
+            ('INDEX', 'orders_customer'),
+            ('COMMENT', 'TABLE orders'),
+        }
+        assert ('FK CONSTRAINT', 'orders orders_customer_id_fkey') in selected(
+            tables=['orders', 'customers'],
+        )
+
+        rest = selected(exclude_tables=['customers'])
+        assert ('TABLE', 'orders') in rest
+        assert not {x for x in rest if 'customers' in x[1]}
+        assert ('FK CONSTRAINT', 'orders orders_customer_id_fkey') not in rest
+
+    def test_restore_tables(self, tmpdir, pg_clean_engine):
+        self.create_shop(pg_clean_engine)
+        backup_file = self.backup(tmpdir, pg_clean_engine)
+
+        with pg_clean_engine.connect() as conn:
+            conn.execute(sa.text('DELETE FROM shop.orders WHERE id > 1'))
+            conn.execute(sa.text('DROP INDEX shop.orders_customer'))
+            conn.execute(sa.text("INSERT INTO shop.notes VALUES ('new')"))
+            conn.commit()
+
+        with backup_file.open('rb') as fp:
+            worek.restore(
+                fp,
+                tables=['shop.orders'],
+                clean_existing_database=True,
+                saengine=pg_clean_engine,
+            )
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*) FROM shop.orders')).scalar() == 3
+            assert conn.execute(sa.text('SELECT count(*) FROM shop.notes')).scalar() == 2
+            indexes = conn.execute(
+                sa.text("SELECT indexname FROM pg_indexes WHERE tablename = 'orders'"),
+            )
+            assert {x for (x,) in indexes} == {'orders_pkey', 'orders_customer'}
+            assert conn.execute(sa.text("SELECT nextval('shop.orders_id_seq')")).scalar() == 4
+
+    def test_restore_referenced_table(self, tmpdir, pg_clean_engine):
+        self.create_shop(pg_clean_engine)
+        backup_file = self.backup(tmpdir, pg_clean_engine)
+
+        # dropping customers would need the foreign key of orders, which isn't restored, dropped
+        with backup_file.open('rb') as fp, pytest.raises(WorekOperationException) as excinfo:
+            worek.restore(
+                fp,
+                tables=['shop.customers'],
+                clean_existing_database=True,
+                saengine=pg_clean_engine,
+            )
+        assert 'orders_customer_id_fkey on shop.orders -> shop.customers' in str(excinfo.value)
+
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*) FROM shop.orders')).scalar() == 3
+
+        # unless the referencing table is restored with it
+        with backup_file.open('rb') as fp:
+            worek.restore(
+                fp,
+                tables=['shop.customers', 'shop.orders'],
+                clean_existing_database=True,
+                saengine=pg_clean_engine,
+            )
+        with pg_clean_engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT count(*) FROM shop.customers')).scalar() == 2
+
+    def test_restore_no_matching_table(self, tmpdir, pg_clean_engine):
+        self.create_shop(pg_clean_engine)
+        backup_file = self.backup(tmpdir, pg_clean_engine)
+
+        result = CliRunner().invoke(
+            cli,
+            ['restore', '-d', DBNAME, '-f', str(backup_file), '-t', 'shop.missing'],
+        )
+        assert result.exit_code == 1
+        assert 'No table of the backup matches shop.missing' in str(result.exception)
+
+    def test_cli_exclude_table(self, tmpdir, pg_clean_engine):
+        self.create_shop(pg_clean_engine)
+        backup_file = self.backup(tmpdir, pg_clean_engine)
+
+        result = CliRunner().invoke(
+            cli,
+            ['restore', '-d', DBNAME, '-f', str(backup_file), '-T', 'notes', '-s', 'shop'],
+        )
+        assert result.exit_code == 0, result.output
+
+        with pg_clean_engine.connect() as conn:
+            tables = conn.execute(
+                sa.text("SELECT tablename FROM pg_tables WHERE schemaname = 'shop'"),
+            )
+            assert {x for (x,) in tables} == {'customers', 'orders'}